@@ -0,0 +1,279 @@
+"""promp の out / apply / clear のベンチマーク
+
+合成したリポジトリとLLMの出力を使い、各コマンドをエンドツーエンドとフェーズごとに計測する。
+ネットワークには接続しない。
+
+使い方:
+    python benchmarks/bench.py --scale 1k --scale 10k -o bench-result.json
+    python benchmarks/bench.py --scale 10k --baseline bench-result.json
+"""
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import datetime
+import subprocess
+import contextlib
+from pathlib import Path
+
+import click
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+PROMP_SCRIPT = REPO_ROOT / "promp.py"
+sys.path.insert(0, str(REPO_ROOT))
+
+import promp  # noqa: E402
+
+# 規模名と、プロンプトの対象になる（無視されない）ファイル数
+SCALES = {"1k": 1_000, "10k": 10_000, "100k": 100_000}
+# 1パッケージあたりのファイル数
+FILES_PER_PACKAGE = 50
+# node_modules 風の無視されるツリーの深さ
+IGNORED_TREE_DEPTH = 6
+# テストデータ風の fixtures/ を置くパッケージの間隔と、その中のファイル数（-e で除外する）
+FIXTURE_PACKAGE_INTERVAL = 10
+FIXTURES_PER_PACKAGE = 20
+OUT_PATTERNS = ("./**/*.py", "./**/*.md")
+OUT_EXCLUDES = ("**/fixtures/**",)
+# ベースラインとの比較に使わない項目
+NON_COMPARED_KEYS = ("generate", "files", "changes")
+
+
+# --- 合成データの生成 ---
+def _module_source(rng, package_no, module_no, lines):
+    """生成するPythonモジュールの内容"""
+    body = [f'"""package{package_no}.module{module_no}"""', "import os", ""]
+    for func_no in range(lines // 4):
+        body.append(f"def func_{func_no}(value):")
+        body.append(f"    # 計算 {rng.randint(0, 10 ** 6)}")
+        body.append(f"    return value * {func_no} + {rng.randint(0, 100)}")
+        body.append("")
+    return "\n".join(body) + "\n"
+
+
+def generate_repository(root, file_count, seed=0):
+    """合成リポジトリを生成し、対象ファイルの (パス, 内容) のリストを返す
+
+    以下を含む:
+    - src/pkgN/ 以下のPythonファイル（対象）とネストした .gitignore で無視される *.log
+    - 一部のパッケージの fixtures/ 以下のPythonファイル（OUT_EXCLUDES で除外される）
+    - ルートの .gitignore で無視される深い node_modules/ と build/
+    - .git/info/exclude で無視される *.tmp
+    """
+    rng = random.Random(seed)
+    root = Path(root)
+    (root / promp.TEMPLATE_DIR).mkdir(parents=True)
+    (root / promp.TEMPLATE_DIR / "default.txt").write_text(promp.DEFAULT_TEMPLATE_CONTENT, encoding="utf-8")
+    (root / ".gitignore").write_text("node_modules/\nbuild/\n.promp-out\n.promp-in\n", encoding="utf-8")
+    (root / ".git" / "info").mkdir(parents=True)
+    (root / ".git" / "info" / "exclude").write_text("*.tmp\n", encoding="utf-8")
+    (root / "README.md").write_text("# synthetic repository\n", encoding="utf-8")
+
+    files = []
+    package_count = max(1, file_count // FILES_PER_PACKAGE)
+    for package_no in range(package_count):
+        package_dir = root / "src" / f"pkg{package_no}"
+        package_dir.mkdir(parents=True)
+        (package_dir / ".gitignore").write_text("*.log\n", encoding="utf-8")
+        (package_dir / "debug.log").write_text("log\n" * 100, encoding="utf-8")
+        (package_dir / "cache.tmp").write_text("tmp\n", encoding="utf-8")
+        if package_no % FIXTURE_PACKAGE_INTERVAL == 0:
+            fixture_dir = package_dir / "fixtures" / "data"
+            fixture_dir.mkdir(parents=True)
+            for fixture_no in range(FIXTURES_PER_PACKAGE):
+                (fixture_dir / f"case{fixture_no}.py").write_text(f"CASE = {fixture_no}\n", encoding="utf-8")
+        for module_no in range(FILES_PER_PACKAGE):
+            if len(files) >= file_count:
+                break
+            path = package_dir / f"module{module_no}.py"
+            content = _module_source(rng, package_no, module_no, rng.randint(20, 200))
+            path.write_text(content, encoding="utf-8")
+            files.append((path.relative_to(root).as_posix(), content))
+
+    # 無視される深いツリー（対象ファイルと同じ数）
+    for ignored_root in ("node_modules", "build"):
+        for tree_no in range(max(1, file_count // (FILES_PER_PACKAGE * 2))):
+            tree_dir = root / ignored_root / f"lib{tree_no}"
+            for depth in range(IGNORED_TREE_DEPTH):
+                tree_dir = tree_dir / f"d{depth}"
+            tree_dir.mkdir(parents=True)
+            for module_no in range(FILES_PER_PACKAGE):
+                (tree_dir / f"index{module_no}.py").write_text("module.exports = {}\n", encoding="utf-8")
+    return files
+
+
+def generate_response(files, change_count, seed=0):
+    """合成したリポジトリに対する、LLMの出力（JSON差分形式）を生成する"""
+    rng = random.Random(seed)
+    targets = rng.sample(files, min(change_count, len(files)))
+    changes = []
+    for number, (path_str, content) in enumerate(targets):
+        kind = number % 4
+        if kind == 0:
+            changes.append({"file_path": path_str, "operation": "update", "content": content.replace("value", "val")})
+        elif kind == 1:
+            lines = content.split("\n")
+            changes.append({
+                "file_path": path_str,
+                "operation": "patch",
+                "diff": "@@ -1,3 +1,4 @@\n" + "\n".join(f" {line}" for line in lines[:2]) + "\n+import sys\n " + lines[2] + "\n",
+            })
+        elif kind == 2:
+            changes.append({"file_path": path_str, "operation": "delete"})
+        else:
+            new_path = path_str.replace(".py", "_new.py")
+            changes.append({"file_path": new_path, "operation": "create", "content": content})
+    body = json.dumps({"changes": changes}, ensure_ascii=False, indent=2)
+    return f"以下が変更内容です。\n\n```json\n{body}\n```\n"
+
+
+# --- 計測 ---
+def _run_cli(args, input_text=None):
+    """promp をサブプロセスとして実行し、経過時間を返す（インタプリタの起動時間を含む）"""
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, str(PROMP_SCRIPT), *args],
+        input=input_text, text=True, encoding="utf-8",
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True,
+    )
+    return time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def _timed(results, name):
+    """ブロックの経過時間を results[name] に記録する"""
+    start = time.perf_counter()
+    yield
+    results[name] = time.perf_counter() - start
+
+
+def _latest_input_file():
+    return sorted(Path(promp.INPUT_DIR).glob("in-*.txt"))[-1]
+
+
+def bench_scale(workdir, scale, change_count, seed):
+    """1つの規模について、out / apply / clear をエンドツーエンドとフェーズごとに計測する"""
+    results = {}
+    repo = Path(workdir) / f"repo-{scale}"
+    with _timed(results, "generate"):
+        files = generate_repository(repo, SCALES[scale], seed)
+    response = generate_response(files, change_count, seed)
+
+    cwd = os.getcwd()
+    os.chdir(repo)
+    try:
+        exclude_args = [arg for pattern in OUT_EXCLUDES for arg in ("-e", pattern)]
+        results["out.total"] = _run_cli(["out", *OUT_PATTERNS, *exclude_args])
+        # 同じ内容で2回目（インデックスが有効な状態）
+        results["out.total_warm"] = _run_cli(["out", *OUT_PATTERNS, *exclude_args])
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            with _timed(results, "out.collect"):
+                matched, _, _ = promp._collect_files(OUT_PATTERNS, OUT_EXCLUDES)
+            with _timed(results, "out.inspect"):
+                matched, _ = promp._inspect_files(matched, promp._parse_size_option(None, None, promp.DEFAULT_MAX_FILE_SIZE))
+            with _timed(results, "out.read"):
+                for _ in promp._iter_file_contents(matched, {}):
+                    pass
+            with _timed(results, "out.tokens"):
+                promp._collect_file_tokens(matched, {})
+
+        _latest_input_file().write_text(response, encoding="utf-8")
+        results["apply.total"] = _run_cli(["apply"], input_text="y\n")
+        results["apply.undo"] = _run_cli(["apply", "--undo"], input_text="y\n")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            with _timed(results, "apply.parse"):
+                changes, _, _ = promp._parse_llm_output(response)
+            with _timed(results, "apply.validate"):
+                promp._validate_changes(changes)
+            with _timed(results, "apply.stage"):
+                plan, created_dirs = promp._stage_changes(changes)
+            with _timed(results, "apply.commit"):
+                promp._commit_changes(plan, created_dirs, "bench")
+
+        results["clear.total"] = _run_cli(["clear"], input_text="y\n")
+    finally:
+        os.chdir(cwd)
+    results["files"] = len(files)
+    results["changes"] = change_count
+    return results
+
+
+def compare_with_baseline(current, baseline, threshold):
+    """ベースラインと比較して表を表示し、閾値を超えて遅くなった項目のリストを返す"""
+    regressions = []
+    click.echo(f"\n{'規模':<6} {'項目':<18} {'今回(s)':>10} {'基準(s)':>10} {'比率':>7}")
+    for scale, metrics in current["results"].items():
+        base_metrics = baseline.get("results", {}).get(scale, {})
+        for name, value in metrics.items():
+            base_value = base_metrics.get(name)
+            if name in NON_COMPARED_KEYS or not isinstance(base_value, (int, float)) or base_value <= 0:
+                continue
+            ratio = value / base_value
+            mark = ""
+            if ratio > 1 + threshold:
+                mark = " ← 悪化"
+                regressions.append((scale, name, ratio))
+            click.echo(f"{scale:<6} {name:<18} {value:>10.3f} {base_value:>10.3f} {ratio:>6.2f}x{mark}")
+    return regressions
+
+
+@click.command()
+@click.option("--scale", "scales", multiple=True, type=click.Choice(list(SCALES)), default=("1k",), show_default=True, help="計測する規模（複数指定可）。")
+@click.option("--changes", "change_count", default=300, show_default=True, help="合成するLLMの出力の変更数。")
+@click.option("--repeat", default=1, show_default=True, help="繰り返し回数。各項目の最小値を採用します。")
+@click.option("--seed", default=0, show_default=True, help="合成データの乱数シード。")
+@click.option("-o", "--output", type=click.Path(dir_okay=False), help="結果を保存するJSONファイル。")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False), help="比較対象の結果JSONファイル。")
+@click.option("--threshold", default=0.1, show_default=True, help="ベースラインより何割遅ければ悪化とみなすか。")
+@click.option("--workdir", type=click.Path(file_okay=False), help="合成リポジトリの作成先（指定時は削除しません）。")
+def main(scales, change_count, repeat, seed, output, baseline, threshold, workdir):
+    """合成リポジトリで promp の out / apply / clear を計測する"""
+    result = {
+        "meta": {
+            "timestamp": datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeat": repeat,
+        },
+        "results": {},
+    }
+    base_dir = workdir or tempfile.mkdtemp(prefix="promp-bench-")
+    try:
+        for scale in scales:
+            best = {}
+            for round_no in range(repeat):
+                round_dir = Path(base_dir) / f"round{round_no}"
+                round_dir.mkdir(parents=True, exist_ok=True)
+                click.echo(f"計測中: {scale}（{round_no + 1}/{repeat}）...")
+                for name, value in bench_scale(round_dir, scale, change_count, seed).items():
+                    best[name] = min(best.get(name, value), value)
+                if not workdir:
+                    shutil.rmtree(round_dir, ignore_errors=True)
+            result["results"][scale] = best
+            for name, value in best.items():
+                click.echo(f"  {name:<18} {value:>10.3f}" if isinstance(value, float) else f"  {name:<18} {value:>10}")
+    finally:
+        if not workdir:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    if output:
+        Path(output).write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+        click.echo(f"\n結果を '{output}' に保存しました。")
+
+    if baseline:
+        regressions = compare_with_baseline(result, json.loads(Path(baseline).read_text(encoding="utf-8")), threshold)
+        if regressions:
+            click.echo(click.style(f"\n{len(regressions)} 個の項目がベースラインより悪化しています。", fg="red"))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
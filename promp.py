@@ -1,5 +1,6 @@
 import os
 import glob
+import fnmatch
 import datetime
 from pathlib import Path
 import click
@@ -7,6 +8,43 @@ import re
 import pathspec
 import json
 import shutil
+import tempfile
+import sys
+import time
+import functools
+import unicodedata
+import hashlib
+import codecs
+import mmap
+import zipfile
+import itertools
+import ast
+import posixpath
+from collections import deque
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# promp watch で変更イベントを受け取るために使う（未インストールの場合は更新日時のポーリングで検出する）
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = None
+
+# promp out --batch のジョブ定義（TOML）の読み込みに使う（Python 3.10 では依存パッケージの tomli を使う）
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
 
 # --- 定数定義 ---
 TEMPLATE_DIR = ".promp-template"
@@ -20,8 +58,10 @@ JSON_DIFF_RULE="""==== JSON差分形式のルール ====
 * JSONオブジェクトには、changesというキーを持たせ、その値は変更点を記述したオブジェクトの配列とします。
 * 各変更オブジェクトには、以下のキーを含めてください。
   * file_path: (文字列) 対象となるファイルのパス。
-  * operation: (文字列) 操作の種類。create (新規作成), update (上書き更新), delete (削除) のいずれかを指定。
+  * operation: (文字列) 操作の種類。create (新規作成), update (上書き更新), patch (部分更新), delete (削除) のいずれかを指定。
   * content: (文字列) createまたはupdateの場合に、ファイルの新しい内容全体を記述。JSON文字列として正しくエスケープしてください（改行は`\\n`など）。
+  * diff: (文字列) patchの場合に、変更箇所をunified diff形式のハンクで記述。各ハンクは`@@ -開始行,行数 +開始行,行数 @@`の行で始め、続けて変更しない前後の行（先頭に半角スペース）、削除する行（先頭に`-`）、追加する行（先頭に`+`）を並べます。前後の行は変更箇所ごとに3行程度含め、既存ファイルの内容と一字一句一致させてください。`---`/`+++`のファイルヘッダーは不要です。
+* 重要: 既存ファイルの一部だけを変更する場合は、ファイル全体を出力するupdateではなくpatchを使用し、出力量を抑えてください。
 * 重要: JSONコードブロック以外の説明文は不要です。
 * 重要: ノーブレークスペース（U+00a0）は絶対に使用せず、通常のスペース（U+0020）のみを使用すること。
 * 重要: ユーザーからの指示内容を最優先とし、明示的に要求された変更のみを実行する。指示にない機能の追加、コードのフォーマット変更、その他の「気を利かせたつもり」の修正は一切行わない。
@@ -44,6 +84,11 @@ JSON_DIFF_RULE="""==== JSON差分形式のルール ====
       "operation": "update",
       "content": "import src.new_feature\\n\\nsrc.new_feature.new_function()\\n"
     },
+    {
+      "file_path": "src/utils.py",
+      "operation": "patch",
+      "diff": "@@ -10,3 +10,3 @@\\n def add(a, b):\\n-    return a+b\\n+    return a + b\\n \\n"
+    },
     {
       "file_path": "docs/old_spec.txt",
       "operation": "delete"
@@ -56,6 +101,7 @@ JSON_DIFF_RULE="""==== JSON差分形式のルール ====
 DEFAULT_TEMPLATE_CONTENT = """あなたは、エクスパートプログラマーです。
 以下の「ユーザーの指示」と「既存ファイル」を参考に、変更内容を「JSON差分形式」で出力してください。
 ※コード中のコメントは日本語で作成してください。
+※既存ファイルの一部だけを変更する場合は、patch操作で変更箇所のみを出力してください。
 
 {json_diff_rule}
 
@@ -70,6 +116,7 @@ DEFAULT_TEMPLATE_CONTENT = """あなたは、エクスパートプログラマ
 SPEC_TEMPLATE_CONTENT = """あなたは、エクスパートプログラマーです。
 以下の「アプリケーションの仕様」を参考に、変更内容を「JSON差分形式」で出力してください。
 ※コード中のコメントは日本語で作成してください。
+※既存ファイルの一部だけを変更する場合は、patch操作で変更箇所のみを出力してください。
 
 {json_diff_rule}
 
@@ -134,12 +181,163 @@ SPEC_TEMPLATE_CONTENT = """あなたは、エクスパートプログラマー
 {existing_files}
 """
 
+# --max-tokens でプロンプトを分割した場合の、2つ目以降のパートのテンプレート
+CONTINUATION_TEMPLATE_CONTENT = """{json_diff_rule}
+
+==== 既存ファイル（続き） ====
+{existing_files}
+"""
+
+# 分割したプロンプトの各パートの先頭に付ける注意書き
+PART_NOTE_FIRST = "※このプロンプトは{part_count}個のパートに分割されています（パート1/{part_count}）。すべてのパートを受け取るまでは回答せず、「次のパートをどうぞ」とだけ返答してください。"
+PART_NOTE_MIDDLE = "※分割されたプロンプトのパート{part_no}/{part_count}です。すべてのパートを受け取るまでは回答せず、「次のパートをどうぞ」とだけ返答してください。"
+PART_NOTE_LAST = "※分割されたプロンプトの最終パート（パート{part_no}/{part_count}）です。パート1の指示に従い、すべてのパートの既存ファイルを踏まえて回答してください。"
+
 GITIGNORE_CONTENT = """
 # for promp
 .promp-out
 .promp-in
 """
 
+# --- 統計情報（--stats） ---
+# 統計情報を既定で表示するための環境変数（1/true で表、json で表とJSON行）
+STATS_ENV = "PROMP_STATS"
+STATS_META_KEY = "promp.stats"
+
+# 統計情報の表に表示するフェーズ名と件数の名前
+STATS_PHASE_LABELS = {
+    "collect": "ファイル収集（走査・.gitignore判定）",
+    "related": "関連ファイルの探索（依存関係）",
+    "inspect": "ファイル検査（バイナリ・サイズ）",
+    "index_load": "インデックス読み込み",
+    "changed_filter": "変更ファイルの絞り込み",
+    "template": "テンプレート読み込み",
+    "pack": "トークン見積もり・分割",
+    "embed": "ファイル読み込み・プロンプト書き出し",
+    "index_save": "インデックス保存",
+    "read": "入力ファイル読み込み",
+    "parse": "JSON解析",
+    "validate": "変更内容の検証",
+    "confirm": "確認待ち（対話）",
+    "stage": "一時ファイルへの書き出し",
+    "commit": "変更の確定",
+    "undo": "取り消し",
+    "manifest": "マニフェスト記録",
+    "scan": "削除対象の集計",
+    "remove": "ディレクトリ・ファイル削除",
+    "archive": "アーカイブへの移動",
+}
+STATS_COUNT_LABELS = {
+    "files_matched": "パターンに一致したファイル数",
+    "files_ignored": ".gitignore で除外した数",
+    "files_excluded": "--exclude で除外した数",
+    "files_related": "追加した関連ファイル数",
+    "files_embedded": "埋め込んだファイル数",
+    "bytes_read": "読み込んだバイト数",
+    "bytes_written": "書き出したバイト数",
+    "write_seconds": "うち書き出し時間（秒）",
+    "tokens": "推定トークン数",
+    "bytes_saved": "削減したバイト数",
+    "tokens_saved": "削減した推定トークン数",
+    "changes": "変更数",
+    "files_removed": "削除したファイル数",
+    "bytes_removed": "削除したバイト数",
+    "files_archived": "アーカイブしたファイル数",
+    "bytes_archived": "アーカイブしたバイト数",
+}
+
+
+def _new_stats(command, enabled=False):
+    """コマンド1回分の統計情報を作成する"""
+    now = time.perf_counter()
+    return {"command": command, "enabled": enabled, "start": now, "mark": now, "phases": {}, "counts": {}, "skipped": {}}
+
+
+def _current_stats():
+    """実行中のコマンドの統計情報を返す（コマンド外から呼ばれた場合は記録しない統計情報を返す）"""
+    ctx = click.get_current_context(silent=True)
+    stats = ctx.meta.get(STATS_META_KEY) if ctx else None
+    return stats if stats is not None else _new_stats("")
+
+
+def _stats_lap(stats, phase):
+    """前回の区切りからの経過時間を、フェーズの時間として加算する"""
+    now = time.perf_counter()
+    stats["phases"][phase] = stats["phases"].get(phase, 0.0) + now - stats["mark"]
+    stats["mark"] = now
+
+
+def _stats_count(stats, key, value=1):
+    """件数やバイト数を加算する"""
+    stats["counts"][key] = stats["counts"].get(key, 0) + value
+
+
+def _stats_skip(stats, reason, value=1):
+    """スキップしたファイル数を理由ごとに加算する"""
+    stats["skipped"][reason] = stats["skipped"].get(reason, 0) + value
+
+
+def _peak_memory():
+    """プロセスの最大メモリ使用量（バイト）を返す。取得できない環境では None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux では KB、macOS ではバイト単位
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _ljust_display(text, width):
+    """全角文字を2桁として数え、表示幅が width になるよう右側を空白で埋める"""
+    display_width = sum(2 if unicodedata.east_asian_width(ch) in ("W", "F") else 1 for ch in text)
+    return text + " " * max(0, width - display_width)
+
+
+def _echo_stats(stats, as_json):
+    """統計情報の表を表示し、必要に応じてJSON行も出力する"""
+    wall = time.perf_counter() - stats["start"]
+    peak = _peak_memory()
+    click.echo(f"\n==== 統計情報 ({stats['command']}) ====")
+    for phase, seconds in stats["phases"].items():
+        click.echo(f"  {_ljust_display(STATS_PHASE_LABELS.get(phase, phase), 40)}{seconds:>10.3f} 秒")
+    click.echo(f"  {_ljust_display('合計', 40)}{wall:>10.3f} 秒")
+    for key, value in stats["counts"].items():
+        formatted = f"{value:,.3f}" if isinstance(value, float) else f"{value:,}"
+        click.echo(f"  {STATS_COUNT_LABELS.get(key, key)}: {formatted}")
+    for reason, count in stats["skipped"].items():
+        click.echo(f"  スキップ（{reason}）: {count:,}")
+    click.echo(f"  最大メモリ使用量: {_format_size(peak) if peak is not None else '不明'}")
+    if as_json:
+        record = {
+            "command": stats["command"],
+            "wall_seconds": round(wall, 6),
+            "phases": {phase: round(seconds, 6) for phase, seconds in stats["phases"].items()},
+            "counts": {key: round(value, 6) if isinstance(value, float) else value for key, value in stats["counts"].items()},
+            "skipped": stats["skipped"],
+            "peak_memory_bytes": peak,
+        }
+        click.echo(json.dumps(record, ensure_ascii=False))
+
+
+def _with_stats(func):
+    """コマンドに --stats / --stats-json オプションを追加し、終了時に統計情報を表示するデコレーター"""
+    @functools.wraps(func)
+    def wrapper(*args, stats, stats_json, **kwargs):
+        env_value = os.environ.get(STATS_ENV, "").strip().lower()
+        as_json = stats_json or env_value == "json"
+        enabled = stats or as_json or env_value in ("1", "true", "yes", "on", "json")
+        collector = _new_stats(func.__name__, enabled)
+        click.get_current_context().meta[STATS_META_KEY] = collector
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if enabled:
+                _echo_stats(collector, as_json)
+
+    wrapper = click.option("--stats-json", is_flag=True, help="統計情報に加えて、JSON形式の1行を出力します。")(wrapper)
+    wrapper = click.option("--stats", is_flag=True, help=f"フェーズごとの処理時間やファイル数などの統計情報を表示します（環境変数 {STATS_ENV}=1 でも有効）。")(wrapper)
+    return wrapper
+
+
 # --- CLIの定義 ---
 @click.group()
 def promp():
@@ -190,12 +388,1799 @@ def init():
     click.echo(click.style("初期化が完了しました。", fg="green"))
 
 
+# --- ファイル収集（.gitignore対応の枝刈りディレクトリ走査） ---
+GIT_DIR = ".git"
+GIT_INFO_EXCLUDE = os.path.join(GIT_DIR, "info", "exclude")
+
+# Windowsではglobと同様に大文字・小文字を区別しない
+_GLOB_FLAGS = re.IGNORECASE if os.name == "nt" else 0
+
+
+def _compile_glob_pattern(pattern):
+    """globパターンを、階層ごとの照合用セグメントのリストに変換する
+
+    '**' のセグメントは None、それ以外は (正規表現, 隠しファイルへの一致を許すか) のタプルになる。
+    カレントフォルダ配下を表さないパターン（絶対パスや '..' を含むもの）の場合は None を返す。
+    """
+    normalized = pattern.replace(os.sep, "/") if os.sep != "/" else pattern
+    if os.path.isabs(pattern) or normalized.startswith("/"):
+        return None
+    parts = [p for p in normalized.split("/") if p not in ("", ".")]
+    if ".." in parts:
+        return None
+    segments = []
+    for part in parts:
+        if part == "**":
+            # 連続する '**' は一つにまとめる
+            if segments and segments[-1] is None:
+                continue
+            segments.append(None)
+        else:
+            regex = re.compile(fnmatch.translate(part), _GLOB_FLAGS)
+            # globと同様、ワイルドカードは先頭が '.' の名前に一致させない
+            allow_hidden = part.startswith(".") or not glob.has_magic(part)
+            segments.append((regex, allow_hidden))
+    return segments
+
+
+def _expand_states(states, compiled_patterns):
+    """'**' が0階層に一致する場合を考慮して、照合状態の集合を展開する"""
+    expanded = set(states)
+    pending = list(states)
+    while pending:
+        index, pos = pending.pop()
+        segments = compiled_patterns[index]
+        if pos < len(segments) - 1 and segments[pos] is None and (index, pos + 1) not in expanded:
+            expanded.add((index, pos + 1))
+            pending.append((index, pos + 1))
+    return expanded
+
+
+def _load_ignore_spec(path):
+    """.gitignore 形式のファイルを読み込む。読めない場合は None を返す"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return pathspec.GitIgnoreSpec.from_lines(f)
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def _is_ignored(rel_path, ignore_specs):
+    """ルートから深い順に並んだ .gitignore を評価し、最後に一致したルールで無視するか判定する"""
+    ignored = False
+    for base, spec in ignore_specs:
+        result = spec.check_file(rel_path[len(base):]).include
+        if result is not None:
+            ignored = result
+    return ignored
+
+
+def _collect_files(file_patterns, exclude, by_pattern=False):
+    """パターンに一致するファイルを、無視対象のディレクトリに降りずに一回の走査で収集する
+
+    .gitignore（ネストしたものを含む）、.git/info/exclude、--exclude のパターンを走査中に評価し、
+    無視されるディレクトリはその場で枝刈りする。
+    戻り値は (ソート済みの相対パスのリスト, .gitignore で除外した数, --exclude で除外した数)。
+    by_pattern を指定した場合は、リストの代わりに {相対パス: 一致したパターンの番号の集合} を返す。
+    """
+    exclude_spec = pathspec.GitIgnoreSpec.from_lines(exclude) if exclude else None
+
+    compiled_patterns = []
+    compiled_numbers = []
+    outside_patterns = []
+    for number, pattern in enumerate(file_patterns):
+        # 末尾が '/' のパターンはディレクトリにしか一致しないため対象外
+        if pattern.endswith(("/", os.sep)):
+            continue
+        segments = _compile_glob_pattern(pattern)
+        if segments is None:
+            outside_patterns.append((number, pattern))
+        elif segments:
+            compiled_patterns.append(segments)
+            compiled_numbers.append(number)
+
+    matched = {}
+    ignored_count = 0
+    excluded_count = 0
+
+    # カレントフォルダ外を指すパターンは従来どおりglobで展開する（.gitignoreの対象外）
+    for number, pattern in outside_patterns:
+        for path_str in glob.glob(pattern, recursive=True):
+            if not os.path.isfile(path_str):
+                continue
+            posix_path = Path(path_str).as_posix()
+            if exclude_spec and exclude_spec.match_file(posix_path):
+                excluded_count += 1
+                continue
+            matched.setdefault(posix_path, set()).add(number)
+
+    root_specs = []
+    info_exclude_spec = _load_ignore_spec(GIT_INFO_EXCLUDE) if os.path.isfile(GIT_INFO_EXCLUDE) else None
+    if info_exclude_spec is not None:
+        root_specs.append(("", info_exclude_spec))
+
+    initial_states = _expand_states({(i, 0) for i in range(len(compiled_patterns))}, compiled_patterns)
+    # スタックの要素: (相対ディレクトリパス（末尾'/'付き）, 照合状態, 適用する.gitignore, 辿ったシンボリックリンク先)
+    stack = [("", initial_states, root_specs, frozenset())] if compiled_patterns else []
+    while stack:
+        rel_dir, states, ignore_specs, link_targets = stack.pop()
+        dir_path = rel_dir or "."
+        try:
+            with os.scandir(dir_path) as it:
+                entries = list(it)
+        except OSError:
+            continue
+
+        # このディレクトリの .gitignore は、同じ階層のエントリから有効になる
+        for entry in entries:
+            if entry.name == GITIGNORE_FILE and entry.is_file():
+                spec = _load_ignore_spec(entry.path)
+                if spec is not None:
+                    ignore_specs = ignore_specs + [(rel_dir, spec)]
+                break
+
+        for entry in entries:
+            name = entry.name
+            if name == GIT_DIR:
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+
+            # 各パターンの照合を1階層進める
+            matched_numbers = set()
+            child_states = set()
+            hidden = name.startswith(".")
+            for index, pos in states:
+                segments = compiled_patterns[index]
+                segment = segments[pos]
+                is_last = pos == len(segments) - 1
+                if segment is None:
+                    if hidden:
+                        continue
+                    if is_last:
+                        matched_numbers.add(compiled_numbers[index])
+                    child_states.add((index, pos))
+                else:
+                    regex, allow_hidden = segment
+                    if (hidden and not allow_hidden) or not regex.match(name):
+                        continue
+                    if is_last:
+                        matched_numbers.add(compiled_numbers[index])
+                    else:
+                        child_states.add((index, pos + 1))
+
+            # 一致の見込みがないエントリは、無視判定も行わずに読み飛ばす
+            if is_dir and not child_states:
+                continue
+            if not is_dir and not matched_numbers:
+                continue
+
+            rel_path = rel_dir + name
+            check_path = rel_path + "/" if is_dir else rel_path
+            if _is_ignored(check_path, ignore_specs):
+                ignored_count += 1
+                continue
+            if exclude_spec and exclude_spec.match_file(check_path):
+                excluded_count += 1
+                continue
+
+            if not is_dir:
+                matched.setdefault(rel_path, set()).update(matched_numbers)
+                continue
+
+            # シンボリックリンクによる循環を避ける
+            if entry.is_symlink():
+                target = os.path.realpath(entry.path)
+                current = os.path.realpath(dir_path)
+                if target in link_targets or current == target or current.startswith(target.rstrip(os.sep) + os.sep):
+                    continue
+                child_link_targets = link_targets | {target}
+            else:
+                child_link_targets = link_targets
+            stack.append((rel_path + "/", _expand_states(child_states, compiled_patterns), ignore_specs, child_link_targets))
+
+    return (matched if by_pattern else sorted(matched)), ignored_count, excluded_count
+
+
+# --- トークン数の見積もりとプロンプトの分割 ---
+# トークン数の集計表に表示するファイル数
+TOKEN_SUMMARY_LIMIT = 10
+_ASCII_BYTES = bytes(range(0x80))
+_UTF8_CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+
+
+def _estimate_tokens(data):
+    """テキスト（bytes または str）のトークン数をオフラインで概算する
+
+    ASCII文字は約4文字で1トークン、日本語などの非ASCII文字は1文字で約1トークンとして数える。
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    non_ascii = data.translate(None, _ASCII_BYTES)
+    # UTF-8の継続バイトを除くと、非ASCII文字の先頭バイトだけが残る
+    non_ascii_chars = len(non_ascii.translate(None, _UTF8_CONTINUATION_BYTES))
+    ascii_chars = len(data) - len(non_ascii)
+    return (ascii_chars + 3) // 4 + non_ascii_chars
+
+
+def _section_tokens(path_str, file_tokens, section=None, label=None):
+    """ヘッダーと区切りの改行（コードフェンスを含む）を含めた、1ファイル分の推定トークン数
+
+    分割の見積もりと、書き出したプロンプトの集計の両方でこの関数を使い、数え方を揃える。
+    label にはヘッダーにパスの代わりに表示する文字列を指定する。
+    """
+    section = section or DEFAULT_FILE_SECTION
+    overhead = "\n\n" + _format_section_header(section, path_str, label) + "\n"
+    if section["fenced"]:
+        overhead += f"```{_fence_language(path_str)}\n\n```"
+    return file_tokens + _estimate_tokens(overhead)
+
+
+def _collect_file_tokens(file_paths, file_index):
+    """各ファイルの推定トークン数を並列に求める。インデックスの記録が新しいファイルは読まない
+
+    読み込めなかったファイルは結果に含めない。
+    """
+    file_tokens = {}
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        futures = [
+            (path_str, executor.submit(_index_file, path_str, file_index.get(path_str)))
+            for path_str in file_paths
+        ]
+        for path_str, future in futures:
+            try:
+                entry = future.result()
+            except OSError:
+                continue
+            file_index[path_str] = entry
+            file_tokens[path_str] = entry["tokens"]
+    return file_tokens
+
+
+def _pack_parts(file_paths, section_tokens, first_budget, rest_budget):
+    """ファイルをソート順のまま、各パートの予算に収まるように先頭から詰めていく
+
+    1つ目のパートはテンプレートを含むため、予算を別に指定する。
+    単独で予算を超えるファイルは、1ファイルだけのパートになる。
+    """
+    parts = [[]]
+    used = 0
+    budget = first_budget
+    for path_str in file_paths:
+        tokens = section_tokens.get(path_str, 0)
+        if parts[-1] and used + tokens > budget:
+            parts.append([])
+            used = 0
+            budget = rest_budget
+        parts[-1].append(path_str)
+        used += tokens
+    return parts
+
+
+def _echo_token_summary(file_tokens, template_tokens, parts):
+    """推定トークン数の多いファイルの集計表を表示する
+
+    合計は、ヘッダーやコードフェンス、2つ目以降のパートのテンプレートと注意書きを含む、各パートの合計とする。
+    """
+    click.echo("\n==== 推定トークン数 ====")
+    ranked = sorted(file_tokens.items(), key=lambda item: (-item[1], item[0]))
+    total = sum(part_tokens for _, part_tokens, _ in parts)
+    split = len(parts) > 1
+    for path_str, tokens in ranked[:TOKEN_SUMMARY_LIMIT]:
+        ratio = tokens / total * 100 if total else 0
+        click.echo(f"  {tokens:>10,}  {ratio:5.1f}%  {path_str}")
+    if len(ranked) > TOKEN_SUMMARY_LIMIT:
+        rest = ranked[TOKEN_SUMMARY_LIMIT:]
+        click.echo(f"  （他 {len(rest)} 個のファイル: {sum(tokens for _, tokens in rest):,} トークン）")
+    click.echo(f"  テンプレート: {template_tokens:,} トークン" + ("（パート1）" if split else ""))
+    if split:
+        for part_no, (output_path, part_tokens, file_count) in enumerate(parts, start=1):
+            click.echo(f"  パート{part_no}: {part_tokens:,} トークン（{file_count} ファイル） -> {output_path}")
+    click.echo(f"  合計: {total:,} トークン")
+
+
+# --- .promp-out などに保存する JSON ファイルの読み書き ---
+def _read_json_dict(path):
+    """JSON ファイルを辞書として読み込む。存在しない、壊れている、または辞書でない場合は空の辞書を返す"""
+    try:
+        with Path(path).open("r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _write_text_atomic(path, text):
+    """テキストファイルを一時ファイル経由で置き換えて保存する（書き込み途中のファイルを読ませない）"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # watch と out などが同じファイルを同時に保存しても一時ファイルが衝突しないよう、名前は毎回作る
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="\n") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+def _write_json_atomic(path, data, indent=None):
+    """JSON ファイルを一時ファイル経由で置き換えて保存する"""
+    _write_text_atomic(
+        path, json.dumps(data, ensure_ascii=False, indent=indent, separators=None if indent else (",", ":"))
+    )
+
+
+# --- ファイルインデックス（内容ハッシュの永続化） ---
+INDEX_FILE = "index.json"
+# インデックスに保持する過去のプロンプトのスナップショット数
+INDEX_MAX_RUNS = 20
+# インデックスの各ファイルの記録に含まれるキー
+INDEX_ENTRY_KEYS = ("size", "mtime_ns", "hash", "tokens")
+
+
+def _hash_bytes(data):
+    """ファイル内容のハッシュ値を求める"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _is_fresh_entry(entry, st):
+    """インデックスの記録が揃っていて、ファイルのサイズ・更新日時と一致するか"""
+    return (
+        bool(entry)
+        and all(key in entry for key in INDEX_ENTRY_KEYS)
+        and entry["size"] == st.st_size
+        and entry["mtime_ns"] == st.st_mtime_ns
+    )
+
+
+def _make_index_entry(st, data):
+    """ファイルの stat 結果と内容からインデックスの記録を作成する"""
+    return {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "hash": _hash_bytes(data),
+        "tokens": _estimate_tokens(data),
+    }
+
+
+def _encode_runs(runs, files):
+    """スナップショットを保存用の小さな形にまとめ、(ファイルの記録のないパスの一覧, {タイムスタンプ: 記録}) を返す
+
+    パスの番号は、パス順に並べたファイルの記録の順に、記録のないパスを続けたもの。各スナップショットは、
+    番号の範囲 [開始, 終了) のリストと、ファイルの記録と異なるハッシュ値 [番号, ハッシュ値] のリストだけを保存する
+    （同じパスとハッシュ値をスナップショットごとに繰り返さない）。
+    """
+    extra_paths = sorted(set().union(*runs.values()).difference(files))
+    numbers = {path_str: number for number, path_str in enumerate(itertools.chain(sorted(files), extra_paths))}
+    encoded = {}
+    for timestamp, snapshot in runs.items():
+        ranges = []
+        changed = []
+        for path_str in sorted(snapshot, key=numbers.__getitem__):
+            number = numbers[path_str]
+            if ranges and ranges[-1][1] == number:
+                ranges[-1][1] = number + 1
+            else:
+                ranges.append([number, number + 1])
+            entry = files.get(path_str)
+            if entry is None or entry.get("hash") != snapshot[path_str]:
+                changed.append([number, snapshot[path_str]])
+        encoded[timestamp] = {"ranges": ranges, "changed": changed}
+    return extra_paths, encoded
+
+
+def _decode_runs(paths, encoded, files):
+    """_encode_runs で保存したスナップショットを {タイムスタンプ: {パス: ハッシュ値}} に戻す。壊れた記録は読み飛ばす"""
+    runs = {}
+    for timestamp, run in encoded.items():
+        try:
+            snapshot = {}
+            for start, end in run["ranges"]:
+                for path_str in paths[start:end]:
+                    entry = files.get(path_str)
+                    if entry is not None and "hash" in entry:
+                        snapshot[path_str] = entry["hash"]
+            for number, file_hash in run["changed"]:
+                snapshot[paths[number]] = file_hash
+        except (KeyError, TypeError, ValueError, IndexError):
+            continue
+        runs[timestamp] = snapshot
+    return runs
+
+
+def _load_file_index():
+    """'.promp-out/index.json' を読み込む。存在しない、または壊れている場合は空のインデックスを返す"""
+    index = _read_json_dict(Path(OUTPUT_DIR) / INDEX_FILE)
+    index.setdefault("files", {})
+    index.setdefault("runs", {})
+    # extra_paths がある場合は、まとめて保存したスナップショット（ない場合は以前の {パス: ハッシュ値} の形）
+    extra_paths = index.pop("extra_paths", None)
+    if isinstance(extra_paths, list):
+        index["runs"] = _decode_runs(list(index["files"]) + extra_paths, index["runs"], index["files"])
+    return index
+
+
+def _save_file_index(index):
+    """インデックスを一時ファイル経由で置き換えて保存する
+
+    保持しているスナップショットのいずれにも含まれないファイルと、削除・名前変更されたファイルの記録は破棄する。
+    スナップショットは _encode_runs でまとめて保存する（メモリ上の index は変更しない）。
+    """
+    # 古いスナップショットから順に破棄する
+    for timestamp in sorted(index["runs"])[:-INDEX_MAX_RUNS]:
+        del index["runs"][timestamp]
+    referenced = set().union(*index["runs"].values())
+    # 最新のスナップショットのファイルは読み込んだばかりのため、それ以外のファイルだけ存在を確認する
+    latest = index["runs"][max(index["runs"])] if index["runs"] else {}
+    for path_str in list(index["files"]):
+        if path_str not in referenced or (path_str not in latest and not os.path.isfile(path_str)):
+            del index["files"][path_str]
+    extra_paths, runs = _encode_runs(index["runs"], index["files"])
+    files = dict(sorted(index["files"].items()))
+    _write_json_atomic(Path(OUTPUT_DIR) / INDEX_FILE, {"files": files, "extra_paths": extra_paths, "runs": runs})
+
+
+def _index_file(path_str, known=None):
+    """ファイルの現在のインデックスの記録を返す。サイズと更新日時が known と一致すればファイルを開かない"""
+    if _is_fresh_entry(known, os.stat(path_str)):
+        return known
+    with open(path_str, "rb") as f:
+        st = os.fstat(f.fileno())
+        if st.st_size >= LARGE_FILE_THRESHOLD:
+            return _index_large_file(f, st)
+        return _make_index_entry(st, f.read())
+
+
+def _current_file_hash(path_str, file_index):
+    """ファイルの現在のハッシュ値を返し、インデックスの記録を更新する"""
+    entry = _index_file(path_str, file_index.get(path_str))
+    file_index[path_str] = entry
+    return entry["hash"]
+
+
+def _filter_changed_files(file_paths, changed_since, index):
+    """--changed-since で指定したプロンプト以降に変更されたファイルだけを返す
+
+    指定したプロンプトのスナップショットがインデックスにあれば内容ハッシュで比較し、
+    なければタイムスタンプとファイルの更新日時で比較する。指定が不正な場合は None を返す。
+    """
+    runs = index["runs"]
+    if changed_since == "last":
+        if not runs:
+            click.echo(click.style("エラー: 比較対象となる過去のプロンプトの記録が見つかりません。", fg="red"))
+            return None
+        timestamp = max(runs)
+    else:
+        match = re.search(r"\d{8}-\d{6}", changed_since)
+        if not match:
+            click.echo(click.style(f"エラー: --changed-since には 'last' または YYYYMMDD-HHMMSS を指定してください: {changed_since}", fg="red"))
+            return None
+        timestamp = match.group(0)
+
+    snapshot = runs.get(timestamp)
+    if snapshot is not None:
+        click.echo(f"ℹ️ プロンプト 'out-{timestamp}.txt' の時点から内容が変更されたファイルを対象とします。")
+        changed = []
+        for path_str in file_paths:
+            try:
+                if snapshot.get(path_str) != _current_file_hash(path_str, index["files"]):
+                    changed.append(path_str)
+            except OSError:
+                changed.append(path_str)
+        return changed
+
+    try:
+        since = datetime.datetime.strptime(timestamp, "%Y%m%d-%H%M%S").timestamp()
+    except ValueError:
+        click.echo(click.style(f"エラー: タイムスタンプの形式が正しくありません: {timestamp}", fg="red"))
+        return None
+    click.echo(f"ℹ️ {timestamp} 以降に更新されたファイルを対象とします（インデックスに記録がないため更新日時で判定します）。")
+    changed = []
+    for path_str in file_paths:
+        try:
+            if os.stat(path_str).st_mtime >= since:
+                changed.append(path_str)
+        except OSError:
+            changed.append(path_str)
+    return changed
+
+
+# --- 依存関係グラフ（--related による関連ファイルの追加） ---
+DEPS_FILE = "deps.json"
+DEFAULT_RELATED_LIMIT = 50
+# 依存関係を解析する拡張子
+PYTHON_EXTENSIONS = (".py", ".pyi")
+JS_EXTENSIONS = (".ts", ".tsx", ".js", ".jsx", ".mjs", ".cjs")
+# Python の絶対インポートを探すフォルダ（カレントフォルダと src レイアウト）
+PYTHON_IMPORT_ROOTS = ("", "src/")
+# import/export ... from '...'、import '...'、require('...')、import('...') のうち、相対パスのもの
+_JS_IMPORT_PATTERN = re.compile(
+    r"""(?:\bimport\s+(?:[^'"`;]*?\s+from\s+)?|\bexport\s+[^'"`;]*?\s+from\s+|\b(?:require|import)\s*\(\s*)"""
+    r"""(['"])(\.{1,2}/[^'"\n]*)\1"""
+)
+
+
+def _python_module_candidates(parts, roots):
+    """モジュール名の各部分から、対応するファイルの候補を詳しい順に返す"""
+    candidates = []
+    for count in range(len(parts), 0, -1):
+        for root in roots:
+            prefix = root + "/".join(parts[:count])
+            candidates.extend((prefix + ".py", prefix + "/__init__.py"))
+    return candidates
+
+
+def _python_import_candidates(path_str, source):
+    """Python の import 文を ast で解析し、インポートごとにファイルの候補のリストを返す"""
+    try:
+        tree = ast.parse(source, filename=path_str)
+    except (SyntaxError, ValueError):
+        return []
+    package_dir = posixpath.dirname(path_str)
+    imports = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                imports.append(_python_module_candidates(alias.name.split("."), PYTHON_IMPORT_ROOTS))
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                base = posixpath.normpath(posixpath.join(package_dir or ".", *[".."] * (node.level - 1)))
+                if base == ".." or base.startswith("../"):
+                    continue
+                roots = ("" if base == "." else base + "/",)
+            else:
+                roots = PYTHON_IMPORT_ROOTS
+            module_parts = node.module.split(".") if node.module else []
+            for alias in node.names:
+                # from x import y の y はサブモジュールの場合と、x の中の名前の場合がある
+                names = module_parts + [alias.name] if alias.name != "*" else module_parts
+                candidates = _python_module_candidates(names, roots)
+                if node.level:
+                    # from . import x の x がモジュールでない場合は、パッケージ自体を参照する
+                    candidates.append(roots[0] + "__init__.py")
+                imports.append(candidates)
+    return imports
+
+
+def _js_import_candidates(path_str, source):
+    """JavaScript/TypeScript の相対パスのインポートごとに、ファイルの候補のリストを返す"""
+    imports = []
+    base_dir = posixpath.dirname(path_str)
+    for m in _JS_IMPORT_PATTERN.finditer(source):
+        target = posixpath.normpath(posixpath.join(base_dir, m.group(2)))
+        if target == ".." or target.startswith("../"):
+            continue
+        stem, ext = posixpath.splitext(target)
+        candidates = []
+        if ext in JS_EXTENSIONS:
+            candidates.append(target)
+            # TypeScript の ESM では、.ts ファイルを .js の拡張子でインポートする
+            if ext in (".js", ".jsx", ".mjs", ".cjs"):
+                candidates.extend((stem + ".ts", stem + ".tsx"))
+        candidates.extend(target + js_ext for js_ext in JS_EXTENSIONS)
+        candidates.extend(f"{target}/index{js_ext}" for js_ext in JS_EXTENSIONS)
+        imports.append(candidates)
+    return imports
+
+
+def _parse_import_candidates(path_str, data):
+    """ファイルの内容から、インポートごとのファイルの候補を求める"""
+    source = data.decode("utf-8", errors="replace")
+    if path_str.endswith(PYTHON_EXTENSIONS):
+        return _python_import_candidates(path_str, source)
+    return _js_import_candidates(path_str, source)
+
+
+def _load_dependency_graph(exclude):
+    """プロジェクト内の Python/JS/TS ファイルの依存関係を {パス: [インポートするファイルのパス]} として返す
+
+    ファイルごとのインポートの解析結果は '.promp-out/deps.json' にキャッシュし、
+    サイズ・更新日時、またはハッシュ値が変わっていないファイルは解析し直さない。
+    """
+    patterns = [f"**/*{ext}" for ext in PYTHON_EXTENSIONS + JS_EXTENSIONS]
+    file_paths, _, _ = _collect_files(patterns, exclude)
+    cache_path = Path(OUTPUT_DIR) / DEPS_FILE
+    cache = _read_json_dict(cache_path)
+
+    entries = {}
+    changed = False
+    for path_str in file_paths:
+        try:
+            st = os.stat(path_str)
+            cached = cache.get(path_str)
+            if cached and cached.get("size") == st.st_size and cached.get("mtime_ns") == st.st_mtime_ns:
+                entries[path_str] = cached
+                continue
+            with open(path_str, "rb") as f:
+                data = f.read()
+        except OSError:
+            continue
+        digest = _hash_bytes(data)
+        if cached and cached.get("hash") == digest:
+            imports = cached["imports"]
+        else:
+            imports = _parse_import_candidates(path_str, data)
+        entries[path_str] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": digest, "imports": imports}
+        changed = True
+
+    if changed or len(entries) != len(cache):
+        _write_json_atomic(cache_path, entries)
+
+    # インポートごとに、候補のうち実在する最初のファイルを依存先とする
+    known = set(entries)
+    graph = {}
+    for path_str, entry in entries.items():
+        targets = []
+        for candidates in entry["imports"]:
+            target = next((candidate for candidate in candidates if candidate in known), None)
+            if target is not None and target != path_str and target not in targets:
+                targets.append(target)
+        graph[path_str] = targets
+    return graph
+
+
+def _find_related_files(seeds, graph, depth):
+    """起点のファイルから depth 段階までにインポートする・されるファイルを、(パス, 距離) の距離順のリストで返す"""
+    importers = {}
+    for path_str, targets in graph.items():
+        for target in targets:
+            importers.setdefault(target, []).append(path_str)
+
+    distances = {path_str: 0 for path_str in seeds}
+    frontier = list(seeds)
+    for distance in range(1, depth + 1):
+        next_frontier = []
+        for path_str in frontier:
+            for neighbor in graph.get(path_str, []) + importers.get(path_str, []):
+                if neighbor not in distances:
+                    distances[neighbor] = distance
+                    next_frontier.append(neighbor)
+        frontier = next_frontier
+    return sorted(
+        ((path_str, distance) for path_str, distance in distances.items() if distance),
+        key=lambda item: (item[1], item[0]),
+    )
+
+
+def _limit_related_files(related, limit, max_size):
+    """距離の近い順に、件数と合計サイズの上限まで関連ファイルを選ぶ。戻り値は (選んだもの, 上限で除外した数)"""
+    selected = []
+    total_size = 0
+    for index, (path_str, distance) in enumerate(related):
+        if len(selected) >= limit:
+            return selected, len(related) - index
+        try:
+            size = os.path.getsize(path_str)
+        except OSError:
+            continue
+        if max_size and total_size + size > max_size:
+            return selected, len(related) - index
+        selected.append((path_str, distance))
+        total_size += size
+    return selected, 0
+
+
+# --- 埋め込み前のファイル検査（バイナリ・サイズ超過・エンコーディング） ---
+# 埋め込むファイルサイズの上限の既定値
+DEFAULT_MAX_FILE_SIZE = "1MB"
+# バイナリやエンコーディングの判定に読む先頭部分のサイズ
+SNIFF_SIZE = 8192
+# これ以上のサイズのファイルは、メモリに全体を読み込まずに mmap と分割読み込みで処理する
+LARGE_FILE_THRESHOLD = 4 * 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+# 分割して書き写す途中でUTF-8として解釈できない内容が見つかった場合に書き添える注意書き
+DECODE_ERROR_NOTE = "\n（UTF-8として解釈できない内容があるため、以降を省略しました）\n"
+_SIZE_UNITS = {"": 1, "B": 1, "KB": 1024, "K": 1024, "MB": 1024 ** 2, "M": 1024 ** 2, "GB": 1024 ** 3, "G": 1024 ** 3}
+
+
+def _parse_size_option(ctx, param, value):
+    """'500KB' '2MB' などのサイズ指定をバイト数に変換する（0 は無制限）"""
+    if value is None:
+        return None
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([A-Za-z]*)\s*", str(value))
+    if not match or match.group(2).upper() not in _SIZE_UNITS:
+        raise click.BadParameter(f"サイズの形式が正しくありません: {value}（例: 500KB, 2MB）")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def _format_size(size):
+    """バイト数を読みやすい単位の文字列にする"""
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+def _inspect_file(path_str, max_file_size):
+    """ファイルを読み込む前に、サイズと先頭部分だけで埋め込めるかを判定する
+
+    埋め込めない場合はその理由を、埋め込める場合は None を返す。
+    """
+    try:
+        with open(path_str, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if max_file_size and size > max_file_size:
+                return f"サイズ超過 ({_format_size(size)} > {_format_size(max_file_size)})"
+            head = f.read(SNIFF_SIZE)
+    except OSError as e:
+        return f"読み込み不可 ({e})"
+    if b"\0" in head:
+        return "バイナリファイル"
+    try:
+        # 先頭部分の末尾で途切れた文字は許容する
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=len(head) < SNIFF_SIZE)
+    except UnicodeDecodeError:
+        return "UTF-8以外のエンコーディング"
+    return None
+
+
+def _inspect_files(file_paths, max_file_size):
+    """各ファイルを並列に検査し、(埋め込むファイルのリスト, スキップしたファイルと理由のリスト) を返す"""
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        reasons = list(executor.map(_inspect_file, file_paths, itertools.repeat(max_file_size)))
+    accepted = [path_str for path_str, reason in zip(file_paths, reasons) if reason is None]
+    skipped = [(path_str, reason) for path_str, reason in zip(file_paths, reasons) if reason is not None]
+    return accepted, skipped
+
+
+def _index_large_file(f, st, validate=False):
+    """大きなファイルを mmap で参照し、内容全体を複製せずにインデックスの記録を作成する
+
+    validate が True の場合は UTF-8 として正しいかも確認し、不正なら UnicodeDecodeError を送出する。
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    tokens = 0
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        digest.update(mm)
+        for offset in range(0, len(mm), READ_CHUNK_SIZE):
+            chunk = mm[offset:offset + READ_CHUNK_SIZE]
+            tokens += _estimate_tokens(chunk)
+            if validate:
+                decoder.decode(chunk)
+    if validate:
+        decoder.decode(b"", final=True)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": digest.hexdigest(), "tokens": tokens}
+
+
+def _copy_text_file(out_f, path_str):
+    """テキストファイルを分割して読みながら、出力ストリームへ書き写す
+
+    戻り値は、ファイルが改行で終わっているかどうか。UTF-8として解釈できない場合は、
+    それまでの内容を書き写した上で UnicodeDecodeError を送出する。
+    """
+    last_chunk = ""
+    with open(path_str, "r", encoding="utf-8") as f:
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            out_f.write(chunk)
+            last_chunk = chunk
+    return last_chunk.endswith("\n")
+
+
+def _echo_skipped_files(skipped):
+    """埋め込まなかったファイルとその理由を表示する"""
+    if not skipped:
+        return
+    click.echo(f"\n==== スキップしたファイル（{len(skipped)}個） ====")
+    for path_str, reason in skipped:
+        click.echo(click.style(f"  - {path_str}: {reason}", fg="yellow"))
+
+
+# --- 埋め込む内容の削減（重複ファイルの省略・コメント削除・空白の圧縮・先頭N行） ---
+# 削減方法の適用順と表示名（dedup は内容が同じファイルの省略）
+REDUCE_MODES = ("comments", "whitespace", "head")
+REDUCE_MODE_LABELS = {
+    "dedup": "重複ファイルの省略",
+    "comments": "コメントの削除",
+    "whitespace": "空白・空行の圧縮",
+    "head": "先頭N行のみ",
+    "slice": "行範囲の指定",
+    "outline": "アウトライン",
+}
+# 削減して埋め込んだファイルのヘッダーに添える説明
+REDUCED_HEADER_NOTES = {
+    "comments": "コメントを削除した内容",
+    "whitespace": "空白・空行を圧縮した内容",
+    "head": "先頭の行のみ",
+}
+DUPLICATE_NOTE = "（{path} と同じ内容のため省略）"
+HEAD_NOTE = "…（以降の{count}行を省略）\n"
+_REDUCE_OPTION_PATTERN = re.compile(r"^(comments|whitespace|head=(\d+)):(.+)$")
+# 削除したコメントの位置の目印（バイナリファイルは埋め込まないため、本文には現れない）
+_COMMENT_MARK = "\x00"
+_STRING_LITERAL = r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\''
+# JavaScript/TypeScript の正規表現リテラル（割り算と区別するため、直前が演算子・括弧・行頭などの場合だけ）
+_REGEX_LITERAL = r"(?m:(?:^|[(,=:\[!&|?{};]|\breturn)[ \t]*/(?![*/])(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/)"
+# 文字列リテラルは読み飛ばし、comment グループに一致した部分だけを削除する
+_COMMENT_PATTERNS = {
+    "python": re.compile(r'"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'|' + _STRING_LITERAL + r"|(?P<comment>#[^\n]*)"),
+    # シェルの ${#var} や URL の #fragment を残すため、# は行頭か空白の直後だけをコメントとみなす
+    "hash": re.compile(_STRING_LITERAL + r"|(?P<comment>(?<!\S)#[^\n]*)"),
+    "c": re.compile(_STRING_LITERAL + r"|`(?:\\.|[^`\\])*`|(?P<comment>/\*[\s\S]*?\*/|//[^\n]*)"),
+    "js": re.compile(_STRING_LITERAL + r"|`(?:\\.|[^`\\])*`|" + _REGEX_LITERAL + r"|(?P<comment>/\*[\s\S]*?\*/|//[^\n]*)"),
+    "css": re.compile(_STRING_LITERAL + r"|(?P<comment>/\*[\s\S]*?\*/)"),
+    "markup": re.compile(r"(?P<comment><!--[\s\S]*?-->)"),
+    "sql": re.compile(_STRING_LITERAL + r"|(?P<comment>--[^\n]*|/\*[\s\S]*?\*/)"),
+    # Lua の長い文字列 [[...]] と、ブロックコメント --[[...]]（[==[ のように = を挟む形も含む）
+    "lua": re.compile(
+        _STRING_LITERAL + r"|(?P<comment>--\[(?P<comment_level>=*)\[[\s\S]*?\](?P=comment_level)\]|--[^\n]*)"
+        r"|\[(?P<level>=*)\[[\s\S]*?\](?P=level)\]"
+    ),
+}
+# 拡張子ごとのコメントの書式
+COMMENT_STYLES = {
+    ".py": "python", ".pyi": "python",
+    ".sh": "hash", ".bash": "hash", ".zsh": "hash", ".rb": "hash", ".pl": "hash", ".r": "hash",
+    ".yml": "hash", ".yaml": "hash", ".toml": "hash", ".cfg": "hash", ".conf": "hash",
+    ".js": "js", ".mjs": "js", ".cjs": "js", ".jsx": "js", ".ts": "js", ".tsx": "js",
+    ".c": "c", ".h": "c", ".cc": "c", ".cpp": "c", ".hpp": "c", ".java": "c", ".kt": "c",
+    ".go": "c", ".rs": "c", ".cs": "c", ".swift": "c", ".php": "c", ".scss": "c",
+    ".css": "css",
+    ".html": "markup", ".htm": "markup", ".xml": "markup", ".vue": "markup", ".md": "markup",
+    ".sql": "sql", ".lua": "lua",
+}
+_INNER_WHITESPACE = re.compile(r"[ \t]{2,}")
+
+
+def _parse_reduce_option(ctx, param, values):
+    """--reduce の 'comments:パターン' 'whitespace:パターン' 'head=N:パターン' を (方法, N, パターン) のリストに変換する"""
+    rules = []
+    for value in values:
+        m = _REDUCE_OPTION_PATTERN.match(value)
+        if not m:
+            raise click.BadParameter(f"形式が正しくありません: {value}（例: comments:**/*.py, whitespace:*.json, head=50:*.lock）")
+        mode = "head" if m.group(2) else m.group(1)
+        line_count = int(m.group(2)) if m.group(2) else None
+        rules.append((mode, line_count, pathspec.GitIgnoreSpec.from_lines([m.group(3)])))
+    return rules
+
+
+def _new_reduction(rules, dedup):
+    """埋め込む内容を削減するための設定と、削減量の集計を作成する
+
+    saved は方法ごとの [ファイル数, 削減したバイト数, 削減した推定トークン数]、
+    tokens は削減後の推定トークン数（削減したファイルのみ）、
+    views は一部だけを埋め込むファイルの {パス: ("slice", 行範囲) または ("outline", None)}、
+    partial は元の内容のとおりには埋め込まなかったファイルの {パス: 方法}（apply で update を拒否するために記録する）。
+    """
+    return {
+        "rules": rules, "dedup": dedup, "seen": {}, "saved": {}, "tokens": {},
+        "views": {}, "partial": {}, "labels": {}, "outlines": None, "outlines_changed": False,
+    }
+
+
+def _record_saving(reduction, mode, before, after):
+    """削減前後の内容から、削減量を集計に加える"""
+    saved = reduction["saved"].setdefault(mode, [0, 0, 0])
+    saved[0] += 1
+    saved[1] += len(before.encode("utf-8")) - len(after.encode("utf-8"))
+    saved[2] += _estimate_tokens(before) - _estimate_tokens(after)
+
+
+def _strip_comments(content, path_str):
+    """拡張子からコメントの書式を判定し、コメントを削除する。コメントだけの行は行ごと削除する"""
+    pattern = _COMMENT_PATTERNS.get(COMMENT_STYLES.get(os.path.splitext(path_str)[1].lower()))
+    if pattern is None:
+        return content
+    # シェバン行はコメントとして扱わない
+    shebang = ""
+    if content.startswith("#!"):
+        shebang, _, content = content.partition("\n")
+        shebang += "\n"
+    marked = pattern.sub(lambda m: _COMMENT_MARK if m.group("comment") else m.group(0), content)
+    if _COMMENT_MARK not in marked:
+        return shebang + content
+    lines = []
+    for line in marked.split("\n"):
+        if _COMMENT_MARK in line:
+            line = line.replace(_COMMENT_MARK, "").rstrip()
+            if not line:
+                continue
+        lines.append(line)
+    stripped = "\n".join(lines)
+    if content.endswith("\n") and not stripped.endswith("\n"):
+        stripped += "\n"
+    return shebang + stripped
+
+
+def _collapse_blank_lines(content):
+    """行末の空白を削除し、インデント以外の連続する空白と、連続する空行をそれぞれ1つにまとめる"""
+    lines = []
+    previous_blank = False
+    for line in content.split("\n"):
+        indent_length = len(line) - len(line.lstrip(" \t"))
+        body = _INNER_WHITESPACE.sub(" ", line[indent_length:]).rstrip()
+        if not body:
+            if previous_blank:
+                continue
+            previous_blank = True
+            lines.append("")
+        else:
+            previous_blank = False
+            lines.append(line[:indent_length] + body)
+    return "\n".join(lines)
+
+
+def _head_lines(content, line_count):
+    """先頭の line_count 行だけを残し、省略した行数を書き添える"""
+    lines = content.split("\n", line_count)
+    if len(lines) <= line_count or (len(lines) == line_count + 1 and not lines[-1]):
+        return content
+    rest = lines[-1]
+    rest_count = rest.count("\n") + (0 if rest.endswith("\n") else 1)
+    return "\n".join(lines[:line_count]) + "\n" + HEAD_NOTE.format(count=rest_count)
+
+
+def _matching_reduce_modes(path_str, reduction):
+    """パスに一致する削減方法を {方法: head の行数} として返す"""
+    modes = {}
+    for mode, line_count, spec in reduction["rules"]:
+        if spec.match_file(path_str):
+            # head を複数指定した場合は、最も少ない行数を使う
+            if mode == "head" and "head" in modes:
+                line_count = min(line_count, modes["head"])
+            modes[mode] = line_count
+    return modes
+
+
+def _reduced_label(path_str, mode):
+    """削減して埋め込んだファイルのヘッダーに表示するパス"""
+    return f"{path_str}（{REDUCED_HEADER_NOTES[mode]}。変更は patch で行ってください）"
+
+
+def _estimate_reduce_overhead(path_str, entry, reduction):
+    """--reduce に一致するファイルの、(省略の注記の推定トークン数, ヘッダーに表示するパス) を返す（分割の見積もり用）
+
+    削減後の内容は元の内容より長くならないため、内容は元のトークン数で見積もり、注記と説明の分だけを加える。
+    """
+    modes = _matching_reduce_modes(path_str, reduction)
+    if not modes:
+        return 0, None
+    # 省略する行数はファイルのバイト数を超えない
+    note_tokens = _estimate_tokens(HEAD_NOTE.format(count=entry["size"])) if "head" in modes else 0
+    label = max((_reduced_label(path_str, mode) for mode in modes), key=_estimate_tokens)
+    return note_tokens, label
+
+
+def _reduce_content(path_str, content, reduction):
+    """パスに一致する削減方法を決まった順に適用し、削減量を集計する"""
+    modes = _matching_reduce_modes(path_str, reduction)
+    if not modes:
+        return content
+    original = content
+    for mode in REDUCE_MODES:
+        if mode not in modes:
+            continue
+        if mode == "comments":
+            reduced = _strip_comments(content, path_str)
+        elif mode == "whitespace":
+            reduced = _collapse_blank_lines(content)
+        else:
+            reduced = _head_lines(content, modes[mode])
+        if reduced != content:
+            _record_saving(reduction, mode, content, reduced)
+            # 後に適用する方法ほど元の内容との差が大きいため、最後の方法を記録する
+            reduction["partial"][path_str] = mode
+            content = reduced
+    if content is not original:
+        reduction["tokens"][path_str] = _estimate_tokens(content)
+    return content
+
+
+def _duplicate_of(path_str, entry, reduction):
+    """内容が同じファイルを既に埋め込んでいれば、そのパスを返す（参照の方が長くなる小さなファイルは対象外）"""
+    if reduction is None or not reduction["dedup"]:
+        return None
+    first = reduction["seen"].setdefault(entry["hash"], path_str)
+    if first == path_str or entry["size"] <= len(DUPLICATE_NOTE.format(path=first).encode("utf-8")):
+        return None
+    return first
+
+
+def _embedded_tokens(path_str, file_index, reduction):
+    """埋め込んだ内容の推定トークン数（削減した場合は削減後の値）"""
+    return reduction["tokens"].get(path_str, file_index[path_str]["tokens"])
+
+
+def _embedded_section_tokens(path_str, file_index, reduction, section):
+    """埋め込んだ1ファイル分の、ヘッダー（一部だけ・削減した場合の説明を含む）を含めた推定トークン数"""
+    tokens = _embedded_tokens(path_str, file_index, reduction)
+    return _section_tokens(path_str, tokens, section, reduction["labels"].get(path_str))
+
+
+def _find_duplicates(file_paths, file_index, views=None):
+    """インデックスのハッシュ値から、内容が同じファイルを {パス: 最初のパス} として求める（分割の見積もり用）
+
+    書き出し時と同様に、一部だけを埋め込むファイル views は重複の判定の対象にしない。
+    """
+    first_by_hash = {}
+    duplicates = {}
+    for path_str in file_paths:
+        entry = file_index.get(path_str)
+        if entry is None or path_str in (views or {}):
+            continue
+        first = first_by_hash.setdefault(entry["hash"], path_str)
+        if first != path_str and entry["size"] > len(DUPLICATE_NOTE.format(path=first).encode("utf-8")):
+            duplicates[path_str] = first
+    return duplicates
+
+
+def _echo_reduction_summary(reduction):
+    """削減方法ごとの削減量を表示する"""
+    if not reduction["saved"]:
+        return
+    click.echo("\n==== 削減量 ====")
+    for mode in ("dedup", "slice", "outline") + REDUCE_MODES:
+        if mode not in reduction["saved"]:
+            continue
+        file_count, saved_bytes, saved_tokens = reduction["saved"][mode]
+        click.echo(f"  {_ljust_display(REDUCE_MODE_LABELS[mode], 20)}{file_count:>6,} ファイル  {_format_size(saved_bytes):>10}  {saved_tokens:>10,} トークン")
+    total_bytes = sum(saved[1] for saved in reduction["saved"].values())
+    total_tokens = sum(saved[2] for saved in reduction["saved"].values())
+    click.echo(f"  {_ljust_display('合計', 20)}{'':>6}        {_format_size(total_bytes):>10}  {total_tokens:>10,} トークン")
+
+
+# --- ファイルの一部だけの埋め込み（行範囲の指定・アウトライン） ---
+OUTLINE_CACHE_FILE = "outlines.json"
+OUTLINE_CACHE_MAX = 1000
+PARTIAL_VIEW_LABELS = {
+    "slice": "行範囲",
+    "outline": "アウトライン",
+    "comments": "コメントを削除した内容",
+    "whitespace": "空白・空行を圧縮した内容",
+    "head": "先頭の行",
+}
+SLICE_GAP_NOTE = "…（省略）\n"
+_SLICE_ARGUMENT_PATTERN = re.compile(r"^(.+):(\d+)-(\d+)$")
+# Python 以外のアウトラインとして残す、定義や import らしい行
+_GENERIC_OUTLINE_PATTERN = re.compile(
+    r"^[ \t]*(?:(?:export|default|public|private|protected|internal|static|abstract|final|async|pub|extern|inline|virtual|override)[ \t]+)*"
+    r"(?:def|class|function|interface|type|enum|struct|union|trait|impl|fn|func|module|namespace|package|import|from|using|#include|#define)\b.*$",
+    re.MULTILINE,
+)
+_MARKDOWN_HEADING_PATTERN = re.compile(r"^#{1,6}[ \t].*$", re.MULTILINE)
+
+
+def _merge_ranges(ranges):
+    """重なる・隣り合う行範囲をまとめ、開始行の順に並べる"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _parse_slice_arguments(file_patterns):
+    """'パス:開始行-終了行' の引数を取り出し、(ファイルパターンのリスト, {パス: [(開始行, 終了行)]}) を返す
+
+    行範囲が正しくない場合は ValueError を送出する。
+    """
+    patterns = []
+    slices = {}
+    for pattern in file_patterns:
+        m = _SLICE_ARGUMENT_PATTERN.match(pattern)
+        if not m:
+            patterns.append(pattern)
+            continue
+        start, end = int(m.group(2)), int(m.group(3))
+        if start < 1 or end < start:
+            raise ValueError(f"行範囲が正しくありません: {pattern}（例: src/app.py:10-50）")
+        patterns.append(m.group(1))
+        slices.setdefault(posixpath.normpath(Path(m.group(1)).as_posix()), []).append((start, end))
+    return patterns, {path_str: _merge_ranges(ranges) for path_str, ranges in slices.items()}
+
+
+def _slice_lines(content, ranges):
+    """指定した行範囲だけを取り出し、範囲の前後の省略を書き添える。戻り値は (内容, ファイル全体の行数)"""
+    lines = content.split("\n")
+    if lines and lines[-1] == "":
+        lines.pop()
+    total = len(lines)
+    parts = []
+    previous_end = 0
+    for start, end in ranges:
+        if start > total:
+            break
+        end = min(end, total)
+        if start > previous_end + 1:
+            parts.append(SLICE_GAP_NOTE)
+        parts.append("\n".join(lines[start - 1:end]) + "\n")
+        previous_end = end
+    if previous_end < total:
+        parts.append(SLICE_GAP_NOTE)
+    return "".join(parts), total
+
+
+def _is_docstring(node):
+    """ast のノードが docstring（文字列だけの式文）か"""
+    return isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+
+
+def _python_outline(source):
+    """Python のソースから、import 文・クラスと関数の定義行・docstring・代入文の1行目だけを取り出す"""
+    tree = ast.parse(source)
+    lines = source.split("\n")
+    outline = []
+
+    def emit(start, end):
+        outline.extend(lines[start - 1:end])
+
+    def visit(body, top_level):
+        emitted = False
+        for position, node in enumerate(body):
+            if top_level and position == 0 and _is_docstring(node):
+                emit(node.lineno, node.end_lineno)
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                emit(node.lineno, node.end_lineno)
+            elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+                first_line = lines[node.lineno - 1]
+                outline.append(first_line if node.end_lineno == node.lineno else first_line + " ...")
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                # 最上位の定義の間は1行空ける
+                if top_level and outline and outline[-1].strip():
+                    outline.append("")
+                start = min([decorator.lineno for decorator in node.decorator_list] + [node.lineno])
+                first = node.body[0]
+                if first.lineno == node.lineno:
+                    # def f(): return 1 のような1行の定義
+                    emit(start, node.lineno)
+                    emitted = True
+                    continue
+                # col_offset は UTF-8 のバイト数のため、バイト列で切り出す
+                header = lines[first.lineno - 1].encode("utf-8")[:first.col_offset].decode("utf-8").rstrip()
+                if header.strip():
+                    # 複数行のシグネチャの閉じ括弧と同じ行から本体が始まる場合は、':' までを残して本体を省略する
+                    emit(start, first.lineno - 1)
+                    outline.append(header + " ...")
+                    emitted = True
+                    continue
+                emit(start, first.lineno - 1)
+                rest = node.body
+                if _is_docstring(first):
+                    emit(first.lineno, first.end_lineno)
+                    rest = node.body[1:]
+                has_members = isinstance(node, ast.ClassDef) and visit(rest, False)
+                if rest and not has_members:
+                    outline.append(" " * first.col_offset + "...")
+            else:
+                continue
+            emitted = True
+        return emitted
+
+    visit(tree.body, True)
+    return "\n".join(outline) + "\n" if outline else ""
+
+
+def _make_outline(path_str, content):
+    """ファイルのアウトラインを作成する。Python は ast で解析し、その他は定義や import らしい行を取り出す"""
+    ext = os.path.splitext(path_str)[1].lower()
+    if ext in PYTHON_EXTENSIONS:
+        try:
+            return _python_outline(content)
+        except (SyntaxError, ValueError):
+            pass
+    pattern = _MARKDOWN_HEADING_PATTERN if ext in (".md", ".markdown") else _GENERIC_OUTLINE_PATTERN
+    return "".join(m.group(0) + "\n" for m in pattern.finditer(content))
+
+
+def _cached_outline(path_str, content, entry, reduction):
+    """ファイルのハッシュ値ごとにキャッシュしたアウトラインを返す（なければ作成してキャッシュする）"""
+    if reduction["outlines"] is None:
+        reduction["outlines"] = _read_json_dict(Path(OUTPUT_DIR) / OUTLINE_CACHE_FILE)
+    outlines = reduction["outlines"]
+    # 同じ内容でも、拡張子によってアウトラインの作り方が変わる
+    key = entry["hash"] + os.path.splitext(path_str)[1].lower()
+    outline = outlines.pop(key, None)
+    if outline is None:
+        if content is None:
+            content = Path(path_str).read_text(encoding="utf-8")
+        outline = _make_outline(path_str, content)
+        reduction["outlines_changed"] = True
+    # 最近使ったものを末尾に移し、保存時には古いものから破棄する
+    outlines[key] = outline
+    return outline
+
+
+def _save_outline_cache(reduction):
+    """アウトラインのキャッシュに追加があれば、古いものを破棄して保存する"""
+    if not reduction["outlines_changed"]:
+        return
+    outlines = reduction["outlines"]
+    for key in list(outlines)[:-OUTLINE_CACHE_MAX]:
+        del outlines[key]
+    _write_json_atomic(Path(OUTPUT_DIR) / OUTLINE_CACHE_FILE, outlines)
+
+
+def _view_label(path_str, view, total=None):
+    """行範囲またはアウトラインのファイルのヘッダーに表示するパス（行範囲の場合は total にファイル全体の行数を指定する）"""
+    mode, ranges = view
+    if mode == "outline":
+        return f"{path_str}（アウトラインのみ。変更は patch で行ってください）"
+    ranges_text = ",".join(f"{start}-{end}" for start, end in ranges)
+    return f"{path_str}:{ranges_text}（全{total}行のうち一部。変更は patch で行ってください）"
+
+
+def _estimate_view_tokens(path_str, entry, view, reduction):
+    """行範囲またはアウトラインとして埋め込む部分の (推定トークン数, ヘッダーに表示するパス) を返す（分割の見積もり用）"""
+    mode, ranges = view
+    if mode == "outline":
+        return _estimate_tokens(_cached_outline(path_str, None, entry, reduction)), _view_label(path_str, view)
+    reduced, total = _slice_lines(Path(path_str).read_text(encoding="utf-8"), ranges)
+    return _estimate_tokens(reduced), _view_label(path_str, view, total)
+
+
+def _render_view(path_str, content, entry, view, reduction):
+    """行範囲またはアウトラインだけを取り出し、(内容, ヘッダーに表示するパス) を返す"""
+    mode, ranges = view
+    if mode == "outline":
+        reduced = _cached_outline(path_str, content, entry, reduction)
+        label = _view_label(path_str, view)
+    else:
+        if content is None:
+            content = Path(path_str).read_text(encoding="utf-8")
+        reduced, total = _slice_lines(content, ranges)
+        label = _view_label(path_str, view, total)
+    if content is not None:
+        _record_saving(reduction, mode, content, reduced)
+    reduction["partial"][path_str] = mode
+    reduction["tokens"][path_str] = _estimate_tokens(reduced)
+    return reduced, label
+
+
+# --- ファイル読み込みとプロンプトの書き出し ---
+# 読み込みスレッド数と、同時に保持する読み込み結果の上限
+READ_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+READ_WINDOW = READ_WORKERS * 4
+
+
+def _read_text_file(path_str, known=None):
+    """ファイルをUTF-8のテキストとして読み込み、(内容, インデックスの記録) を返す
+
+    サイズと更新日時がインデックスの記録 known と一致する場合は、ハッシュ値などの再計算を省略する。
+    大きなファイルは内容を読み込まずに、内容として None を返す（書き出し時に分割して読む）。
+    記録が変わっていなければファイルを開くだけで済ませ、変わっている場合だけ mmap で記録の作成と検証を行う。
+    """
+    with open(path_str, "rb") as f:
+        st = os.fstat(f.fileno())
+        if st.st_size >= LARGE_FILE_THRESHOLD:
+            if _is_fresh_entry(known, st):
+                return None, known
+            return None, _index_large_file(f, st, validate=True)
+        data = f.read()
+    entry = known if _is_fresh_entry(known, st) else _make_index_entry(st, data)
+    content = data.decode("utf-8")
+    # read_text と同様に改行コードを '\n' に揃える
+    if "\r" in content:
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
+    return content, entry
+
+
+def _iter_file_contents(file_paths, file_index):
+    """ファイルをスレッドプールで並列に読み込み、入力順に (パス, (内容, インデックスの記録), 例外) を返すジェネレータ
+
+    先読みは READ_WINDOW 件までに制限するため、ファイル数が多くてもメモリ使用量は一定に保たれる。
+    """
+    paths = iter(file_paths)
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        pending = deque(
+            (path_str, executor.submit(_read_text_file, path_str, file_index.get(path_str)))
+            for path_str in itertools.islice(paths, READ_WINDOW)
+        )
+        while pending:
+            path_str, future = pending.popleft()
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append((next_path, executor.submit(_read_text_file, next_path, file_index.get(next_path))))
+            try:
+                yield path_str, future.result(), None
+            except Exception as e:
+                yield path_str, None, e
+
+
+def _write_file_sections(out_f, file_paths, file_index, report=True, stats=None, section=None, file_contents=None, reduction=None):
+    """各ファイルをヘッダー付きで、読み込んだ順に出力ストリームへ直接書き出す
+
+    section でヘッダーの書式とコードフェンスの有無を指定する（省略時は「---- パス ----」のみ）。
+    file_contents（{パス: (内容, インデックスの記録)}）を指定した場合は、ファイルを読み込まずにその内容を使う。
+    reduction を指定した場合は、内容が同じファイルを参照に置き換え、一致する削減方法を適用する。
+    読み込んだファイルのサイズ・更新日時・ハッシュ値などは file_index に記録する。
+    stats を指定した場合は、読み込んだバイト数と書き出しにかかった時間を加算する。
+    戻り値は書き出したファイルのパスのリスト。
+    """
+    # 埋め込むファイルがない場合は「なし」とする
+    if not file_paths:
+        out_f.write("なし")
+        return []
+
+    section = section or DEFAULT_FILE_SECTION
+    if file_contents is not None:
+        results = ((path_str, file_contents[path_str], None) for path_str in file_paths)
+    else:
+        results = _iter_file_contents(file_paths, file_index)
+    written = []
+    for relative_path, result, error in results:
+        if error is not None:
+            if report:
+                click.echo(click.style(f"  - 読み込み失敗: {relative_path} ({error})", fg="yellow"))
+            continue
+        content, entry = result
+        file_index[relative_path] = entry
+        write_start = time.perf_counter()
+        # 行範囲の指定やアウトラインのファイルは、重複の判定をせず一部だけを埋め込む
+        view = reduction["views"].get(relative_path) if reduction is not None else None
+        duplicate_of = None if view is not None else _duplicate_of(relative_path, entry, reduction)
+        label = None
+        if view is not None:
+            content, label = _render_view(relative_path, content, entry, view, reduction)
+        elif duplicate_of is None and reduction is not None and content is not None:
+            content = _reduce_content(relative_path, content, reduction)
+            mode = reduction["partial"].get(relative_path)
+            if mode is not None:
+                # 元の内容と異なるため、update を拒否することがヘッダーからも分かるようにする
+                label = _reduced_label(relative_path, mode)
+        if label is not None:
+            reduction["labels"][relative_path] = label
+        # ファイル間の区切りとして改行を2つ入れる
+        if written:
+            out_f.write("\n\n")
+        out_f.write(_format_section_header(section, relative_path, label) + "\n")
+        if duplicate_of is not None:
+            note = DUPLICATE_NOTE.format(path=duplicate_of)
+            out_f.write(note)
+            reduction["tokens"][relative_path] = _estimate_tokens(note)
+            saved = reduction["saved"].setdefault("dedup", [0, 0, 0])
+            saved[0] += 1
+            saved[1] += entry["size"] - len(note.encode("utf-8"))
+            saved[2] += entry["tokens"] - reduction["tokens"][relative_path]
+        else:
+            if section["fenced"]:
+                fence = _code_fence(content)
+                out_f.write(f"{fence}{_fence_language(relative_path)}\n")
+            if content is None:
+                try:
+                    ends_with_newline = _copy_text_file(out_f, relative_path)
+                except UnicodeDecodeError as e:
+                    # 記録が変わっていない大きなファイルは事前に検証しないため、書き写しながら検出する
+                    out_f.write(DECODE_ERROR_NOTE)
+                    ends_with_newline = True
+                    if report:
+                        click.echo(click.style(f"  - 読み込み失敗（途中まで埋め込みました）: {relative_path} ({e})", fg="yellow"))
+            else:
+                out_f.write(content)
+                ends_with_newline = content.endswith("\n")
+            if section["fenced"]:
+                out_f.write(fence if ends_with_newline else f"\n{fence}")
+        written.append(relative_path)
+        if stats is not None:
+            _stats_count(stats, "bytes_read", entry["size"])
+            _stats_count(stats, "write_seconds", time.perf_counter() - write_start)
+        if report:
+            click.echo(f"  - 読み込み成功: {relative_path}")
+    return written
+
+
+# --- テンプレートのコンパイルと描画 ---
+# テンプレート中で置き換える記法。{include:...} と {section_header:...} の引数には {path} と {lang} を含められる
+_TEMPLATE_PLACEHOLDER = re.compile(
+    r"\{(json_diff_rule|existing_files|include|section_header)(?::((?:[^{}\n]|\{(?:path|lang)\})*))?\}"
+)
+# 各ファイルのセクションの既定の書式
+DEFAULT_FILE_SECTION = {"header": "---- {path} ----", "fenced": False}
+EXISTING_FILES_FORMATS = ("", "fenced")
+# コードフェンスに付ける言語名（拡張子ごと）
+FENCE_LANGUAGES = {
+    ".py": "python", ".pyi": "python", ".js": "javascript", ".mjs": "javascript", ".cjs": "javascript",
+    ".jsx": "jsx", ".ts": "typescript", ".tsx": "tsx", ".json": "json", ".md": "markdown",
+    ".sh": "bash", ".bash": "bash", ".yml": "yaml", ".yaml": "yaml", ".toml": "toml", ".ini": "ini",
+    ".html": "html", ".css": "css", ".scss": "scss", ".sql": "sql", ".go": "go", ".rs": "rust",
+    ".java": "java", ".kt": "kotlin", ".c": "c", ".h": "c", ".cpp": "cpp", ".hpp": "cpp",
+    ".cs": "csharp", ".rb": "ruby", ".php": "php", ".swift": "swift", ".xml": "xml", ".txt": "text",
+}
+_BACKTICK_RUN = re.compile(r"`{3,}")
+# コンパイル済みテンプレートのキャッシュ: {テンプレートの絶対パス: ([(依存ファイル, (更新日時, サイズ)), ...], セグメント)}
+_TEMPLATE_CACHE = {}
+
+
+def _fence_language(path_str):
+    """ファイルの拡張子から、コードフェンスに付ける言語名を返す"""
+    return FENCE_LANGUAGES.get(os.path.splitext(path_str)[1].lower(), "")
+
+
+def _code_fence(content):
+    """内容に含まれるバッククォートの連続より長いコードフェンスを返す
+
+    分割して読む大きなファイル（content が None）は、内容を確認せずに4つのバッククォートを使う。
+    """
+    if content is None:
+        return "````"
+    longest = max((len(run) for run in _BACKTICK_RUN.findall(content)), default=2)
+    return "`" * (longest + 1)
+
+
+def _format_section_header(section, path_str, label=None):
+    """ファイルのセクションのヘッダー行を組み立てる。label を指定した場合は、パスの代わりに表示する"""
+    return section["header"].replace("{path}", label or path_str).replace("{lang}", _fence_language(path_str))
+
+
+def _append_template_text(segments, text):
+    """テキストのセグメントを追加する。直前もテキストの場合は連結する"""
+    if not text:
+        return
+    if segments and segments[-1][0] == "text":
+        segments[-1] = ("text", segments[-1][1] + text)
+    else:
+        segments.append(("text", text))
+
+
+def _resolve_include(name, base_dir):
+    """{include:名前} の参照先のパスを返す。拡張子を省略した場合は .txt を補う"""
+    include_path = Path(base_dir) / name
+    if not include_path.suffix:
+        include_path = include_path.with_suffix(".txt")
+    return include_path
+
+
+def _compile_template(text, base_dir, deps, including=()):
+    """テンプレートを、テキストと既存ファイルの埋め込み位置からなるセグメントのリストにコンパイルする
+
+    セグメントは ("text", 文字列) または ("files", セクションの書式)。
+    {json_diff_rule} と {include:...} はコンパイル時に展開し、読み込んだインクルード先を deps に追加する。
+    インクルード先が見つからない場合や循環している場合、書式が不明な場合は ValueError を送出する。
+    """
+    segments = []
+    section = dict(DEFAULT_FILE_SECTION)
+    pos = 0
+    for m in _TEMPLATE_PLACEHOLDER.finditer(text):
+        _append_template_text(segments, text[pos:m.start()])
+        pos = m.end()
+        name, arg = m.group(1), m.group(2)
+        if name == "json_diff_rule":
+            _append_template_text(segments, JSON_DIFF_RULE)
+        elif name == "section_header":
+            section["header"] = arg or DEFAULT_FILE_SECTION["header"]
+            # 1行だけの指定は、行ごと出力しない
+            if text.startswith("\n", pos) and (m.start() == 0 or text[m.start() - 1] == "\n"):
+                pos += 1
+        elif name == "existing_files":
+            if (arg or "") not in EXISTING_FILES_FORMATS:
+                raise ValueError(f"{m.group(0)} の書式 '{arg}' は不明です（指定できるのは fenced のみです）。")
+            segments.append(("files", {"header": section["header"], "fenced": arg == "fenced"}))
+        else:
+            if not arg:
+                raise ValueError("{include:...} にインクルードするテンプレート名が指定されていません。")
+            include_path = _resolve_include(arg, base_dir)
+            resolved = include_path.resolve()
+            if resolved in including:
+                raise ValueError(f"テンプレートのインクルードが循環しています: {include_path}")
+            try:
+                include_text = include_path.read_text(encoding="utf-8")
+            except OSError:
+                raise ValueError(f"インクルードするテンプレート '{include_path}' が見つかりません。")
+            deps.append(include_path)
+            for segment in _compile_template(include_text, include_path.parent, deps, including + (resolved,)):
+                if segment[0] == "text":
+                    _append_template_text(segments, segment[1])
+                else:
+                    segments.append(segment)
+    _append_template_text(segments, text[pos:])
+    return segments
+
+
+def _file_signature(path):
+    """キャッシュの無効化判定に使う (更新日時, サイズ)。ファイルがない場合は None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _load_template(template_file):
+    """テンプレートファイルをコンパイルして返す
+
+    テンプレート本体とインクルード先のいずれかの更新日時・サイズが変わるまでは、コンパイル結果を再利用する。
+    """
+    key = os.path.abspath(template_file)
+    cached = _TEMPLATE_CACHE.get(key)
+    if cached is not None and all(_file_signature(path) == signature for path, signature in cached[0]):
+        return cached[1]
+    template_file = Path(template_file)
+    deps = [template_file]
+    segments = _compile_template(
+        template_file.read_text(encoding="utf-8"), template_file.parent, deps, (template_file.resolve(),)
+    )
+    _TEMPLATE_CACHE[key] = ([(path, _file_signature(path)) for path in deps], segments)
+    return segments
+
+
+def _template_file_section(segments):
+    """テンプレートで最初に既存ファイルを埋め込む位置の書式を返す（埋め込み位置がない場合は既定の書式）"""
+    return next((segment[1] for segment in segments if segment[0] == "files"), DEFAULT_FILE_SECTION)
+
+
+def _template_tokens(segments):
+    """テンプレートのテキスト部分の推定トークン数"""
+    return _estimate_tokens("".join(segment[1] for segment in segments if segment[0] == "text"))
+
+
+def _render_template(out_f, segments, file_paths, file_index, stats=None, report=True, file_contents=None, reduction=None):
+    """コンパイル済みのテンプレートを、既存ファイルの内容とともに出力ストリームへ直接書き出す
+
+    読み込み結果の表示は、最初の埋め込み位置でのみ行う。戻り値は書き出したファイルのパスのリスト。
+    """
+    written = []
+    for kind, value in segments:
+        if kind == "text":
+            out_f.write(value)
+        else:
+            written = _write_file_sections(
+                out_f, file_paths, file_index, report=report, stats=stats, section=value,
+                file_contents=file_contents, reduction=reduction,
+            )
+            report = False
+    return written
+
+
+# --- バッチ実行（1回の走査で複数のプロンプトを出力） ---
+BATCH_JOB_KEYS = ("patterns", "exclude", "template")
+_BATCH_JOB_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+def _string_list(value, key):
+    """TOML の値を文字列のリストとして取り出す（文字列1つも受け付ける）。不正な場合は ValueError を送出する"""
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list) and all(isinstance(item, str) for item in value):
+        return list(value)
+    raise ValueError(f"'{key}' には文字列または文字列の配列を指定してください。")
+
+
+def _load_batch_jobs(batch_file, default_template, exclude):
+    """ジョブ定義ファイル（TOML）を読み込み、(全ジョブ共通の除外パターン, ジョブのリスト) を返す
+
+    各ジョブは {"name", "patterns", "exclude", "template"}。定義が不正な場合は ValueError を送出する。
+    """
+    if tomllib is None:
+        raise ValueError("--batch には Python 3.11 以降、または tomli パッケージが必要です（pip install tomli）。")
+    with open(batch_file, "rb") as f:
+        try:
+            data = tomllib.load(f)
+        except tomllib.TOMLDecodeError as e:
+            raise ValueError(f"'{batch_file}' を解析できません: {e}") from e
+    common_exclude = list(exclude) + _string_list(data.get("exclude", []), "exclude")
+    jobs_table = data.get("jobs")
+    if not isinstance(jobs_table, dict) or not jobs_table:
+        raise ValueError(f"'{batch_file}' に [jobs.<ジョブ名>] の定義がありません。")
+    jobs = []
+    for name, job in jobs_table.items():
+        if not _BATCH_JOB_NAME_PATTERN.match(name):
+            raise ValueError(f"ジョブ名 '{name}' には英数字と _ . - のみ使用できます。")
+        if not isinstance(job, dict):
+            raise ValueError(f"ジョブ '{name}' はテーブル（[jobs.{name}]）で定義してください。")
+        unknown = sorted(set(job).difference(BATCH_JOB_KEYS))
+        if unknown:
+            raise ValueError(f"ジョブ '{name}' に未知のキーがあります: {', '.join(unknown)}")
+        template = job.get("template", default_template)
+        if not isinstance(template, str):
+            raise ValueError(f"ジョブ '{name}': 'template' には文字列を指定してください。")
+        try:
+            patterns = _string_list(job.get("patterns", []), "patterns")
+            job_exclude = _string_list(job.get("exclude", []), "exclude")
+        except ValueError as e:
+            raise ValueError(f"ジョブ '{name}': {e}") from e
+        jobs.append({"name": name, "patterns": patterns, "exclude": job_exclude, "template": template})
+    return common_exclude, jobs
+
+
+def _render_batch_job(job, timestamp, file_index, reduce_rules, dedup):
+    """1つのジョブのプロンプトと入力用の空ファイルを書き出し、結果を返す（スレッドプールで並列に呼ばれる）"""
+    started = time.perf_counter()
+    reduction = _new_reduction(reduce_rules, dedup)
+    output_path = Path(OUTPUT_DIR) / f"out-{timestamp}-{job['name']}.txt"
+    with output_path.open("w", encoding="utf-8") as out_f:
+        written = _render_template(out_f, job["segments"], job["files"], file_index, report=False, reduction=reduction)
+    input_path = Path(INPUT_DIR) / f"in-{timestamp}-{job['name']}.txt"
+    input_path.write_text("", encoding="utf-8")
+    file_section = _template_file_section(job["segments"])
+    tokens = _template_tokens(job["segments"]) + sum(
+        _embedded_section_tokens(path_str, file_index, reduction, file_section) for path_str in written
+    )
+    return {
+        "written": written,
+        "output_path": output_path,
+        "input_path": input_path,
+        "tokens": tokens,
+        "bytes_read": sum(file_index[path_str]["size"] for path_str in written),
+        "bytes_written": output_path.stat().st_size,
+        "seconds": time.perf_counter() - started,
+        "reduction": reduction,
+    }
+
+
+def _echo_batch_summary(jobs, shared_seconds, wall_seconds):
+    """ジョブごとのファイル数・推定トークン数・処理時間と、共通の処理時間の集計表を表示する"""
+    click.echo("\n==== バッチの実行結果 ====")
+    for job in jobs:
+        result = job.get("result")
+        if result is None:
+            click.echo(f"  {_ljust_display(job['name'], 24)}（{job['error']}）")
+            continue
+        click.echo(
+            f"  {_ljust_display(job['name'], 24)}{len(result['written']):>6,} ファイル{result['tokens']:>12,} トークン"
+            f"{result['seconds']:>10.3f} 秒  -> {result['output_path']}"
+        )
+    click.echo(f"  {_ljust_display('共通の処理（走査・検査など）', 58)}{shared_seconds:>10.3f} 秒")
+    click.echo(f"  {_ljust_display('合計', 58)}{wall_seconds:>10.3f} 秒")
+
+
+def _run_batch(batch_file, default_template, exclude, max_file_size, reduce_rules, dedup):
+    """ジョブ定義ファイルの各ジョブのプロンプトを、1回のディレクトリ走査を共有して並列に出力する"""
+    stats = _current_stats()
+    started = time.perf_counter()
+    try:
+        common_exclude, jobs = _load_batch_jobs(batch_file, default_template, exclude)
+    except (OSError, ValueError) as e:
+        click.echo(click.style(f"エラー: {e}", fg="red"))
+        return
+    click.echo(f"ℹ️ '{batch_file}' の {len(jobs)} 個のジョブを実行します。")
+
+    # 全ジョブのパターンをまとめて、.gitignore と共通の除外パターンで一回だけ走査する
+    all_patterns = [pattern for job in jobs for pattern in job["patterns"]]
+    matched, ignored_count, excluded_count = _collect_files(all_patterns, common_exclude, by_pattern=True)
+    _stats_lap(stats, "collect")
+    _stats_count(stats, "files_matched", len(matched))
+    _stats_count(stats, "files_ignored", ignored_count)
+    _stats_count(stats, "files_excluded", excluded_count)
+    if ignored_count:
+        click.echo(f"ℹ️ .gitignore に基づき {ignored_count} 個のファイル/ディレクトリを除外します。")
+
+    # 走査結果を、ジョブごとのパターンと除外パターンで振り分ける
+    offset = 0
+    for job in jobs:
+        numbers = set(range(offset, offset + len(job["patterns"])))
+        offset += len(job["patterns"])
+        job_spec = pathspec.GitIgnoreSpec.from_lines(job["exclude"]) if job["exclude"] else None
+        job["files"] = sorted(
+            path_str for path_str, matched_numbers in matched.items()
+            if not numbers.isdisjoint(matched_numbers) and not (job_spec and job_spec.match_file(path_str))
+        )
+
+    # 読み込む前の検査は、ジョブ間で重複するファイルも一度だけ行う
+    accepted, skipped_files = _inspect_files(sorted(set().union(*(job["files"] for job in jobs))), max_file_size)
+    accepted = set(accepted)
+    _stats_lap(stats, "inspect")
+    for _, reason in skipped_files:
+        _stats_skip(stats, reason.split(" (")[0])
+    for job in jobs:
+        if job["patterns"] and not job["files"]:
+            job["error"] = "パターンに一致するファイルがありません"
+            continue
+        job["files"] = [path_str for path_str in job["files"] if path_str in accepted]
+        if job["patterns"] and not job["files"]:
+            job["error"] = "埋め込めるファイルがありません"
+            continue
+        template_file = Path(TEMPLATE_DIR) / f"{job['template']}.txt"
+        if not template_file.exists():
+            job["error"] = f"テンプレート '{template_file}' が見つかりません"
+            continue
+        try:
+            job["segments"] = _load_template(template_file)
+        except ValueError as e:
+            job["error"] = str(e)
+    _stats_lap(stats, "template")
+
+    index = _load_file_index()
+    _stats_lap(stats, "index_load")
+    runnable = [job for job in jobs if "error" not in job]
+    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    Path(OUTPUT_DIR).mkdir(exist_ok=True)
+    Path(INPUT_DIR).mkdir(exist_ok=True)
+
+    # ジョブごとのプロンプトはスレッドプールで並列に書き出す（ファイルの読み込みは各ジョブ内でも並列）
+    embed_start = time.perf_counter()
+    if runnable:
+        with ThreadPoolExecutor(max_workers=min(len(runnable), os.cpu_count() or 1)) as executor:
+            futures = [
+                executor.submit(_render_batch_job, job, timestamp, index["files"], reduce_rules, dedup)
+                for job in runnable
+            ]
+            for job, future in zip(runnable, futures):
+                try:
+                    job["result"] = future.result()
+                except OSError as e:
+                    job["error"] = f"書き出しに失敗しました: {e}"
+    embed_seconds = time.perf_counter() - embed_start
+    _stats_lap(stats, "embed")
+
+    completed = [job for job in jobs if "result" in job]
+    for job in completed:
+        result = job["result"]
+        _stats_count(stats, "files_embedded", len(result["written"]))
+        _stats_count(stats, "bytes_read", result["bytes_read"])
+        _stats_count(stats, "bytes_written", result["bytes_written"])
+        _stats_count(stats, "tokens", result["tokens"])
+        for saved in result["reduction"]["saved"].values():
+            _stats_count(stats, "bytes_saved", saved[1])
+            _stats_count(stats, "tokens_saved", saved[2])
+
+    # 今回の時点の全ジョブのファイル内容をまとめて記録する（--changed-since で比較できるようにする）
+    index["runs"][timestamp] = {
+        path_str: index["files"][path_str]["hash"]
+        for job in completed for path_str in job["result"]["written"]
+    }
+    _save_file_index(index)
+    _stats_lap(stats, "index_save")
+
+    for job in completed:
+        result = job["result"]
+        _record_pair(
+            job["template"], result["written"], [result["output_path"]], result["input_path"],
+            partial_files=result["reduction"]["partial"],
+        )
+        click.echo(click.style(f"✅ [{job['name']}] プロンプトを '{result['output_path']}' に出力しました。", fg="green"))
+        click.echo(f"   LLMの出力は '{result['input_path']}' に貼り付けてください。")
+    for job in jobs:
+        if "error" in job:
+            click.echo(click.style(f"❌ [{job['name']}] {job['error']}", fg="red"))
+    _stats_lap(stats, "manifest")
+
+    wall_seconds = time.perf_counter() - started
+    _echo_batch_summary(jobs, wall_seconds - embed_seconds, wall_seconds)
+    _echo_skipped_files(skipped_files)
+
+
 @promp.command()
+@_with_stats
 @click.argument("file_patterns", nargs=-1, required=False)
 @click.option("-t", "--template", default="default", help="プロンプト作成時のテンプレート名を指定します。")
 @click.option("-e", "--exclude", multiple=True, help="除外するファイルパターンを指定します。ワイルドカード使用可。")
-def out(file_patterns, template, exclude):
-    """指定されたファイルを埋め込んだプロンプトを出力する"""
+@click.option("--changed-since", metavar="last|YYYYMMDD-HHMMSS", help="指定したプロンプト（lastは直前のもの）以降に変更されたファイルのみを埋め込みます。")
+@click.option("--max-tokens", type=click.IntRange(min=1), help="1つのプロンプトの推定トークン数の上限。超える場合は複数のパートに分割して出力します。")
+@click.option("--max-file-size", default=DEFAULT_MAX_FILE_SIZE, show_default=True, callback=_parse_size_option, help="埋め込むファイルサイズの上限（例: 500KB, 2MB）。0 で無制限。")
+@click.option("--reduce", "reduce_rules", multiple=True, metavar="方法:パターン", callback=_parse_reduce_option, help="パターンに一致するファイルの内容を削減します。方法は comments / whitespace / head=N（例: comments:**/*.py, head=50:*.lock）。")
+@click.option("--no-dedup", is_flag=True, help="内容が同じファイルも、省略せずにそれぞれ埋め込みます。")
+@click.option("--related", is_flag=True, help="指定したファイルがインポートする・されるファイル（Python/JS/TS）を追加します。")
+@click.option("--depth", type=click.IntRange(min=1), default=1, show_default=True, help="--related で辿るインポートの段数。")
+@click.option("--related-limit", type=click.IntRange(min=1), default=DEFAULT_RELATED_LIMIT, show_default=True, help="--related で追加するファイル数の上限。")
+@click.option("--related-max-size", callback=_parse_size_option, help="--related で追加するファイルの合計サイズの上限（例: 500KB）。")
+@click.option("--outline", multiple=True, metavar="パターン", help="パターンに一致するファイルは、定義の行と docstring などのアウトラインだけを埋め込みます。")
+@click.option("--batch", type=click.Path(exists=True, dir_okay=False), help="ジョブ定義ファイル（TOML）の各ジョブのプロンプトを、1回の走査でまとめて出力します。")
+def out(file_patterns, template, exclude, changed_since, max_tokens, max_file_size, reduce_rules, no_dedup, related, depth, related_limit, related_max_size, outline, batch):
+    """指定されたファイルを埋め込んだプロンプトを出力する
+
+    既存ファイルパスに 'パス:開始行-終了行' を指定すると、そのファイルは指定した行範囲だけを埋め込む。
+    """
+    # --batch の場合は、ジョブ定義ファイルのパターン・除外パターン・テンプレートでジョブごとに出力する
+    if batch:
+        conflicts = [
+            name for name, value in (
+                ("既存ファイルパス", file_patterns), ("--changed-since", changed_since), ("--max-tokens", max_tokens),
+                ("--related", related), ("--outline", outline),
+            ) if value
+        ]
+        if conflicts:
+            click.echo(click.style(f"エラー: --batch と同時に指定できません: {', '.join(conflicts)}", fg="red"))
+            return
+        _run_batch(batch, template, exclude, max_file_size, reduce_rules, dedup=not no_dedup)
+        return
+
+    stats = _current_stats()
+    reduction = _new_reduction(reduce_rules, dedup=not no_dedup)
+    try:
+        file_patterns, slices = _parse_slice_arguments(file_patterns)
+    except ValueError as e:
+        click.echo(click.style(f"エラー: {e}", fg="red"))
+        return
     # 引数「既存ファイルパス」が指定されていない場合は、警告をだす
     if not file_patterns:
         click.echo(click.style("注意: 既存ファイルパスが指定されていないため、プロンプトに既存ファイルの内容は反映されません。", fg="yellow"))
@@ -207,83 +2192,188 @@ def out(file_patterns, template, exclude):
         return
 
     # 1. ワイルドカードを展開して、対象ファイルリストを収集
-    all_files = []
-    for pattern in file_patterns:
-        # globでワイルドカードに一致するファイルを探す
-        matched_files = glob.glob(pattern, recursive=True)
-        all_files.extend(matched_files)
-
-    # 重複を除外してソート
-    unique_files = sorted(list(set(all_files)))
-
-    # 2. .gitignoreと--excludeオプションでファイルを除外
-    # .gitignoreの内容でフィルタリング
-    gitignore_path = Path(GITIGNORE_FILE)
-    if gitignore_path.exists():
-        with open(gitignore_path, "r", encoding="utf-8") as f:
-            # GitWildMatchPatternの代わりに 'gitwildmatch' を文字列として渡す
-            gitignore_spec = pathspec.PathSpec.from_lines('gitwildmatch', f)
-            ignored_files = set(gitignore_spec.match_files(unique_files))
-            if ignored_files:
-                click.echo(f"ℹ️ .gitignore に基づき {len(ignored_files)} 個のファイルを除外します。")
-                unique_files = [f for f in unique_files if f not in ignored_files]
-
-    # --exclude オプションで指定されたパターンでフィルタリング
-    if exclude:
-        # GitWildMatchPatternの代わりに 'gitwildmatch' を文字列として渡す
-        exclude_spec = pathspec.PathSpec.from_lines('gitwildmatch', exclude)
-        excluded_files_by_opt = set(exclude_spec.match_files(unique_files))
-        if excluded_files_by_opt:
-            click.echo(f"ℹ️ --exclude オプションに基づき {len(excluded_files_by_opt)} 個のファイルを除外します。")
-            unique_files = [f for f in unique_files if f not in excluded_files_by_opt]
+    # .gitignore と --exclude で除外されるディレクトリには降りずに、全パターンを一回の走査で照合する
+    unique_files, ignored_count, excluded_count = _collect_files(file_patterns, exclude)
+    _stats_lap(stats, "collect")
+    _stats_count(stats, "files_matched", len(unique_files))
+    _stats_count(stats, "files_ignored", ignored_count)
+    _stats_count(stats, "files_excluded", excluded_count)
+
+    # 2. 除外結果を表示
+    if ignored_count:
+        click.echo(f"ℹ️ .gitignore に基づき {ignored_count} 個のファイル/ディレクトリを除外します。")
+    if excluded_count:
+        click.echo(f"ℹ️ --exclude オプションに基づき {excluded_count} 個のファイル/ディレクトリを除外します。")
 
     # パターンが指定されたにもかかわらず一致するファイルがなかった場合のみエラーとする
     if not unique_files and file_patterns:
         click.echo(click.style("エラー: 指定されたパターンに一致するファイルが見つかりませんでした。", fg="red"))
         return
-    
-    click.echo(f"ℹ️ {len(unique_files)}個のファイルを処理対象とします。内容を読み込みます...")
 
-    # 3. 各ファイルの内容をヘッダー付きでリストに格納
-    existing_files_content_list = []
-    for file_path_str in unique_files:
-        file_path = Path(file_path_str)
-        if file_path.is_file():
-            try:
-                content = file_path.read_text(encoding="utf-8")
-                # カレントディレクトリからの相対パスを使用
-                relative_path = file_path.as_posix()
-                header = f"---- {relative_path} ----"
-                # ヘッダーとファイル内容を結合してリストに追加
-                existing_files_content_list.append(f"{header}\n{content}")
-                click.echo(f"  - 読み込み成功: {relative_path}")
-            except Exception as e:
-                click.echo(click.style(f"  - 読み込み失敗: {relative_path} ({e})", fg="yellow"))
+    # --related が指定された場合は、依存関係グラフを辿って関連ファイルを距離の近い順に追加する
+    if related:
+        graph = _load_dependency_graph(exclude)
+        related_files, omitted = _limit_related_files(
+            _find_related_files(unique_files, graph, depth), related_limit, related_max_size
+        )
+        _stats_lap(stats, "related")
+        _stats_count(stats, "files_related", len(related_files))
+        if related_files:
+            click.echo(f"ℹ️ 依存関係から {len(related_files)} 個の関連ファイルを追加します（[ ] 内は起点からの距離）。")
+            for path_str, distance in related_files:
+                click.echo(f"  - [{distance}] {path_str}")
+        else:
+            click.echo("ℹ️ 依存関係から追加する関連ファイルはありません。")
+        if omitted:
+            click.echo(click.style(f"  ※上限（--related-limit / --related-max-size）を超えるため、{omitted} 個の関連ファイルを除外しました。", fg="yellow"))
+        unique_files = sorted(set(unique_files).union(path_str for path_str, _ in related_files))
+
+    # 読み込む前に、サイズと先頭部分だけでバイナリ・サイズ超過・UTF-8以外のファイルを除外する
+    unique_files, skipped_files = _inspect_files(unique_files, max_file_size)
+    _stats_lap(stats, "inspect")
+    for _, reason in skipped_files:
+        _stats_skip(stats, reason.split(" (")[0])
+    if skipped_files:
+        click.echo(f"ℹ️ バイナリ・サイズ超過などにより {len(skipped_files)} 個のファイルをスキップします。")
+    if not unique_files and file_patterns:
+        click.echo(click.style("エラー: 埋め込めるファイルがありません。", fg="red"))
+        _echo_skipped_files(skipped_files)
+        return
 
-    # 4. テンプレートにファイル内容を埋め込む
-    template_content = template_file.read_text(encoding="utf-8")
-    
-    # 埋め込むファイルがない場合は「なし」、ある場合は内容を結合した文字列を作成
-    if not unique_files:
-        files_as_string = "なし"
-    else:
-        # ファイル間の区切りとして改行を2つ入れる
-        files_as_string = "\n\n".join(existing_files_content_list)
-    
-    # テンプレートのプレースホルダを置換
-    final_prompt = template_content.replace("{json_diff_rule}", JSON_DIFF_RULE)
-    final_prompt = final_prompt.replace("{existing_files}", files_as_string)
+    # 行範囲の指定（アウトラインより優先）とアウトラインの対象を決める
+    outline_spec = pathspec.GitIgnoreSpec.from_lines(outline) if outline else None
+    for path_str in unique_files:
+        if path_str in slices:
+            reduction["views"][path_str] = ("slice", slices[path_str])
+        elif outline_spec is not None and outline_spec.match_file(path_str):
+            reduction["views"][path_str] = ("outline", None)
+    for path_str in sorted(set(slices).difference(unique_files)):
+        click.echo(click.style(f"  - 警告: 行範囲を指定した {path_str} は埋め込みの対象外です（除外・スキップされたか、存在しません）。", fg="yellow"))
+
+    # 変更のないファイルの再ハッシュを省くため、前回までのインデックスを読み込む
+    index = _load_file_index()
+    matched_files = unique_files
+    _stats_lap(stats, "index_load")
+
+    # --changed-since が指定された場合は、変更されたファイルのみに絞り込む
+    if changed_since:
+        unique_files = _filter_changed_files(matched_files, changed_since, index)
+        _stats_lap(stats, "changed_filter")
+        if unique_files is None:
+            return
+        if not unique_files:
+            click.echo(f"ℹ️ 変更されたファイルはありません（{len(matched_files)}個のファイルを確認しました）。")
+            return
+        click.echo(f"ℹ️ {len(matched_files)}個のファイルのうち、{len(unique_files)}個が変更されています。")
+
+    click.echo(f"ℹ️ {len(unique_files)}個のファイルを処理対象とします。内容を読み込みます...")
+
+    # 3. テンプレートをコンパイルする（インクルード先を含めて更新がなければキャッシュを使う）
+    try:
+        template_segments = _load_template(template_file)
+    except ValueError as e:
+        click.echo(click.style(f"エラー: {e}", fg="red"))
+        return
+    template_tokens = _template_tokens(template_segments)
+    file_section = _template_file_section(template_segments)
+    _stats_lap(stats, "template")
+
+    # 4. --max-tokens が指定された場合は、ファイルをパートに詰め分ける
+    parts = [unique_files]
+    if max_tokens:
+        file_tokens = _collect_file_tokens(unique_files, index["files"])
+        # 書き出したプロンプトの集計と同じく _section_tokens で、ヘッダーとコードフェンスを含めて見積もる
+        section_tokens = {}
+        for path_str, tokens in file_tokens.items():
+            note_tokens, label = _estimate_reduce_overhead(path_str, index["files"][path_str], reduction)
+            section_tokens[path_str] = _section_tokens(path_str, tokens + note_tokens, file_section, label)
+        # 内容が同じファイルは参照だけを埋め込むため、参照の分だけを見積もる
+        if reduction["dedup"]:
+            for path_str, first in _find_duplicates(unique_files, index["files"], reduction["views"]).items():
+                reference_tokens = _estimate_tokens(DUPLICATE_NOTE.format(path=first))
+                section_tokens[path_str] = _section_tokens(path_str, reference_tokens, file_section)
+        # 一部だけを埋め込むファイルは、取り出した部分で見積もる
+        for path_str, view in reduction["views"].items():
+            if path_str in section_tokens:
+                view_tokens, label = _estimate_view_tokens(path_str, index["files"][path_str], view, reduction)
+                section_tokens[path_str] = _section_tokens(path_str, view_tokens, file_section, label)
+        # 注意書きは最も長いものを、パート数が3桁の場合で見積もる
+        note_tokens = max(
+            _estimate_tokens(note.format(part_no=999, part_count=999) + "\n\n")
+            for note in (PART_NOTE_FIRST, PART_NOTE_MIDDLE, PART_NOTE_LAST)
+        )
+        # 2つ目以降のパートでも、ファイルのセクションはテンプレートと同じ書式で出力する
+        continuation_segments = [
+            (kind, file_section if kind == "files" else value)
+            for kind, value in _compile_template(CONTINUATION_TEMPLATE_CONTENT, TEMPLATE_DIR, [])
+        ]
+        first_budget = max_tokens - template_tokens - note_tokens
+        rest_budget = max_tokens - _template_tokens(continuation_segments) - note_tokens
+        if first_budget <= 0 or rest_budget <= 0:
+            click.echo(click.style(f"エラー: テンプレートだけで --max-tokens ({max_tokens:,}) を超えています。", fg="red"))
+            return
+        for path_str, tokens in section_tokens.items():
+            if tokens > rest_budget:
+                click.echo(click.style(f"  - 警告: {path_str} は単独で上限を超えるため（約{tokens:,}トークン）、1ファイルだけのパートとして出力します。", fg="yellow"))
+        parts = _pack_parts(unique_files, section_tokens, first_budget, rest_budget)
+        if len(parts) > 1:
+            click.echo(f"ℹ️ 推定トークン数が上限を超えるため、プロンプトを{len(parts)}個のパートに分割します。")
+        _stats_lap(stats, "pack")
 
     # 5. 結果を出力ファイルと入力ファイル（空）に書き込む
     # タイムスタンプを生成
     timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
 
-    # .promp-out フォルダと出力ファイルの準備
+    # .promp-out フォルダの準備
     Path(OUTPUT_DIR).mkdir(exist_ok=True)
-    output_filename = f"out-{timestamp}.txt"
-    output_path = Path(OUTPUT_DIR) / output_filename
-    output_path.write_text(final_prompt, encoding="utf-8")
-    click.echo(click.style(f"\nプロンプトを '{output_path}' に出力しました。", fg="green"))
+
+    part_count = len(parts)
+    part_summaries = []
+    embedded_files = []
+    for part_no, part_files in enumerate(parts, start=1):
+        if part_count == 1:
+            output_filename = f"out-{timestamp}.txt"
+            note = ""
+            body_segments = template_segments
+        else:
+            output_filename = f"out-{timestamp}-part{part_no}.txt"
+            if part_no == 1:
+                note = PART_NOTE_FIRST
+                body_segments = template_segments
+            else:
+                note = PART_NOTE_LAST if part_no == part_count else PART_NOTE_MIDDLE
+                body_segments = continuation_segments
+            note = note.format(part_no=part_no, part_count=part_count) + "\n\n"
+        output_path = Path(OUTPUT_DIR) / output_filename
+
+        # ファイルは並列に読み込み、ソート順のままヘッダー付きで出力ファイルへ逐次書き出す
+        # （プロンプト全体をメモリ上に組み立てない）
+        with output_path.open("w", encoding="utf-8") as out_f:
+            out_f.write(note)
+            written = _render_template(out_f, body_segments, part_files, index["files"], stats=stats, reduction=reduction)
+        embedded_files.extend(written)
+        _stats_count(stats, "bytes_written", output_path.stat().st_size)
+        click.echo(click.style(f"\nプロンプトを '{output_path}' に出力しました。", fg="green"))
+
+        part_tokens = _estimate_tokens(note) + _template_tokens(body_segments) + sum(
+            _embedded_section_tokens(path_str, index["files"], reduction, file_section) for path_str in written
+        )
+        part_summaries.append((output_path, part_tokens, len(written)))
+    _stats_lap(stats, "embed")
+    _stats_count(stats, "files_embedded", len(embedded_files))
+    _stats_count(stats, "tokens", sum(part_tokens for _, part_tokens, _ in part_summaries))
+    if reduction["saved"]:
+        _stats_count(stats, "bytes_saved", sum(saved[1] for saved in reduction["saved"].values()))
+        _stats_count(stats, "tokens_saved", sum(saved[2] for saved in reduction["saved"].values()))
+    if len(embedded_files) < len(unique_files):
+        _stats_skip(stats, "読み込み失敗", len(unique_files) - len(embedded_files))
+
+    # 今回の時点のファイル内容をスナップショットとして記録し、インデックスを保存する
+    index["runs"][timestamp] = {
+        path_str: index["files"][path_str]["hash"] for path_str in matched_files if path_str in index["files"]
+    }
+    _save_file_index(index)
+    _stats_lap(stats, "index_save")
 
     # .promp-in フォルダと入力用の空ファイルの準備
     Path(INPUT_DIR).mkdir(exist_ok=True)
@@ -293,13 +2383,168 @@ def out(file_patterns, template, exclude):
     input_path.write_text("", encoding="utf-8")
     click.echo(click.style(f"LLMの出力を貼り付けるための空ファイル '{input_path}' を作成しました。", fg="green"))
 
+    # 出力ファイルと入力ファイルの組をマニフェストに記録する
+    # 一部だけ・削減して埋め込んだファイルも記録し、apply でファイル全体の update を拒否できるようにする
+    _record_pair(
+        template, embedded_files, [output_path for output_path, _, _ in part_summaries], input_path,
+        partial_files=reduction["partial"],
+    )
+    _save_outline_cache(reduction)
+    _stats_lap(stats, "manifest")
+
+    # 推定トークン数の集計表を表示する
+    _echo_token_summary(
+        {path_str: _embedded_tokens(path_str, index["files"], reduction) for path_str in embedded_files},
+        template_tokens,
+        part_summaries,
+    )
+    _echo_reduction_summary(reduction)
+    _echo_skipped_files(skipped_files)
+
+
+# --- プロンプトの履歴（マニフェスト・保持ポリシー・アーカイブ） ---
+MANIFEST_FILE = "manifest.jsonl"
+# 最新の組の記録だけを保存するファイル（apply のたびにマニフェスト全体を読まないため）
+LATEST_PAIR_FILE = "latest.json"
+ARCHIVE_DIR = "archive"
+# out-YYYYMMDD-HHMMSS[-partN など].txt / in-YYYYMMDD-HHMMSS[-...].txt
+_PAIR_FILE_PATTERN = re.compile(r"^(out|in)-(\d{8}-\d{6})(?:-[^/\\]+)?\.txt$")
+_AGE_PATTERN = re.compile(r"^\s*(\d+)\s*([dhm])\s*$", re.IGNORECASE)
+_AGE_UNITS = {"d": "days", "h": "hours", "m": "minutes"}
+
+
+def _load_manifest():
+    """'.promp-out/manifest.jsonl' を読み込み、{"latest": 最新の組のキー, "pairs": {キー: 組の記録}} を返す
+
+    マニフェストは追記専用の JSON Lines で、各行は組の記録 {"id", "pair"} か、適用状況の更新 {"id", "status", "at"}。
+    組の記録（キーは入力ファイル名から 'in-' と '.txt' を除いたもの）には、テンプレート名・埋め込んだファイル・
+    一部だけ・削減して埋め込んだファイル・出力ファイルとそのサイズ・入力ファイル名・適用状況（pending / applied / undone）・
+    移動先のアーカイブを記録する。存在しない場合は空のマニフェストを返し、壊れた行は読み飛ばす。
+    """
+    manifest = {"latest": None, "pairs": {}}
+    try:
+        f = (Path(OUTPUT_DIR) / MANIFEST_FILE).open("r", encoding="utf-8")
+    except OSError:
+        return manifest
+    with f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(record, dict) or "id" not in record:
+                continue
+            if isinstance(record.get("pair"), dict):
+                manifest["pairs"][record["id"]] = record["pair"]
+                manifest["latest"] = record["id"]
+            elif record["id"] in manifest["pairs"] and "status" in record:
+                pair = manifest["pairs"][record["id"]]
+                pair["status"] = record["status"]
+                pair[f"{record['status']}_at"] = record.get("at")
+    return manifest
+
+
+def _save_manifest(manifest):
+    """マニフェストを組ごとに1行の記録へまとめ直して保存し、最新の組の記録も更新する（clear で使う）"""
+    lines = "".join(
+        json.dumps({"id": pair_id, "pair": pair}, ensure_ascii=False, separators=(",", ":")) + "\n"
+        for pair_id, pair in manifest["pairs"].items()
+    )
+    _write_text_atomic(Path(OUTPUT_DIR) / MANIFEST_FILE, lines)
+    latest = manifest["pairs"].get(manifest["latest"] or "")
+    if latest is None:
+        (Path(OUTPUT_DIR) / LATEST_PAIR_FILE).unlink(missing_ok=True)
+    else:
+        _write_json_atomic(Path(OUTPUT_DIR) / LATEST_PAIR_FILE, {"id": manifest["latest"], "pair": latest})
+
+
+def _append_manifest(record):
+    """マニフェストの末尾に1行を追記する（既存の記録は読み込まない）"""
+    Path(OUTPUT_DIR).mkdir(exist_ok=True)
+    with (Path(OUTPUT_DIR) / MANIFEST_FILE).open("a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+
+def _load_latest_pair():
+    """'.promp-out/latest.json' から、最新の組の (キー, 記録) を返す。記録がない場合は (None, None)"""
+    latest = _read_json_dict(Path(OUTPUT_DIR) / LATEST_PAIR_FILE)
+    if not isinstance(latest.get("id"), str) or not isinstance(latest.get("pair"), dict):
+        return None, None
+    return latest["id"], latest["pair"]
+
+
+def _find_pair(input_path):
+    """入力ファイルに対応する組の記録を返す（記録がない場合は None）
+
+    最新の組であれば小さな latest.json だけを読み、それ以外の場合のみマニフェスト全体を読み込む。
+    """
+    pair_id = _pair_id(input_path)
+    if pair_id is None:
+        return None
+    latest_id, latest = _load_latest_pair()
+    if latest_id == pair_id:
+        return latest
+    return _load_manifest()["pairs"].get(pair_id)
+
+
+def _pair_id(input_path):
+    """入力ファイル名から、マニフェストのキー（'in-' と '.txt' を除いた部分）を返す。入力ファイル名の形式でない場合は None"""
+    name = Path(input_path).name
+    m = _PAIR_FILE_PATTERN.match(name)
+    if not m or m.group(1) != "in":
+        return None
+    return name[len("in-"):-len(".txt")]
+
+
+def _record_pair(template, file_paths, output_paths, input_path, partial_files=None):
+    """出力ファイルと入力ファイルの組をマニフェストに記録し、最新の組とする
+
+    partial_files には、一部だけ・削減して埋め込んだファイルの {パス: 方法} を指定する。
+    """
+    pair_id = _pair_id(input_path)
+    pair = {
+        "template": template,
+        "files": list(file_paths),
+        "outputs": {Path(path).name: os.path.getsize(path) for path in output_paths},
+        "input": Path(input_path).name,
+        "partial": dict(partial_files or {}),
+        "status": "pending",
+        "archive": None,
+    }
+    _append_manifest({"id": pair_id, "pair": pair})
+    _write_json_atomic(Path(OUTPUT_DIR) / LATEST_PAIR_FILE, {"id": pair_id, "pair": pair})
+
+
+def _set_pair_status(input_path, status):
+    """入力ファイルに対応する組の適用状況を、マニフェストへの追記で更新する（記録のない入力ファイルは何もしない）"""
+    if _find_pair(input_path) is None:
+        return
+    pair_id = _pair_id(input_path)
+    at = datetime.datetime.now().isoformat(timespec="seconds")
+    _append_manifest({"id": pair_id, "status": status, "at": at})
+    latest_id, latest = _load_latest_pair()
+    if latest_id == pair_id:
+        latest["status"] = status
+        latest[f"{status}_at"] = at
+        _write_json_atomic(Path(OUTPUT_DIR) / LATEST_PAIR_FILE, {"id": pair_id, "pair": latest})
+
+
 def _find_latest_input_file():
-    """'.promp-in' ディレクトリ内の最新の入力ファイルを検索するヘルパー関数"""
+    """'.promp-in' ディレクトリ内の最新の入力ファイルを検索するヘルパー関数
+
+    最新の組の記録（latest.json）を使い、記録がない場合だけディレクトリを一覧して探す。
+    """
     input_dir_path = Path(INPUT_DIR)
     if not input_dir_path.is_dir():
         click.echo(click.style(f"エラー: '{INPUT_DIR}' ディレクトリが見つかりません。", fg="red"))
         return None
 
+    _, latest = _load_latest_pair()
+    if latest is not None and not latest.get("archive"):
+        latest_path = input_dir_path / latest["input"]
+        if latest_path.is_file():
+            return latest_path
+
     in_files = sorted(list(input_dir_path.glob("in-*.txt")), reverse=True)
     if not in_files:
         click.echo(click.style(f"エラー: '{INPUT_DIR}' 内に適用対象のファイルが見つかりません。", fg="red"))
@@ -307,52 +2552,774 @@ def _find_latest_input_file():
         
     return in_files[0]
 
-@promp.command()
-@click.argument("apply_file", type=click.Path(dir_okay=False), required=False)
-def apply(apply_file):
-    """LLMが出力したJSON差分ファイルを適用する"""
-    target_file_path = None
 
-    if apply_file is None:
-        click.echo(f"ℹ️ ファイルが指定されていないため、'{INPUT_DIR}/' 内の最新ファイルを検索します...")
-        target_file_path = _find_latest_input_file()
-        if not target_file_path:
-            return
-        click.echo(click.style(f"✅ 最新ファイル '{target_file_path}' を適用対象とします。", fg="green"))
+def _archive_path(timestamp):
+    """タイムスタンプの組を格納するアーカイブ（月ごとのzipファイル）のパス"""
+    return Path(OUTPUT_DIR) / ARCHIVE_DIR / f"pairs-{timestamp[:6]}.zip"
+
+
+def _read_archived_input(input_path):
+    """アーカイブに移動した入力ファイルの内容を返す。見つからない場合は None"""
+    m = _PAIR_FILE_PATTERN.match(Path(input_path).name)
+    if not m or m.group(1) != "in":
+        return None
+    archive_path = _archive_path(m.group(2))
+    member = f"{INPUT_DIR}/{Path(input_path).name}"
+    try:
+        with zipfile.ZipFile(archive_path) as zf:
+            data = zf.read(member)
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return None
+    return data.decode("utf-8").replace("\r\n", "\n")
+
+
+def _parse_age_option(ctx, param, value):
+    """--older-than の期間（例: 30d, 12h, 90m）を timedelta に変換する click のコールバック"""
+    if value is None:
+        return None
+    m = _AGE_PATTERN.match(value)
+    if not m:
+        raise click.BadParameter(f"期間の形式が正しくありません: {value}（例: 30d, 12h, 90m）")
+    return datetime.timedelta(**{_AGE_UNITS[m.group(2).lower()]: int(m.group(1))})
+
+
+def _collect_pairs():
+    """'.promp-out' と '.promp-in' のプロンプトのファイルを、タイムスタンプごとに [(パス, サイズ)] にまとめる"""
+    pairs = {}
+    for dir_name in (OUTPUT_DIR, INPUT_DIR):
+        try:
+            entries = list(os.scandir(dir_name))
+        except OSError:
+            continue
+        for entry in entries:
+            m = _PAIR_FILE_PATTERN.match(entry.name)
+            if not m or not entry.is_file():
+                continue
+            try:
+                datetime.datetime.strptime(m.group(2), "%Y%m%d-%H%M%S")
+            except ValueError:
+                continue
+            pairs.setdefault(m.group(2), []).append((Path(dir_name) / entry.name, entry.stat().st_size))
+    return pairs
+
+
+def _archive_pairs(timestamps, pairs):
+    """指定したタイムスタンプの組を月ごとのzipファイルに圧縮して移動する。戻り値は移動したファイル数"""
+    moved = 0
+    by_month = {}
+    for timestamp in timestamps:
+        by_month.setdefault(timestamp[:6], []).append(timestamp)
+    for month_timestamps in by_month.values():
+        archive_path = _archive_path(month_timestamps[0])
+        archive_path.parent.mkdir(parents=True, exist_ok=True)
+        archived = []
+        with zipfile.ZipFile(archive_path, "a", compression=zipfile.ZIP_DEFLATED) as zf:
+            names = set(zf.namelist())
+            for timestamp in month_timestamps:
+                for path, _ in pairs[timestamp]:
+                    member = f"{path.parent.name}/{path.name}"
+                    if member not in names:
+                        zf.write(path, arcname=member)
+                    archived.append(path)
+        # zipファイルを書き終えてから元のファイルを削除する
+        for path in archived:
+            path.unlink()
+        moved += len(archived)
+    return moved
+
+
+def _clear_pairs(keep, older_than, archive, stats):
+    """保持ポリシーに従って古いプロンプトの組を削除、またはアーカイブへ移動する"""
+    pairs = _collect_pairs()
+    timestamps = sorted(pairs, reverse=True)
+    targets = timestamps[keep:] if keep is not None else timestamps
+    if older_than is not None:
+        limit = datetime.datetime.now() - older_than
+        targets = [ts for ts in targets if datetime.datetime.strptime(ts, "%Y%m%d-%H%M%S") < limit]
+    files = [(path, size) for ts in targets for path, size in pairs[ts]]
+    _stats_lap(stats, "scan")
+    if not targets:
+        click.echo(f"ℹ️ 対象となるプロンプトはありません（保存されているプロンプト: {len(timestamps)}回分）。")
+        return
+
+    action = "圧縮アーカイブへ移動" if archive else "削除"
+    total_size = sum(size for _, size in files)
+    click.echo(f"{len(timestamps)}回分のプロンプトのうち、以下の{len(targets)}回分（{len(files)}ファイル、{_format_size(total_size)}）を{action}します。")
+    click.echo(f"  {min(targets)} 〜 {max(targets)}")
+    confirmed = click.confirm("よろしいですか？")
+    _stats_lap(stats, "confirm")
+    if not confirmed:
+        click.echo("処理を中断しました。")
+        return
+
+    manifest = _load_manifest()
+    target_set = set(targets)
+    if archive:
+        moved = _archive_pairs(targets, pairs)
+        _stats_lap(stats, "archive")
+        _stats_count(stats, "files_archived", moved)
+        _stats_count(stats, "bytes_archived", total_size)
+        for pair_id, pair in manifest["pairs"].items():
+            if pair_id[:15] in target_set:
+                pair["archive"] = _archive_path(pair_id).name
+        click.echo(click.style(f"✅ {moved}個のファイルを '{Path(OUTPUT_DIR) / ARCHIVE_DIR}' に移動しました。", fg="green"))
     else:
-        target_file_path = Path(apply_file)
+        for path, size in files:
+            try:
+                path.unlink()
+            except OSError as e:
+                click.echo(click.style(f"❌ エラー: '{path}' を削除できませんでした: {e}", fg="red"))
+                continue
+            _stats_count(stats, "files_removed")
+            _stats_count(stats, "bytes_removed", size)
+        _stats_lap(stats, "remove")
+        for pair_id in [pair_id for pair_id in manifest["pairs"] if pair_id[:15] in target_set]:
+            del manifest["pairs"][pair_id]
+        click.echo(click.style(f"✅ {len(files)}個のファイルを削除しました。", fg="green"))
+    _save_manifest(manifest)
+
+
+# --- LLM出力の解析（JSONブロックの走査） ---
+# 文字列中の改行やタブなどの制御文字も許容する
+_JSON_DECODER = json.JSONDecoder(strict=False)
+_JSON_WHITESPACE = re.compile(r"[ \t\r\n]*")
+# ``` で始まる行（言語タグは任意）
+_FENCE_PATTERN = re.compile(r"^[ \t]*```[ \t]*([A-Za-z0-9_+-]*)[^\n]*$", re.MULTILINE)
+_FILE_PATH_PATTERN = re.compile(r'"file_path"\s*:\s*"((?:[^"\\]|\\.)*)"')
+# JSONとして解釈するコードブロックの言語タグ
+JSON_FENCE_TAGS = ("json", "jsonc", "")
+# jsonc のブロックのコメント（文字列リテラルは読み飛ばす）
+_JSONC_COMMENT_PATTERN = re.compile(r'"(?:\\.|[^"\\])*"|(?P<comment>//[^\n]*|/\*[\s\S]*?\*/)')
+
+
+def _find_json_blocks(text):
+    """テキストから JSON のコードブロックを探し、(開始位置, 終了位置, 言語タグ) のリストを返す
+
+    言語タグが json / jsonc のものとタグなしのものを対象とし、閉じられていない最後のブロックはテキスト末尾までとする。
+    コードブロックが1つもなければ、最初の '{' からテキスト末尾までを1つのブロックとみなす。
+    """
+    blocks = []
+    has_fence = False
+    fences = _FENCE_PATTERN.finditer(text)
+    for opening in fences:
+        has_fence = True
+        closing = next(fences, None)
+        start = opening.end()
+        end = closing.start() if closing else len(text)
+        tag = opening.group(1).lower()
+        if tag in JSON_FENCE_TAGS:
+            brace = _JSON_WHITESPACE.match(text, start).end()
+            if brace < end and text[brace] == "{":
+                blocks.append((brace, end, tag))
+        if closing is None:
+            break
+    if not has_fence:
+        brace = text.find("{")
+        if brace < 0:
+            raise json.JSONDecodeError("JSONオブジェクトが見つかりません", text, 0)
+        blocks.append((brace, len(text), ""))
+    return blocks
+
+
+def _blank_jsonc_comments(text, start, end):
+    """start から end までのコメントを空白に置き換えたテキストを返す（行番号や位置がずれないよう、改行と長さは保つ）"""
+    def blank(m):
+        if m.group("comment") is None:
+            return m.group(0)
+        return re.sub(r"[^\n]", " ", m.group(0))
+
+    return text[:start] + _JSONC_COMMENT_PATTERN.sub(blank, text[start:end]) + text[end:]
+
+
+def _is_truncation(error, end):
+    """JSONの解析エラーが、ブロックの末尾で内容が途切れたことによるものか"""
+    return error.pos >= end or error.msg.startswith("Unterminated string")
+
+
+def _parse_changes_block(text, start, end, changes):
+    """JSONブロックの changes 配列を1件ずつ解析して changes に追加する
+
+    変更が途中で途切れている場合は (途切れた変更の位置, 推測した file_path) を返し、それ以外は None を返す。
+    途切れ以外の構文エラーは json.JSONDecodeError を送出する。
+    """
+    # ブロック末尾の空白を除いた位置を、途切れの判定に使う
+    while end > start and text[end - 1].isspace():
+        end -= 1
+
+    pos = start + 1
+    while True:
+        pos = _JSON_WHITESPACE.match(text, pos).end()
+        if pos >= end:
+            # changes 配列より後ろで途切れた場合は、変更の欠落はない
+            return None
+        if text[pos] == "}":
+            return None
+        if text[pos] == ",":
+            pos += 1
+            continue
+        key, pos = _JSON_DECODER.raw_decode(text, pos)
+        pos = _JSON_WHITESPACE.match(text, pos).end()
+        if text[pos:pos + 1] != ":":
+            raise json.JSONDecodeError("Expecting ':' delimiter", text, pos)
+        pos = _JSON_WHITESPACE.match(text, pos + 1).end()
 
-    if not target_file_path.exists():
-        click.echo(click.style(f"エラー: ファイル '{target_file_path}' が見つかりません。", fg="red"))
+        if key != "changes":
+            try:
+                _, pos = _JSON_DECODER.raw_decode(text, pos)
+            except json.JSONDecodeError as e:
+                if _is_truncation(e, end):
+                    return None
+                raise
+            continue
+
+        if text[pos:pos + 1] != "[":
+            raise json.JSONDecodeError("'changes' が配列ではありません", text, pos)
+        pos += 1
+        while True:
+            pos = _JSON_WHITESPACE.match(text, pos).end()
+            if pos >= end:
+                return pos, None
+            if text[pos] == "]":
+                pos += 1
+                break
+            if text[pos] == ",":
+                pos += 1
+                continue
+            try:
+                change, pos = _JSON_DECODER.raw_decode(text, pos)
+            except json.JSONDecodeError as e:
+                if not _is_truncation(e, end):
+                    raise
+                match = _FILE_PATH_PATTERN.search(text, pos, end)
+                return pos, (json.loads(f'"{match.group(1)}"') if match else None)
+            changes.append(change)
+
+
+def _parse_llm_output(text):
+    """LLMの出力から全ての JSON ブロックを探し、changes の要素を出現順にまとめて返す
+
+    戻り値は (変更のリスト, 途切れた変更のリスト, 読み飛ばしたブロックのリスト)。
+    途切れた変更は (何件目か, 行番号, 推測した file_path) のタプル。
+    構文エラーのブロックは、そのブロックの変更をすべて除いて読み飛ばし、(行番号, エラー) のタプルとして返す。
+    変更が1件も見つからず、構文エラーのブロックがあった場合は、最初のエラーの json.JSONDecodeError を送出する。
+    """
+    # ノーブレークスペースを通常のスペースに置換（含まれている場合のみ複製する）
+    if "\u00a0" in text:
+        text = text.replace("\u00a0", " ")
+
+    changes = []
+    truncated = []
+    skipped = []
+    for start, end, tag in _find_json_blocks(text):
+        if tag == "jsonc":
+            text = _blank_jsonc_comments(text, start, end)
+        count = len(changes)
+        try:
+            result = _parse_changes_block(text, start, end, changes)
+        except json.JSONDecodeError as e:
+            # 説明用のコード例などの壊れたブロックで、他のブロックの変更まで止めない
+            del changes[count:]
+            skipped.append((text.count("\n", 0, start) + 1, e))
+            continue
+        if result is not None:
+            pos, path_str = result
+            truncated.append((len(changes) + 1, text.count("\n", 0, pos) + 1, path_str))
+    if not changes and skipped:
+        raise skipped[0][1]
+    return changes, truncated, skipped
+
+
+# --- patch 操作（unified diff 形式のハンクの適用） ---
+def _collapse_whitespace(line):
+    """行内の連続する空白を1つにまとめ、前後の空白を取り除く"""
+    return " ".join(line.split())
+
+
+# ハンクの照合方法（完全一致、行末の空白を無視、空白の違いを無視の順に試す）
+_HUNK_NORMALIZERS = (None, str.rstrip, _collapse_whitespace)
+
+
+def _parse_hunks(diff_text):
+    """unified diff 形式の文字列をハンクのリストに分解する
+
+    各ハンクは (元ファイルでの開始行, 元ファイルでの行数, [(種別, 行), ...]) のタプル。
+    行番号が省略された '@@' だけの行も受け付け、その場合の開始行と行数は None になる。
+    種別は ' '（変更しない行）、'-'（削除する行）、'+'（追加する行）のいずれか。
+    """
+    hunks = []
+    current = None
+    # splitlines は改ページ（\x0c）や U+2028 などでも区切ってしまうため、改行コードだけで区切る
+    for line in diff_text.replace("\r\n", "\n").rstrip("\n").split("\n"):
+        if line.startswith("@@"):
+            match = re.match(r"@@\s*-(\d+)(?:,(\d+))?", line)
+            if match:
+                old_count = int(match.group(2)) if match.group(2) is not None else 1
+                current = (int(match.group(1)), old_count, [])
+            else:
+                current = (None, None, [])
+            hunks.append(current)
+        elif current is None:
+            # 最初のハンクより前の '--- a/...' '+++ b/...' などのヘッダーは読み飛ばす
+            continue
+        elif line.startswith("\\"):
+            # '\ No newline at end of file' は無視する
+            continue
+        elif line[:1] in (" ", "-", "+"):
+            current[2].append((line[0], line[1:]))
+        elif line == "":
+            # 先頭の半角スペースが失われた空行は、変更しない空行とみなす
+            current[2].append((" ", ""))
+        else:
+            raise ValueError(f"ハンク{len(hunks)}に解釈できない行があります: {line!r}")
+    if not hunks:
+        raise ValueError("diff に '@@' で始まるハンクが見つかりません。")
+    return hunks
+
+
+def _find_hunk_position(lines, old_lines, start, hint, normalized_cache):
+    """ハンクの元の行が一致する位置を start 以降から探す。見つからなければ None を返す
+
+    完全一致から順に空白の違いを許容していき、複数見つかった場合は行番号 hint に最も近い位置を選ぶ。
+    """
+    count = len(old_lines)
+    for normalize in _HUNK_NORMALIZERS:
+        if normalize is None:
+            file_lines, target = lines, old_lines
+        else:
+            if normalize not in normalized_cache:
+                normalized_cache[normalize] = [normalize(line) for line in lines]
+            file_lines = normalized_cache[normalize]
+            target = [normalize(line) for line in old_lines]
+        candidates = [
+            i for i in range(start, len(file_lines) - count + 1)
+            if file_lines[i] == target[0] and file_lines[i:i + count] == target
+        ]
+        if candidates:
+            if hint is None:
+                return candidates[0]
+            return min(candidates, key=lambda i: (abs(i - hint), i))
+    return None
+
+
+def _apply_unified_diff(original, diff_text):
+    """ファイルの内容に unified diff 形式のハンクを順に適用し、(適用後の内容, ハンク数) を返す
+
+    ハンクは前後の行の内容で位置を特定するため、行番号がずれていても適用できる。
+    適用できないハンクがある場合は ValueError を送出する（ファイルは変更しない）。
+    """
+    hunks = _parse_hunks(diff_text)
+    ends_with_newline = original.endswith("\n") or original == ""
+    lines = original.split("\n")
+    if ends_with_newline:
+        lines.pop()
+
+    result = []
+    pos = 0
+    normalized_cache = {}
+    for hunk_no, (old_start, old_count, ops) in enumerate(hunks, start=1):
+        old_lines = [text for kind, text in ops if kind != "+"]
+        if not old_lines:
+            # 追加のみのハンクは、行番号の位置（なければファイル末尾）に挿入する
+            index = len(lines) if old_start is None else old_start if old_count == 0 else old_start - 1
+            index = min(max(index, pos), len(lines))
+        else:
+            hint = None if old_start is None else old_start - 1
+            index = _find_hunk_position(lines, old_lines, pos, hint, normalized_cache)
+            if index is None:
+                preview = "\n".join(f"    {line}" for line in old_lines[:3])
+                raise ValueError(f"ハンク{hunk_no}/{len(hunks)}を適用できません。以下の行に一致する箇所が見つかりません:\n{preview}")
+
+        result.extend(lines[pos:index])
+        # 変更しない行は、空白の違いがあってもファイル側の内容をそのまま残す
+        for kind, text in ops:
+            if kind == " ":
+                result.append(lines[index])
+                index += 1
+            elif kind == "-":
+                index += 1
+            else:
+                result.append(text)
+        pos = index
+
+    result.extend(lines[pos:])
+    patched = "\n".join(result)
+    if ends_with_newline and result:
+        patched += "\n"
+    return patched, len(hunks)
+
+
+# --- 変更の一括適用（検証・一時ファイルへの書き出し・確定・取り消し） ---
+# 直前の apply を取り消すためのジャーナルとバックアップの保存先（.promp-in 内）
+UNDO_DIR = "undo"
+UNDO_JOURNAL_FILE = "journal.json"
+UNDO_BACKUP_DIR = "files"
+KNOWN_OPERATIONS = ("create", "update", "patch", "delete")
+
+
+def _validate_changes(changes, partial_files=None):
+    """変更内容全体を検証し、問題点のメッセージのリストを返す（問題がなければ空のリスト）
+
+    partial_files には、プロンプトに一部（行範囲・アウトライン）だけ、または削減（--reduce）して埋め込んだファイルの
+    {パス: 方法} を指定する。これらのファイル全体を置き換える update は拒否する。
+    """
+    errors = []
+    seen_paths = {}
+    cwd = os.path.realpath(os.getcwd())
+    for number, change in enumerate(changes, start=1):
+        if not isinstance(change, dict):
+            errors.append(f"{number}件目: 変更がオブジェクトではありません。")
+            continue
+        op = change.get("operation")
+        path_str = change.get("file_path")
+        if not isinstance(path_str, str) or not path_str:
+            errors.append(f"{number}件目: 'file_path' がありません。")
+            continue
+        if op not in KNOWN_OPERATIONS:
+            errors.append(f"{path_str}: 未知の操作 '{op}' です。")
+
+        # カレントフォルダの外を指すパスは拒否する
+        target = os.path.realpath(os.path.join(cwd, path_str))
+        if os.path.isabs(path_str) or os.path.commonpath([cwd, target]) != cwd or target == cwd:
+            errors.append(f"{path_str}: カレントフォルダの外を指すパスは指定できません。")
+            continue
+
+        # 同じファイルへの複数の変更は、適用順によって結果が変わるため拒否する
+        if target in seen_paths:
+            errors.append(f"{path_str}: {seen_paths[target]} と同じファイルに対する変更が重複しています。")
+        else:
+            seen_paths[target] = path_str
+
+        if op in ("create", "update") and not isinstance(change.get("content"), str):
+            errors.append(f"{path_str}: {op} には 'content' が必要です。")
+        view = (partial_files or {}).get(Path(os.path.relpath(target, cwd)).as_posix())
+        if op == "update" and view is not None:
+            errors.append(
+                f"{path_str}: プロンプトには{PARTIAL_VIEW_LABELS[view]}だけを埋め込んだため、ファイル全体を置き換える update はできません。patch を使用してください。"
+            )
+        if op == "patch" and not isinstance(change.get("diff"), str):
+            errors.append(f"{path_str}: patch には 'diff' が必要です。")
+    return errors
+
+
+def _make_missing_dirs(dir_path):
+    """親ディレクトリを作成し、新たに作成したディレクトリのリストを浅い順に返す"""
+    created = []
+    current = dir_path
+    while not current.exists() and current != current.parent:
+        created.append(current)
+        current = current.parent
+    dir_path.mkdir(parents=True, exist_ok=True)
+    return [d.as_posix() for d in reversed(created)]
+
+
+def _remove_empty_dirs(dir_paths):
+    """作成したディレクトリのうち、空のものを深い順に削除する"""
+    for dir_str in reversed(dir_paths):
+        try:
+            os.rmdir(dir_str)
+        except OSError:
+            pass
+
+
+def _detect_newline(text):
+    """テキストの最初の改行の改行コード（'\r\n' または '\n'）を返す。改行がない場合は OS の標準"""
+    position = text.find("\n")
+    if position < 0:
+        return os.linesep
+    return "\r\n" if position > 0 and text[position - 1] == "\r" else "\n"
+
+
+def _write_staged_file(file_path, text, number, newline=None):
+    """新しい内容を対象ファイルと同じフォルダの一時ファイルに書き出し、(一時ファイルのパス, ハッシュ値) を返す
+
+    newline を省略した場合は、write_text と同様に改行コードをOSの標準に合わせる。
+    """
+    newline = newline or os.linesep
+    if newline != "\n":
+        text = text.replace("\n", newline)
+    data = text.encode("utf-8")
+    tmp_path = file_path.parent / f".{file_path.name}.promp-tmp-{os.getpid()}-{number}"
+    with open(tmp_path, "xb") as f:
+        f.write(data)
+    # 既存ファイルを置き換える場合は、パーミッションを引き継ぐ
+    if file_path.exists():
+        shutil.copymode(file_path, tmp_path)
+    return tmp_path, _hash_bytes(data)
+
+
+def _discard_staged(plan, created_dirs):
+    """確定前の一時ファイルと、作成したディレクトリを片付ける"""
+    for item in plan:
+        if item["tmp"] is not None:
+            Path(item["tmp"]).unlink(missing_ok=True)
+    _remove_empty_dirs(created_dirs)
+
+
+def _stage_changes(changes):
+    """各変更の新しい内容を一時ファイルに書き出し、(確定処理の計画, 作成したディレクトリ) を返す
+
+    patch のハンクを適用できない場合などは ValueError を送出する（書き出した一時ファイルは片付ける）。
+    """
+    plan = []
+    created_dirs = []
+    try:
+        for number, change in enumerate(changes):
+            op = change["operation"]
+            path_str = change["file_path"]
+            file_path = Path(path_str)
+            exists = file_path.exists()
+
+            if op == "create" and exists:
+                click.echo(click.style(f"  - 警告: 作成予定のファイル {path_str} は既に存在するためスキップします。", fg="yellow"))
+                continue
+            if op == "update" and not exists:
+                click.echo(click.style(f"  - 警告: 更新予定のファイル {path_str} が見つからないため新規作成します。", fg="yellow"))
+            if op == "patch" and not exists:
+                click.echo(click.style(f"  - 警告: 部分更新予定のファイル {path_str} が見つからないためスキップします。", fg="yellow"))
+                continue
+            if op == "delete" and not exists:
+                click.echo(click.style(f"  - 警告: 削除予定のファイル {path_str} は存在しません。", fg="yellow"))
+                continue
+
+            item = {"op": op, "path": path_str, "existed": exists, "tmp": None, "hash": None, "message": ""}
+            if op == "delete":
+                item["message"] = f"  ✅ [DELETE] {path_str} を削除しました。"
+            else:
+                newline = None
+                if op == "patch":
+                    # 変更しない行の改行コードを保つため、元のファイルの改行コードで書き戻す
+                    with file_path.open("r", encoding="utf-8", newline="") as f:
+                        original = f.read()
+                    newline = _detect_newline(original)
+                    try:
+                        text, hunk_count = _apply_unified_diff(original.replace("\r\n", "\n"), change["diff"])
+                    except ValueError as e:
+                        raise ValueError(f"{path_str}: {e}") from e
+                    item["message"] = f"  ✅ [PATCH] {path_str} を部分更新しました（ハンク{hunk_count}個）。"
+                elif op == "create":
+                    text = change["content"]
+                    item["message"] = f"  ✅ [CREATE] {path_str} を作成しました。"
+                else:
+                    text = change["content"]
+                    item["message"] = f"  ✅ [UPDATE] {path_str} を更新しました。"
+                created_dirs.extend(_make_missing_dirs(file_path.parent))
+                item["tmp"], item["hash"] = _write_staged_file(file_path, text, number, newline)
+            plan.append(item)
+    except Exception:
+        _discard_staged(plan, created_dirs)
+        raise
+    return plan, created_dirs
+
+
+def _commit_one(item, backup_path):
+    """1件の変更を確定する。既存ファイルは置き換える前にバックアップ先へリンク（できなければコピー）する"""
+    path_str = item["path"]
+    if item["existed"]:
+        try:
+            os.link(path_str, backup_path)
+        except OSError:
+            shutil.copy2(path_str, backup_path)
+    if item["op"] == "delete":
+        os.unlink(path_str)
+    else:
+        os.replace(item["tmp"], path_str)
+
+
+def _rollback_entry(entry, undo_path):
+    """ジャーナルの1件分を適用前の状態に戻す"""
+    path = Path(entry["path"])
+    if entry["existed"]:
+        backup_path = undo_path / UNDO_BACKUP_DIR / entry["backup"]
+        if backup_path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(backup_path, path)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def _echo_not_restored(not_restored, undo_path):
+    """元に戻せなかったファイルを表示する（バックアップとジャーナルは apply --undo でやり直せるよう残す）"""
+    click.echo(click.style("\n❌ 以下のファイルは元に戻せませんでした：", fg="red"))
+    for path_str, e in not_restored:
+        click.echo(click.style(f"  - {path_str}: {e}", fg="red"))
+    click.echo(click.style(f"  バックアップは '{undo_path / UNDO_BACKUP_DIR}' に残しています。原因を取り除いてから 'promp apply --undo' を実行してください。", fg="yellow"))
+
+
+def _write_journal(undo_path, journal):
+    """ジャーナルを一時ファイル経由で置き換えて保存する"""
+    _write_json_atomic(undo_path / UNDO_JOURNAL_FILE, journal, indent=2)
+
+
+def _commit_changes(plan, created_dirs, source):
+    """書き出した変更を並列に確定し、取り消し用のジャーナルを '.promp-in/undo/' に残す
+
+    いずれかの確定に失敗した場合は、確定済みの変更も含めて全体を元に戻し False を返す。
+    """
+    undo_path = Path(INPUT_DIR) / UNDO_DIR
+    shutil.rmtree(undo_path, ignore_errors=True)
+    (undo_path / UNDO_BACKUP_DIR).mkdir(parents=True)
+
+    entries = [
+        {
+            "path": item["path"],
+            "operation": item["op"],
+            "existed": item["existed"],
+            "backup": str(number) if item["existed"] else None,
+            "hash": item["hash"],
+        }
+        for number, item in enumerate(plan)
+    ]
+    journal = {
+        "source": str(source),
+        "applied_at": datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
+        "status": "pending",
+        "created_dirs": created_dirs,
+        "entries": entries,
+    }
+    # 確定の途中で中断しても元に戻せるよう、先にジャーナルを書いておく
+    _write_journal(undo_path, journal)
+
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        futures = [
+            executor.submit(_commit_one, item, undo_path / UNDO_BACKUP_DIR / str(number))
+            for number, item in enumerate(plan)
+        ]
+        failures = []
+        for item, future in zip(plan, futures):
+            try:
+                future.result()
+            except Exception as e:
+                failures.append((item, e))
+
+    if failures:
+        for item, e in failures:
+            click.echo(click.style(f"  ❌ [{item['op'].upper()}] {item['path']} の処理中にエラーが発生しました: {e}", fg="red"))
+        click.echo(click.style("  すべての変更を適用前の状態に戻します...", fg="yellow"))
+        # 1件戻せなくても残りは戻し、戻せなかったファイルだけを最後にまとめて示す
+        not_restored = []
+        for entry in reversed(entries):
+            try:
+                _rollback_entry(entry, undo_path)
+            except Exception as e:
+                not_restored.append((entry["path"], e))
+        _discard_staged(plan, created_dirs)
+        if not_restored:
+            _echo_not_restored(not_restored, undo_path)
+        else:
+            shutil.rmtree(undo_path, ignore_errors=True)
+        return False
+
+    journal["status"] = "committed"
+    _write_journal(undo_path, journal)
+    for item in plan:
+        click.echo(click.style(item["message"], fg="green"))
+    return True
+
+
+def _undo_last_apply():
+    """'.promp-in/undo/' のジャーナルをもとに、直前の apply を元に戻す"""
+    undo_path = Path(INPUT_DIR) / UNDO_DIR
+    journal = _read_json_dict(undo_path / UNDO_JOURNAL_FILE)
+    if "entries" not in journal:
+        click.echo(click.style("エラー: 元に戻せる apply の記録が見つかりません。", fg="red"))
+        return
+
+    entries = journal["entries"]
+    click.echo(f"ℹ️ {journal['applied_at']} に '{journal['source']}' から適用した以下の変更を元に戻します：")
+    modified = []
+    for entry in entries:
+        click.echo(f"  [{entry['operation'].upper()}] {entry['path']}")
+        path = Path(entry["path"])
+        # 適用後にさらに編集されたファイルを検出する
+        if entry["operation"] == "delete":
+            if path.exists():
+                modified.append(entry["path"])
+        elif not path.is_file() or _hash_bytes(path.read_bytes()) != entry["hash"]:
+            modified.append(entry["path"])
+
+    if modified:
+        click.echo(click.style("\n警告: 以下のファイルは適用後に変更されています。元に戻すとその変更は失われます。", fg="yellow"))
+        for path_str in modified:
+            click.echo(click.style(f"  - {path_str}", fg="yellow"))
+
+    if not click.confirm("\n処理を続行しますか？"):
+        click.echo("処理を中断しました。")
         return
+
+    click.echo("")
+    not_restored = []
+    for entry in reversed(entries):
+        try:
+            _rollback_entry(entry, undo_path)
+            click.echo(click.style(f"  ✅ {entry['path']} を元に戻しました。", fg="green"))
+        except Exception as e:
+            not_restored.append((entry["path"], e))
+    _remove_empty_dirs(journal.get("created_dirs", []))
+    if not_restored:
+        _echo_not_restored(not_restored, undo_path)
+        return
+    shutil.rmtree(undo_path, ignore_errors=True)
+    _set_pair_status(journal["source"], "undone")
+    click.echo(click.style("\n元に戻す処理が完了しました。", fg="green"))
+
+
+def _apply_input_file(target_file_path, stats):
+    """LLMの出力ファイルを解析・検証し、確認の上で変更をまとめて適用する。適用を確定した場合は True を返す"""
+    archived_content = None
+    if not target_file_path.exists():
+        # clear --archive でアーカイブへ移動した入力ファイルは、アーカイブから読み込む
+        archived_content = _read_archived_input(target_file_path)
+        if archived_content is None:
+            click.echo(click.style(f"エラー: ファイル '{target_file_path}' が見つかりません。", fg="red"))
+            return False
+        click.echo(f"ℹ️ '{target_file_path.name}' をアーカイブから読み込みます。")
     
     click.echo(f"📖 ファイル '{target_file_path}' を読み込んで差分情報を解析します...")
     
     try:
-        content = target_file_path.read_text(encoding="utf-8")
-        # LLM出力の```json ... ```ブロックからJSON部分を抽出
-        match = re.search(r"```json\s*\n(.*?)\n```", content, re.DOTALL)
-        if match:
-            json_str = match.group(1)
+        if archived_content is None:
+            content = target_file_path.read_text(encoding="utf-8")
+            _stats_count(stats, "bytes_read", target_file_path.stat().st_size)
         else:
-            # ブロックがない場合は、ファイル全体をJSONとして解釈しようと試みる
-            json_str = content
-
-        # ノーブレークスペースを通常のスペースに置換
-        json_str = json_str.replace('\u00a0', ' ')
-
-        data = json.loads(json_str)
-        changes = data.get("changes", [])
-    except json.JSONDecodeError:
-        click.echo(click.style("エラー: ファイルのJSON形式が正しくありません。", fg="red"))
-        return
+            content = archived_content
+            _stats_count(stats, "bytes_read", len(content.encode("utf-8")))
+        _stats_lap(stats, "read")
+        # LLM出力の全てのJSONコードブロックを一回の走査で探し、changes の要素を1件ずつ解析する
+        changes, truncated, skipped = _parse_llm_output(content)
+        _stats_lap(stats, "parse")
+        _stats_count(stats, "changes", len(changes))
+    except json.JSONDecodeError as e:
+        click.echo(click.style(f"エラー: ファイルのJSON形式が正しくありません（{e.lineno}行目 {e.colno}文字目: {e.msg}）。", fg="red"))
+        return False
     except Exception as e:
         click.echo(click.style(f"エラー: ファイルの読み込み中に予期せぬ問題が発生しました: {e}", fg="red"))
-        return
+        return False
+
+    for line_no, e in skipped:
+        click.echo(click.style(f"警告: {line_no}行目からの JSON ブロックは形式が正しくないため読み飛ばします（{e.lineno}行目 {e.colno}文字目: {e.msg}）。", fg="yellow"))
+
+    # LLMの出力が途中で途切れている場合は、再出力を依頼すべき箇所を示す
+    for number, line_no, path_str in truncated:
+        if path_str:
+            click.echo(click.style(f"警告: {number}件目の変更（{path_str}、{line_no}行目）が途中で途切れているため、適用対象から除外します。", fg="yellow"))
+            click.echo(click.style(f"  LLMに「{path_str} 以降の変更を再出力してください」と依頼してください。", fg="yellow"))
+        else:
+            click.echo(click.style(f"警告: {line_no}行目で出力が途切れているため、{number}件目以降の変更が欠けている可能性があります。", fg="yellow"))
 
     if not changes:
         click.echo(click.style("警告: 適用する変更がJSON内に見つかりませんでした。", fg="yellow"))
-        return
+        return False
+
+    # 変更内容全体を先に検証し、問題があれば何も適用しない
+    # 一部だけを埋め込んだファイルは、マニフェストの記録から求める
+    pair = _find_pair(target_file_path)
+    errors = _validate_changes(changes, pair.get("partial") if pair else None)
+    _stats_lap(stats, "validate")
+    if errors:
+        click.echo(click.style("エラー: 変更内容に以下の問題があるため、何も適用せずに中断します。", fg="red"))
+        for message in errors:
+            click.echo(click.style(f"  - {message}", fg="red"))
+        return False
 
     click.echo("\n以下の変更が適用されます：")
     for change in changes:
@@ -362,59 +3329,85 @@ def apply(apply_file):
             click.echo(click.style(f"  [CREATE] {path}", fg="green"))
         elif op == "UPDATE":
             click.echo(click.style(f"  [UPDATE] {path}", fg="yellow"))
+        elif op == "PATCH":
+            click.echo(click.style(f"  [PATCH] {path}", fg="cyan"))
         elif op == "DELETE":
             click.echo(click.style(f"  [DELETE] {path}", fg="red"))
 
-    if not click.confirm("\n処理を続行しますか？"):
+    confirmed = click.confirm("\n処理を続行しますか？")
+    _stats_lap(stats, "confirm")
+    if not confirmed:
         click.echo("処理を中断しました。")
-        return
+        return False
 
     click.echo("\nパッチの適用を開始します...")
-    for change in changes:
-        op = change.get('operation')
-        path_str = change.get('file_path')
-        
-        if not op or not path_str:
-            click.echo(click.style("  - スキップ: 'operation'または'file_path'が不正です。", fg="yellow"))
-            continue
+    # すべての変更を一時ファイルに書き出してから、まとめて確定する
+    try:
+        plan, created_dirs = _stage_changes(changes)
+    except Exception as e:
+        click.echo(click.style(f"  ❌ エラーが発生したため、何も適用せずに中断します: {e}", fg="red"))
+        return False
 
-        file_path = Path(path_str)
-        
-        try:
-            if op == "create":
-                if file_path.exists():
-                    click.echo(click.style(f"  - 警告: 作成予定のファイル {path_str} は既に存在するためスキップします。", fg="yellow"))
-                    continue
-                file_path.parent.mkdir(parents=True, exist_ok=True)
-                file_path.write_text(change.get("content", ""), encoding="utf-8")
-                click.echo(click.style(f"  ✅ [CREATE] {path_str} を作成しました。", fg="green"))
-            
-            elif op == "update":
-                if not file_path.exists():
-                    click.echo(click.style(f"  - 警告: 更新予定のファイル {path_str} が見つからないため新規作成します。", fg="yellow"))
-                file_path.parent.mkdir(parents=True, exist_ok=True)
-                file_path.write_text(change.get("content", ""), encoding="utf-8")
-                click.echo(click.style(f"  ✅ [UPDATE] {path_str} を更新しました。", fg="green"))
-
-            elif op == "delete":
-                if file_path.exists():
-                    file_path.unlink()
-                    click.echo(click.style(f"  ✅ [DELETE] {path_str} を削除しました。", fg="green"))
-                else:
-                    click.echo(click.style(f"  - 警告: 削除予定のファイル {path_str} は存在しません。", fg="yellow"))
-            
-            else:
-                click.echo(click.style(f"  - 警告: 未知の操作 '{op}' のためスキップします。", fg="yellow"))
+    _stats_lap(stats, "stage")
+    _stats_count(stats, "bytes_written", sum(os.path.getsize(item["tmp"]) for item in plan if item["tmp"]))
 
-        except Exception as e:
-            click.echo(click.style(f"  ❌ [{op.upper()}] {path_str} の処理中にエラーが発生しました: {e}", fg="red"))
+    if not plan:
+        click.echo(click.style("\n適用する変更はありませんでした。", fg="yellow"))
+        return False
+
+    committed = _commit_changes(plan, created_dirs, target_file_path)
+    _stats_lap(stats, "commit")
+    if not committed:
+        click.echo(click.style("\nエラーが発生したため、すべての変更を取り消しました。", fg="red"))
+        return False
+    _set_pair_status(target_file_path, "applied")
+
+    click.echo(click.style("\nパッチの適用が完了しました。'promp apply --undo' で元に戻せます。", fg="green"))
+    return True
+
+
+@promp.command()
+@_with_stats
+@click.argument("apply_file", type=click.Path(dir_okay=False), required=False)
+@click.option("--undo", is_flag=True, help="直前の apply で適用した変更を元に戻します。")
+def apply(apply_file, undo):
+    """LLMが出力したJSON差分ファイルを適用する"""
+    stats = _current_stats()
+    if undo:
+        if apply_file is not None:
+            click.echo(click.style("エラー: --undo とファイルの指定は同時に使えません。", fg="red"))
+            return
+        _undo_last_apply()
+        _stats_lap(stats, "undo")
+        return
+
+    target_file_path = None
+
+    if apply_file is None:
+        click.echo(f"ℹ️ ファイルが指定されていないため、'{INPUT_DIR}/' 内の最新ファイルを検索します...")
+        target_file_path = _find_latest_input_file()
+        if not target_file_path:
+            return
+        click.echo(click.style(f"✅ 最新ファイル '{target_file_path}' を適用対象とします。", fg="green"))
+    else:
+        target_file_path = Path(apply_file)
 
-    click.echo(click.style("\nパッチの適用が完了しました。", fg="green"))
+    _apply_input_file(target_file_path, stats)
 
 
 @promp.command()
-def clear():
+@_with_stats
+@click.option("--keep", type=click.IntRange(min=0), help="新しい順に指定した回数分のプロンプトを残し、それより古いものを対象にします。")
+@click.option("--older-than", metavar="期間", callback=_parse_age_option, help="指定した期間（例: 30d, 12h, 90m）より古いプロンプトを対象にします。")
+@click.option("--archive", is_flag=True, help="対象のプロンプトを削除せず、圧縮アーカイブへ移動します（apply で引き続き読み込めます）。")
+def clear(keep, older_than, archive):
     """'.promp-in' と '.promp-out' ディレクトリを削除する"""
+    stats = _current_stats()
+    # 保持ポリシーが指定された場合は、古いプロンプトの組だけを削除（またはアーカイブ）する
+    if keep is not None or older_than is not None or archive:
+        _clear_pairs(keep, older_than, archive, stats)
+        return
+
     click.echo("一時ディレクトリのクリーンアップを開始します。")
 
     # 削除対象のディレクトリ
@@ -427,8 +3420,22 @@ def clear():
         click.echo(f"ℹ️ 削除対象のディレクトリ ({', '.join(dirs_to_delete)}) は見つかりませんでした。")
         return
 
+    # 統計情報を表示する場合のみ、削除するファイル数とバイト数を数える
+    if stats["enabled"]:
+        for dir_name in existing_dirs:
+            for dir_path, _, file_names in os.walk(dir_name):
+                for file_name in file_names:
+                    try:
+                        _stats_count(stats, "bytes_removed", os.path.getsize(os.path.join(dir_path, file_name)))
+                    except OSError:
+                        pass
+                _stats_count(stats, "files_removed", len(file_names))
+        _stats_lap(stats, "scan")
+
     click.echo(f"以下のディレクトリとその内容を全て削除します: {click.style(', '.join(existing_dirs), fg='red')}")
-    if not click.confirm("よろしいですか？"):
+    confirmed = click.confirm("よろしいですか？")
+    _stats_lap(stats, "confirm")
+    if not confirmed:
         click.echo("処理を中断しました。")
         return
     
@@ -440,9 +3447,289 @@ def clear():
             click.echo(click.style(f"✅ ディレクトリ '{dir_name}' を削除しました。", fg="green"))
         except Exception as e:
             click.echo(click.style(f"❌ エラー: '{dir_name}' の削除中にエラーが発生しました: {e}", fg="red"))
+    _stats_lap(stats, "remove")
 
     click.echo(click.style("\nクリーンアップが完了しました。", fg="green"))
 
 
+# --- 常駐モード（promp watch） ---
+WATCH_INTERVAL = 0.5
+# ポーリングで新しく追加されたファイルを見つけるために、ディレクトリを再走査する間隔（秒）
+WATCH_RESCAN_SECONDS = 5.0
+# 変更イベントを受け取ってから、続けて届くイベントをまとめて処理するまでの待ち時間（秒）
+WATCH_DEBOUNCE = 0.05
+# 変更イベントを無視するディレクトリ（.promp-in はポーリングで監視する）
+WATCH_IGNORED_DIRS = (GIT_DIR, INPUT_DIR, OUTPUT_DIR)
+WATCH_EVENT_TYPES = ("modified", "created", "deleted", "moved", "closed")
+
+
+def _start_change_observer(events):
+    """watchdog が使える場合は、カレントフォルダ以下の変更イベントを events（キュー）に積むオブザーバーを開始する
+
+    watchdog がない場合や、監視を開始できない場合（inotify の上限など）は None を返す。
+    """
+    if Observer is None:
+        return None
+    handler = FileSystemEventHandler()
+    handler.on_any_event = events.put
+    observer = Observer()
+    observer.daemon = True
+    try:
+        observer.schedule(handler, ".", recursive=True)
+        observer.start()
+    except OSError as e:
+        click.echo(click.style(f"警告: 変更イベントの監視を開始できないため、ポーリングで検出します: {e}", fg="yellow"))
+        return None
+    return observer
+
+
+def _watch_event_target(event, cache):
+    """変更イベントから、読み込み直すファイルのパスを返す。ディレクトリの再走査が必要な場合は True、無視する場合は None"""
+    if event.event_type not in WATCH_EVENT_TYPES:
+        return None
+    rel_paths = []
+    for path in (event.src_path, getattr(event, "dest_path", "")):
+        if not path:
+            continue
+        rel_path = Path(os.path.relpath(os.fsdecode(path))).as_posix()
+        if rel_path.split("/")[0] not in WATCH_IGNORED_DIRS:
+            rel_paths.append(rel_path)
+    if not rel_paths:
+        return None
+    if event.event_type in ("modified", "closed"):
+        if event.is_directory:
+            return None
+        if rel_paths[0] in cache:
+            return rel_paths[0]
+        # .gitignore が変わると、埋め込むファイルの集合が変わる
+        return True if os.path.basename(rel_paths[0]) == GITIGNORE_FILE else None
+    # ファイルの追加・削除・移動は、ディレクトリを再走査して反映する
+    return True
+
+
+def _wait_for_changes(events, cache, timeout):
+    """変更イベントを最大 timeout 秒待ち、(読み込み直すファイルのパスの集合, 再走査が必要か) を返す"""
+    dirty = set()
+    rescan = False
+    try:
+        event = events.get(timeout=timeout)
+    except queue.Empty:
+        return dirty, rescan
+    # 保存時に続けて届くイベントをまとめる
+    time.sleep(WATCH_DEBOUNCE)
+    while True:
+        target = _watch_event_target(event, cache)
+        if target is True:
+            rescan = True
+        elif target is not None:
+            dirty.add(target)
+        try:
+            event = events.get_nowait()
+        except queue.Empty:
+            return dirty, rescan
+
+
+def _watch_update(cache, file_paths, file_index, max_file_size):
+    """ファイルの (更新日時, サイズ) を確認し、変わったものだけを検査・再読み込みしてキャッシュを更新する
+
+    キャッシュの要素は {"signature", "content", "entry"}、埋め込めないファイルは {"signature", "skipped"}。
+    戻り値は、キャッシュが変わったかどうか。
+    """
+    changed = False
+    to_read = {}
+    for path_str in file_paths:
+        signature = _file_signature(path_str)
+        cached = cache.get(path_str)
+        if cached is not None and cached["signature"] == signature:
+            continue
+        if signature is None:
+            changed = cache.pop(path_str, None) is not None or changed
+            continue
+        changed = True
+        reason = _inspect_file(path_str, max_file_size)
+        if reason is None:
+            to_read[path_str] = signature
+            continue
+        if cached is None or cached.get("skipped") != reason:
+            click.echo(click.style(f"  - スキップ: {path_str}（{reason}）", fg="yellow"))
+        cache[path_str] = {"signature": signature, "skipped": reason}
+
+    if to_read:
+        for path_str, result, error in _iter_file_contents(list(to_read), file_index):
+            if error is not None:
+                click.echo(click.style(f"  - 読み込み失敗: {path_str} ({error})", fg="yellow"))
+                cache[path_str] = {"signature": to_read[path_str], "skipped": f"読み込み不可 ({error})"}
+                continue
+            content, entry = result
+            file_index[path_str] = entry
+            cache[path_str] = {"signature": to_read[path_str], "content": content, "entry": entry}
+    return changed
+
+
+def _watch_rescan(cache, file_patterns, exclude, file_index, max_file_size):
+    """ディレクトリを走査し直して、追加・削除されたファイルをキャッシュに反映する。戻り値はキャッシュが変わったかどうか"""
+    file_paths, _, _ = _collect_files(file_patterns, exclude)
+    removed = set(cache).difference(file_paths)
+    for path_str in removed:
+        del cache[path_str]
+    changed = _watch_update(cache, file_paths, file_index, max_file_size)
+    return changed or bool(removed)
+
+
+def _watch_new_pair(input_signatures, template):
+    """新しいタイムスタンプで、出力先のパスと入力用の空ファイルを用意する"""
+    Path(OUTPUT_DIR).mkdir(exist_ok=True)
+    Path(INPUT_DIR).mkdir(exist_ok=True)
+    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    # 同じ秒に適用が終わった場合に、適用済みの入力ファイルを上書きしないようにする
+    while (Path(INPUT_DIR) / f"in-{timestamp}.txt").exists():
+        time.sleep(0.2)
+        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    input_path = Path(INPUT_DIR) / f"in-{timestamp}.txt"
+    input_path.write_text("", encoding="utf-8")
+    input_signatures[str(input_path)] = _file_signature(input_path)
+    click.echo(click.style(f"LLMの出力を貼り付けるための空ファイル '{input_path}' を作成しました。", fg="green"))
+    return {
+        "timestamp": timestamp,
+        "template": template,
+        "output_path": Path(OUTPUT_DIR) / f"out-{timestamp}.txt",
+        "input_path": input_path,
+    }
+
+
+def _watch_rebuild(pair, segments, cache, index, started):
+    """キャッシュした内容だけからプロンプトを書き出し、インデックスとマニフェストに記録する"""
+    file_paths = sorted(path_str for path_str, item in cache.items() if "entry" in item)
+    file_contents = {path_str: (cache[path_str]["content"], cache[path_str]["entry"]) for path_str in file_paths}
+    output_path = pair["output_path"]
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    with tmp_path.open("w", encoding="utf-8") as out_f:
+        written = _render_template(out_f, segments, file_paths, index["files"], report=False, file_contents=file_contents)
+    # 書き出し途中のプロンプトが読まれないように、書き終えてから置き換える
+    os.replace(tmp_path, output_path)
+
+    index["runs"][pair["timestamp"]] = {path_str: index["files"][path_str]["hash"] for path_str in file_paths}
+    _save_file_index(index)
+    # 組は作成時と埋め込んだファイルが変わった時だけ記録し、内容の更新のたびにマニフェストへ追記しない
+    if written != pair.get("files"):
+        _record_pair(pair["template"], written, [output_path], pair["input_path"])
+        pair["files"] = written
+
+    file_section = _template_file_section(segments)
+    tokens = _template_tokens(segments) + sum(
+        _section_tokens(path_str, index["files"][path_str]["tokens"], file_section) for path_str in written
+    )
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    now = datetime.datetime.now().strftime("%H:%M:%S")
+    click.echo(f"🔄 {now} プロンプトを '{output_path}' に更新しました（{len(written)} ファイル、約{tokens:,} トークン、{elapsed_ms:.0f} ミリ秒）。")
+
+
+def _poll_input_files(input_signatures, pending):
+    """.promp-in の in-*.txt のうち、空でない内容が新たに書き込まれたファイルを返す
+
+    書き込み途中のファイルを解析しないように、(更新日時, サイズ) が前回の確認から変わっていないものだけを返す。
+    """
+    ready = []
+    for path_str in glob.glob(os.path.join(INPUT_DIR, "in-*.txt")):
+        signature = _file_signature(path_str)
+        if signature is None or signature == input_signatures.get(path_str):
+            pending.pop(path_str, None)
+            continue
+        if pending.get(path_str) != signature:
+            pending[path_str] = signature
+            continue
+        del pending[path_str]
+        input_signatures[path_str] = signature
+        if signature[1] > 0:
+            ready.append(Path(path_str))
+    return sorted(ready)
+
+
+@promp.command()
+@click.argument("file_patterns", nargs=-1, required=False)
+@click.option("-t", "--template", default="default", help="プロンプト作成時のテンプレート名を指定します。")
+@click.option("-e", "--exclude", multiple=True, help="除外するファイルパターンを指定します。ワイルドカード使用可。")
+@click.option("--max-file-size", default=DEFAULT_MAX_FILE_SIZE, show_default=True, callback=_parse_size_option, help="埋め込むファイルサイズの上限（例: 500KB, 2MB）。0 で無制限。")
+@click.option("--interval", type=click.FloatRange(min=0.05), default=WATCH_INTERVAL, show_default=True, help="変更を確認する間隔（秒）。")
+@click.option("--poll", is_flag=True, help="変更イベントを使わず、更新日時のポーリングだけで変更を検出します。")
+def watch(file_patterns, template, exclude, max_file_size, interval, poll):
+    """ファイルの変更を監視し、プロンプトを常に最新の状態に保つ（Ctrl+C で終了）"""
+    template_file = Path(TEMPLATE_DIR) / f"{template}.txt"
+    if not template_file.exists():
+        click.echo(click.style(f"エラー: テンプレート '{template_file}' が見つかりません。", fg="red"))
+        return
+    try:
+        segments = _load_template(template_file)
+    except ValueError as e:
+        click.echo(click.style(f"エラー: {e}", fg="red"))
+        return
+
+    # 対象ファイルの内容をメモリ上に読み込んでおき、以降は変更されたファイルだけを読み込み直す
+    started = time.perf_counter()
+    index = _load_file_index()
+    cache = {}
+    _watch_rescan(cache, file_patterns, exclude, index["files"], max_file_size)
+    click.echo(f"ℹ️ {sum('entry' in item for item in cache.values())}個のファイルを読み込みました。")
+
+    input_signatures = {path_str: _file_signature(path_str) for path_str in glob.glob(os.path.join(INPUT_DIR, "in-*.txt"))}
+    pending_inputs = {}
+    pair = _watch_new_pair(input_signatures, template)
+    _watch_rebuild(pair, segments, cache, index, started)
+
+    events = queue.Queue()
+    observer = None if poll else _start_change_observer(events)
+    if observer is not None:
+        click.echo("ℹ️ ファイルの変更イベントを監視しています。Ctrl+C で終了します。")
+    else:
+        click.echo(f"ℹ️ {interval}秒ごとにファイルの更新日時を確認しています。Ctrl+C で終了します。")
+    last_rescan = time.monotonic()
+    template_error = None
+    try:
+        while True:
+            if observer is not None:
+                dirty, rescan = _wait_for_changes(events, cache, interval)
+            else:
+                time.sleep(interval)
+                dirty, rescan = list(cache), time.monotonic() - last_rescan >= WATCH_RESCAN_SECONDS
+
+            started = time.perf_counter()
+            if rescan:
+                changed = _watch_rescan(cache, file_patterns, exclude, index["files"], max_file_size)
+                last_rescan = time.monotonic()
+            else:
+                changed = _watch_update(cache, dirty, index["files"], max_file_size)
+
+            # テンプレート（インクルード先を含む）が変わった場合もプロンプトを書き直す
+            try:
+                current_segments = _load_template(template_file)
+                template_error = None
+            except (OSError, ValueError) as e:
+                if str(e) != template_error:
+                    template_error = str(e)
+                    click.echo(click.style(f"エラー: テンプレートを読み込めないため、以前の内容を使います: {e}", fg="red"))
+                current_segments = segments
+            if current_segments is not segments:
+                segments = current_segments
+                changed = True
+            if changed:
+                _watch_rebuild(pair, segments, cache, index, started)
+
+            for input_path in _poll_input_files(input_signatures, pending_inputs):
+                click.echo(click.style(f"\n✅ '{input_path}' にLLMの出力が書き込まれました。", fg="green"))
+                if not _apply_input_file(input_path, _current_stats()):
+                    continue
+                # 適用した変更を読み込み直し、次のやり取り用のプロンプトと入力ファイルを用意する
+                pair = _watch_new_pair(input_signatures, template)
+                started = time.perf_counter()
+                _watch_rescan(cache, file_patterns, exclude, index["files"], max_file_size)
+                _watch_rebuild(pair, segments, cache, index, started)
+    except KeyboardInterrupt:
+        click.echo("\n監視を終了しました。")
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+
 if __name__ == '__main__':
     promp()
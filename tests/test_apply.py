@@ -0,0 +1,228 @@
+"""promp apply の変更の適用（patch のハンク適用・一時ファイルへの書き出し）のテスト"""
+import os
+
+import pytest
+from click.testing import CliRunner
+
+import promp
+
+
+def _stage_and_read(tmp_path, monkeypatch, original, change):
+    """ファイルを用意して変更を一時ファイルに書き出し、書き出した内容（bytes）を返す"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / change["file_path"]).write_bytes(original)
+    plan, _ = promp._stage_changes([change])
+    try:
+        with open(plan[0]["tmp"], "rb") as f:
+            return f.read()
+    finally:
+        promp._discard_staged(plan, [])
+
+
+def test_patch_keeps_crlf_line_endings(tmp_path, monkeypatch):
+    change = {"file_path": "a.txt", "operation": "patch", "diff": "@@ -1,3 +1,3 @@\n a\n-b\n+B\n c\n"}
+    assert _stage_and_read(tmp_path, monkeypatch, b"a\r\nb\r\nc\r\n", change) == b"a\r\nB\r\nc\r\n"
+
+
+def test_patch_keeps_lf_line_endings(tmp_path, monkeypatch):
+    change = {"file_path": "a.txt", "operation": "patch", "diff": "@@ -1,3 +1,3 @@\n a\n-b\n+B\n c\n"}
+    assert _stage_and_read(tmp_path, monkeypatch, b"a\nb\nc\n", change) == b"a\nB\nc\n"
+
+
+def test_update_uses_os_line_endings(tmp_path, monkeypatch):
+    change = {"file_path": "a.txt", "operation": "update", "content": "x\ny\n"}
+    expected = "x\ny\n".replace("\n", os.linesep).encode("utf-8")
+    assert _stage_and_read(tmp_path, monkeypatch, b"old\r\n", change) == expected
+
+
+def test_detect_newline():
+    assert promp._detect_newline("a\r\nb\n") == "\r\n"
+    assert promp._detect_newline("a\nb\r\n") == "\n"
+    assert promp._detect_newline("") == os.linesep
+
+
+def test_validate_rejects_update_of_partially_embedded_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    changes = [
+        {"file_path": "src/c.py", "operation": "update", "content": "x\n"},
+        {"file_path": "./src/d.py", "operation": "update", "content": "x\n"},
+        {"file_path": "src/e.py", "operation": "patch", "diff": "@@\n-a\n+b\n"},
+    ]
+    errors = promp._validate_changes(changes, {"src/c.py": "head", "src/d.py": "slice", "src/e.py": "comments"})
+    assert len(errors) == 2
+    assert errors[0].startswith("src/c.py:") and "patch" in errors[0]
+    assert errors[1].startswith("./src/d.py:")
+
+
+# --- _apply_unified_diff ---
+def test_apply_unified_diff_simple_hunk():
+    patched, count = promp._apply_unified_diff("a\nb\nc\n", "@@ -1,3 +1,3 @@\n a\n-b\n+B\n c\n")
+    assert (patched, count) == ("a\nB\nc\n", 1)
+
+
+def test_apply_unified_diff_ignores_wrong_line_numbers():
+    original = "".join(f"line{i}\n" for i in range(1, 21))
+    patched, _ = promp._apply_unified_diff(original, "@@ -2,3 +2,3 @@\n line14\n-line15\n+LINE15\n line16\n")
+    assert "LINE15\n" in patched and "line15\n" not in patched
+
+
+def test_apply_unified_diff_prefers_match_nearest_to_line_number():
+    original = "x\nsame\nx\nfiller\nx\nsame\nx\n"
+    patched, _ = promp._apply_unified_diff(original, "@@ -6,1 +6,1 @@\n-same\n+changed\n")
+    assert patched == "x\nsame\nx\nfiller\nx\nchanged\nx\n"
+
+
+def test_apply_unified_diff_tolerates_whitespace_differences():
+    original = "def f():\n    return  1   \n"
+    patched, _ = promp._apply_unified_diff(original, "@@\n def f():\n-  return 1\n+    return 2\n")
+    assert patched == "def f():\n    return 2\n"
+
+
+def test_apply_unified_diff_keeps_file_side_context_lines():
+    original = "a  \nb\n"
+    patched, _ = promp._apply_unified_diff(original, "@@ -1,2 +1,2 @@\n a\n-b\n+B\n")
+    assert patched == "a  \nB\n"
+
+
+def test_apply_unified_diff_insert_only_hunk():
+    patched, _ = promp._apply_unified_diff("a\nb\n", "@@ -1,0 +2,1 @@\n+inserted\n")
+    assert patched == "a\ninserted\nb\n"
+
+
+def test_apply_unified_diff_insert_only_hunk_without_line_numbers_appends():
+    patched, _ = promp._apply_unified_diff("a\nb\n", "@@\n+c\n")
+    assert patched == "a\nb\nc\n"
+
+
+def test_apply_unified_diff_multiple_hunks():
+    original = "a\nb\nc\nd\ne\n"
+    diff = "@@ -1,2 +1,2 @@\n-a\n+A\n b\n@@ -4,2 +4,2 @@\n d\n-e\n+E\n"
+    patched, count = promp._apply_unified_diff(original, diff)
+    assert (patched, count) == ("A\nb\nc\nd\nE\n", 2)
+
+
+def test_apply_unified_diff_failing_hunk_raises():
+    with pytest.raises(ValueError, match="ハンク2/2を適用できません"):
+        promp._apply_unified_diff("a\nb\n", "@@\n-a\n+A\n@@\n-missing\n+x\n")
+
+
+def test_apply_unified_diff_rejects_text_without_hunks():
+    with pytest.raises(ValueError, match="ハンクが見つかりません"):
+        promp._apply_unified_diff("a\n", "not a diff")
+
+
+def test_apply_unified_diff_without_trailing_newline():
+    patched, _ = promp._apply_unified_diff("a\nb", "@@ -1,2 +1,2 @@\n a\n-b\n+B\n\\ No newline at end of file\n")
+    assert patched == "a\nB"
+
+
+def test_apply_unified_diff_crlf_diff_text():
+    patched, _ = promp._apply_unified_diff("a\nb\nc\n", "@@ -1,3 +1,3 @@\r\n a\r\n-b\r\n+B\r\n c\r\n")
+    assert patched == "a\nB\nc\n"
+
+
+
+def test_apply_unified_diff_keeps_form_feed_and_line_separator():
+    # 改ページや U+2028 を含む行も1行として扱う
+    original = "a\n\x0c\nb\u2028c\nd\n"
+    patched, _ = promp._apply_unified_diff(original, "@@ -1,4 +1,4 @@\n a\n \x0c\n-b\u2028c\n+B\u2028C\n d\n")
+    assert patched == "a\n\x0c\nB\u2028C\nd\n"
+
+
+# --- 変更の確定と取り消し ---
+def _snapshot(root):
+    """フォルダ内のファイル（.promp-in を除く）の {パス: 内容} を返す"""
+    return {
+        path.relative_to(root).as_posix(): path.read_bytes()
+        for path in root.rglob("*")
+        if path.is_file() and promp.INPUT_DIR not in path.relative_to(root).parts
+    }
+
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "a.txt").write_bytes(b"a\r\n")
+    (tmp_path / "b.txt").write_bytes(b"b\n")
+    (tmp_path / "c.txt").write_bytes(b"c\n")
+    return tmp_path
+
+
+CHANGES = [
+    {"file_path": "a.txt", "operation": "update", "content": "A\n"},
+    {"file_path": "b.txt", "operation": "patch", "diff": "@@\n-b\n+B\n"},
+    {"file_path": "c.txt", "operation": "delete"},
+    {"file_path": "new/d.txt", "operation": "create", "content": "d\n"},
+]
+
+
+def _commit(changes, source="in.txt"):
+    plan, created_dirs = promp._stage_changes(changes)
+    return promp._commit_changes(plan, created_dirs, source)
+
+
+def test_failure_during_commit_restores_tree(files, monkeypatch):
+    before = _snapshot(files)
+    commit_one = promp._commit_one
+
+    def failing_commit_one(item, backup_path):
+        if item["path"] == "c.txt":
+            raise OSError("書き込みエラー")
+        commit_one(item, backup_path)
+
+    monkeypatch.setattr(promp, "_commit_one", failing_commit_one)
+    assert _commit(CHANGES) is False
+    assert _snapshot(files) == before
+    assert not (files / "new").exists()
+    assert not (files / promp.INPUT_DIR / promp.UNDO_DIR).exists()
+
+
+def test_rollback_continues_after_an_entry_fails(files, monkeypatch, capsys):
+    commit_one = promp._commit_one
+    rollback_entry = promp._rollback_entry
+
+    def failing_commit_one(item, backup_path):
+        if item["path"] == "c.txt":
+            raise OSError("書き込みエラー")
+        commit_one(item, backup_path)
+
+    def failing_rollback_entry(entry, undo_path):
+        if entry["path"] == "b.txt":
+            raise OSError("復元エラー")
+        rollback_entry(entry, undo_path)
+
+    monkeypatch.setattr(promp, "_commit_one", failing_commit_one)
+    monkeypatch.setattr(promp, "_rollback_entry", failing_rollback_entry)
+    assert _commit(CHANGES) is False
+    # b.txt 以外は元に戻り、b.txt のバックアップは残す
+    assert (files / "a.txt").read_bytes() == b"a\r\n"
+    assert (files / "c.txt").read_bytes() == b"c\n"
+    assert not (files / "new" / "d.txt").exists()
+    output = capsys.readouterr().out
+    assert "元に戻せませんでした" in output and "b.txt: 復元エラー" in output
+    assert (files / promp.INPUT_DIR / promp.UNDO_DIR / promp.UNDO_BACKUP_DIR / "1").read_bytes() == b"b\n"
+
+
+@pytest.mark.parametrize(
+    "changes",
+    [
+        [{"file_path": "new/d.txt", "operation": "create", "content": "d\n"}],
+        [{"file_path": "c.txt", "operation": "delete"}],
+        # 名前の変更（元のファイルの削除と新しいファイルの作成）
+        [
+            {"file_path": "b.txt", "operation": "delete"},
+            {"file_path": "renamed/b.txt", "operation": "create", "content": "b\n"},
+        ],
+        CHANGES,
+    ],
+    ids=["create", "delete", "rename", "mixed"],
+)
+def test_undo_restores_tree(files, changes):
+    before = _snapshot(files)
+    assert _commit(changes) is True
+    assert _snapshot(files) != before
+    result = CliRunner().invoke(promp.promp, ["apply", "--undo"], input="y\n")
+    assert result.exit_code == 0, result.output
+    assert _snapshot(files) == before
+    assert not (files / "new").exists() and not (files / "renamed").exists()
+    assert not (files / promp.INPUT_DIR / promp.UNDO_DIR).exists()
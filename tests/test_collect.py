@@ -0,0 +1,103 @@
+"""promp out のファイル収集（.gitignore 対応の枝刈りディレクトリ走査）のテスト"""
+import glob
+import os
+import posixpath
+
+import pytest
+
+import promp
+
+FILES = (
+    "README.md",
+    "main.py",
+    "notes.txt",
+    "src/app.py",
+    "src/util.py",
+    "src/data.txt",
+    "src/pkg/deep/mod.py",
+    "src/pkg/deep/readme.md",
+    "docs/index.md",
+    ".hidden/secret.py",
+    "src/.env.py",
+)
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    """テスト用のファイルツリーを作成し、カレントフォルダにする"""
+    for path_str in FILES:
+        path = tmp_path / path_str
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("x\n", encoding="utf-8")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def _write(path_str, text):
+    os.makedirs(os.path.dirname(path_str) or ".", exist_ok=True)
+    with open(path_str, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def _glob_files(pattern):
+    return sorted(
+        posixpath.normpath(path_str.replace(os.sep, "/"))
+        for path_str in glob.glob(pattern, recursive=True)
+        if os.path.isfile(path_str)
+    )
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    ["**/*.py", "*.md", "src/*.py", "src/**", "./**/*.txt", "src/**/deep/*", "**/*.md", ".hidden/*.py", "src/.*.py", "main.py"],
+)
+def test_matches_glob_without_ignore_rules(tree, pattern):
+    files, ignored, excluded = promp._collect_files([pattern], ())
+    assert files == _glob_files(pattern)
+    assert (ignored, excluded) == (0, 0)
+
+
+def test_multiple_patterns_in_one_walk(tree):
+    files, _, _ = promp._collect_files(["*.md", "src/*.py", "src/*.py"], ())
+    assert files == sorted(set(_glob_files("*.md")) | set(_glob_files("src/*.py")))
+
+
+def test_nested_gitignore_and_info_exclude(tree):
+    _write(".gitignore", "*.txt\n!src/data.txt\n")
+    _write("src/.gitignore", "pkg/\n")
+    _write("src/util.py.bak", "x\n")
+    _write(".git/info/exclude", "docs/\n")
+    files, ignored, _ = promp._collect_files(["**/*"], ())
+    assert files == [
+        "README.md",
+        "main.py",
+        "src/app.py",
+        "src/data.txt",
+        "src/util.py",
+        "src/util.py.bak",
+    ]
+    # notes.txt、src/pkg/、docs/ の3つ（無視したディレクトリの中には降りない）
+    assert ignored == 3
+
+
+def test_nested_gitignore_applies_only_below_its_directory(tree):
+    _write("src/.gitignore", "*.md\n")
+    files, _, _ = promp._collect_files(["**/*.md"], ())
+    assert files == ["README.md", "docs/index.md"]
+
+
+def test_exclude_patterns_prune_directories(tree):
+    files, _, excluded = promp._collect_files(["**/*.py"], ["src/pkg/", "main.py"])
+    assert files == ["src/app.py", "src/util.py"]
+    assert excluded == 2
+
+
+def test_git_directory_is_never_walked(tree):
+    _write(".git/config.py", "x\n")
+    files, _, _ = promp._collect_files([".git/*.py", "**/*.py"], ())
+    assert ".git/config.py" not in files
+
+
+def test_by_pattern_reports_matching_pattern_numbers(tree):
+    matched, _, _ = promp._collect_files(["src/*.py", "**/app.py"], (), by_pattern=True)
+    assert matched == {"src/app.py": {0, 1}, "src/util.py": {0}}
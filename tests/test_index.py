@@ -0,0 +1,74 @@
+"""ファイルインデックス（.promp-out/index.json）の保存と読み込みのテスト"""
+import json
+from pathlib import Path
+
+import pytest
+
+import promp
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for n in range(200):
+        (tmp_path / f"f{n:03}.txt").write_text(f"{n}\n", encoding="utf-8")
+    return tmp_path
+
+
+def _entry(path_str):
+    return promp._index_file(path_str)
+
+
+def test_runs_round_trip(project):
+    index = promp._load_file_index()
+    paths = sorted(path.name for path in project.glob("*.txt"))
+    for path_str in paths:
+        index["files"][path_str] = _entry(path_str)
+    old_hashes = {path_str: index["files"][path_str]["hash"] for path_str in paths}
+    # 削除したファイルはファイルの記録がなく、スナップショットだけに残る
+    old_hashes["deleted.txt"] = "0" * 32
+    index["runs"]["20240101-000000"] = dict(old_hashes)
+    # 一部のファイルを変更し、一部だけを含むスナップショットを追加する
+    for path_str in paths[10:20]:
+        Path(path_str).write_text("changed\n", encoding="utf-8")
+        index["files"][path_str] = _entry(path_str)
+    index["runs"]["20240102-000000"] = {path_str: index["files"][path_str]["hash"] for path_str in paths[::3]}
+    runs = {timestamp: dict(snapshot) for timestamp, snapshot in index["runs"].items()}
+    promp._save_file_index(index)
+
+    loaded = promp._load_file_index()
+    assert loaded["runs"] == runs
+    assert loaded["runs"]["20240101-000000"] == old_hashes
+    assert loaded["files"] == index["files"]
+
+
+def test_saved_runs_do_not_repeat_paths_and_hashes(project):
+    index = promp._load_file_index()
+    paths = sorted(path.name for path in project.glob("*.txt"))
+    for path_str in paths:
+        index["files"][path_str] = _entry(path_str)
+    for day in range(1, 21):
+        index["runs"][f"202401{day:02}-000000"] = {path_str: index["files"][path_str]["hash"] for path_str in paths}
+    promp._save_file_index(index)
+    data = json.loads((Path(promp.OUTPUT_DIR) / promp.INDEX_FILE).read_text(encoding="utf-8"))
+    # 変更のないスナップショットは、番号の範囲1つだけになる
+    assert all(run == {"ranges": [[0, len(paths)]], "changed": []} for run in data["runs"].values())
+    assert data["extra_paths"] == []
+
+
+def test_loads_previous_format(project):
+    entry = _entry("f000.txt")
+    data = {"files": {"f000.txt": entry}, "runs": {"20240101-000000": {"f000.txt": entry["hash"]}}}
+    Path(promp.OUTPUT_DIR).mkdir()
+    (Path(promp.OUTPUT_DIR) / promp.INDEX_FILE).write_text(json.dumps(data), encoding="utf-8")
+    assert promp._load_file_index() == data
+
+
+def test_fresh_entry_is_not_opened(project, monkeypatch):
+    entry = _entry("f000.txt")
+
+    def fail_open(*args, **kwargs):
+        raise AssertionError("ファイルを開きました")
+
+    monkeypatch.setattr("builtins.open", fail_open)
+    assert promp._index_file("f000.txt", entry) is entry
@@ -0,0 +1,81 @@
+"""プロンプトの履歴（manifest.jsonl と latest.json）の記録のテスト"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+import promp
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "a.py").write_text("a = 1\n", encoding="utf-8")
+    return tmp_path
+
+
+def _manifest_lines():
+    return (Path(promp.OUTPUT_DIR) / promp.MANIFEST_FILE).read_text(encoding="utf-8").splitlines()
+
+
+@pytest.mark.parametrize(
+    "path_str, expected",
+    [
+        (".promp-in/in-20240101-120000.txt", "20240101-120000"),
+        ("in-20240101-120000-review.txt", "20240101-120000-review"),
+        ("out-20240101-120000.txt", None),
+        ("in-.txt", None),
+        ("llm-output.json", None),
+        ("in-20240101-120000.md", None),
+    ],
+)
+def test_pair_id_accepts_only_input_file_names(path_str, expected):
+    assert promp._pair_id(path_str) == expected
+
+
+def test_set_pair_status_ignores_unknown_inputs(project):
+    output_path = Path(promp.OUTPUT_DIR) / "out-20240101-120000.txt"
+    output_path.parent.mkdir()
+    output_path.write_text("", encoding="utf-8")
+    promp._record_pair("default", ["a.py"], [output_path], "in-20240101-120000.txt")
+    before = _manifest_lines()
+    promp._set_pair_status("in-20231231-000000.txt", "applied")
+    promp._set_pair_status("llm-output.txt", "applied")
+    assert _manifest_lines() == before
+    promp._set_pair_status("in-20240101-120000.txt", "applied")
+    assert len(_manifest_lines()) == len(before) + 1
+    assert promp._load_latest_pair()[1]["status"] == "applied"
+
+
+def test_watch_records_pair_only_when_file_set_changes(project):
+    segments = promp._compile_template("{existing_files}\n", promp.TEMPLATE_DIR, [])
+    index = promp._load_file_index()
+    cache = {}
+    promp._watch_rescan(cache, ["*.py"], (), index["files"], 0)
+    pair = promp._watch_new_pair({}, "default")
+    promp._watch_rebuild(pair, segments, cache, index, time.perf_counter())
+    assert len(_manifest_lines()) == 1
+
+    # 内容だけの変更では追記しない
+    (project / "a.py").write_text("a = 20\n", encoding="utf-8")
+    promp._watch_update(cache, ["a.py"], index["files"], 0)
+    promp._watch_rebuild(pair, segments, cache, index, time.perf_counter())
+    assert len(_manifest_lines()) == 1
+    assert "a = 20" in pair["output_path"].read_text(encoding="utf-8")
+
+    # ファイルが増えた場合は記録し直す
+    (project / "b.py").write_text("b = 1\n", encoding="utf-8")
+    promp._watch_rescan(cache, ["*.py"], (), index["files"], 0)
+    promp._watch_rebuild(pair, segments, cache, index, time.perf_counter())
+    assert len(_manifest_lines()) == 2
+    assert promp._load_latest_pair()[1]["files"] == ["a.py", "b.py"]
+
+
+def test_concurrent_atomic_writes_do_not_collide(tmp_path):
+    path = tmp_path / "index.json"
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda n: promp._write_json_atomic(path, {"n": n, "data": "x" * 100000}), range(32)))
+    assert promp._read_json_dict(path)["n"] in range(32)
+    # 一時ファイルを残さない
+    assert [p.name for p in tmp_path.iterdir()] == ["index.json"]
@@ -0,0 +1,95 @@
+"""promp out のプロンプトの書き出し（削減・トークン数の見積もり）のテスト"""
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+import promp
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """テンプレートだけを置いたプロジェクトを作成し、カレントフォルダにする"""
+    template_dir = tmp_path / promp.TEMPLATE_DIR
+    template_dir.mkdir()
+    (template_dir / "default.txt").write_text("指示\n{existing_files}\n", encoding="utf-8")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def _write(path_str, text):
+    path = Path(path_str)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text, encoding="utf-8")
+
+
+def _run_out(*args):
+    result = CliRunner().invoke(promp.promp, ["out", *args])
+    assert result.exit_code == 0, result.output
+    return result
+
+
+def _latest_pair():
+    """直前のプロンプトの組と、1つ目の出力ファイルの内容を返す"""
+    _, pair = promp._load_latest_pair()
+    output_name = next(iter(pair["outputs"]))
+    return pair, (Path(promp.OUTPUT_DIR) / output_name).read_text(encoding="utf-8")
+
+
+def test_reduced_file_header_and_manifest_agree(project):
+    _write("src/a.py", "x = 1  # 初期値\ny = 2\n")
+    _write("src/b.py", "z = 3\n")
+    _run_out("src/*.py", "--reduce", "comments:src/a.py", "--reduce", "comments:src/b.py")
+    pair, prompt = _latest_pair()
+    # 内容が変わったファイルだけヘッダーに明記し、update を拒否する対象として記録する
+    assert "---- src/a.py（コメントを削除した内容。変更は patch で行ってください） ----\nx = 1\ny = 2\n" in prompt
+    assert "---- src/b.py ----\nz = 3\n" in prompt
+    assert pair["partial"] == {"src/a.py": "comments"}
+
+
+def test_head_reduction_is_labelled(project):
+    _write("data.txt", "".join(f"{n}\n" for n in range(10)))
+    _run_out("data.txt", "--reduce", "head=3:data.txt")
+    pair, prompt = _latest_pair()
+    assert "---- data.txt（先頭の行のみ。変更は patch で行ってください） ----\n0\n1\n2\n" in prompt
+    assert pair["partial"] == {"data.txt": "head"}
+    errors = promp._validate_changes([{"file_path": "data.txt", "operation": "update", "content": ""}], pair["partial"])
+    assert len(errors) == 1
+
+
+def _make_sources(count):
+    """コメント・重複・アウトラインの対象を含む Python ファイルを作成する"""
+    for n in range(count):
+        body = "".join(f"def f{i}(x):  # 関数{i}\n    return x + {i}\n\n" for i in range(n % 7 + 1))
+        _write(f"src/m{n:02}.py", f'"""モジュール{n}"""\n' + body)
+    _write("src/copy.py", Path("src/m03.py").read_text(encoding="utf-8"))
+
+
+@pytest.mark.parametrize("fenced", [False, True])
+def test_split_parts_stay_within_max_tokens(project, fenced):
+    if fenced:
+        (project / promp.TEMPLATE_DIR / "default.txt").write_text("指示\n{existing_files:fenced}\n", encoding="utf-8")
+    _make_sources(60)
+    max_tokens = 1500
+    _run_out("src/*.py", "--max-tokens", str(max_tokens), "--reduce", "comments:src/m1*.py", "--outline", "src/m2*.py")
+    _, pair = promp._load_latest_pair()
+    assert len(pair["outputs"]) > 1
+    for output_name in pair["outputs"]:
+        prompt = (Path(promp.OUTPUT_DIR) / output_name).read_text(encoding="utf-8")
+        assert promp._estimate_tokens(prompt) <= max_tokens, output_name
+
+
+def test_summary_total_includes_headers(project):
+    _make_sources(6)
+    result = _run_out("src/*.py")
+    _, prompt = _latest_pair()
+    total = int(result.output.split("合計: ")[1].split(" トークン")[0].replace(",", ""))
+    # ヘッダーと区切りの改行を含めて数える（部分ごとに切り上げるため、全体をまとめた見積もり以上になる）
+    assert total >= promp._estimate_tokens(prompt)
+    assert total - promp._estimate_tokens(prompt) <= 3 * 7
+
+
+def test_duplicate_estimate_ignores_views():
+    index = {path_str: {"hash": "h", "size": 1000} for path_str in ("a.py", "b.py", "c.py")}
+    # 書き出し時と同様に、アウトラインの a.py は重複の元にしない
+    assert promp._find_duplicates(["a.py", "b.py", "c.py"], index, {"a.py": ("outline", None)}) == {"c.py": "b.py"}
@@ -0,0 +1,61 @@
+"""promp out --outline の Python のアウトラインのテスト"""
+import ast
+
+import promp
+
+
+def test_keeps_imports_signatures_and_docstrings():
+    source = (
+        '"""モジュール"""\n'
+        "import os\n"
+        "LIMIT = 10\n"
+        "\n"
+        "@decorator\n"
+        "def f(x):\n"
+        '    """関数"""\n'
+        "    return x\n"
+        "\n"
+        "class C:\n"
+        "    def m(self):\n"
+        "        pass\n"
+    )
+    assert promp._python_outline(source) == (
+        '"""モジュール"""\n'
+        "import os\n"
+        "LIMIT = 10\n"
+        "\n"
+        "@decorator\n"
+        "def f(x):\n"
+        '    """関数"""\n'
+        "    ...\n"
+        "\n"
+        "class C:\n"
+        "    def m(self):\n"
+        "        ...\n"
+    )
+
+
+def test_multiline_signature_with_body_on_closing_line():
+    source = (
+        "def f(a,\n"
+        "      b='あ',\n"
+        "      c=None) -> int: return a + b\n"
+        "\n"
+        "class D(Base,\n"
+        "        metaclass=Meta): x = 1\n"
+        "\n"
+        "def g(): return 1\n"
+    )
+    outline = promp._python_outline(source)
+    assert outline == (
+        "def f(a,\n"
+        "      b='あ',\n"
+        "      c=None) -> int: ...\n"
+        "\n"
+        "class D(Base,\n"
+        "        metaclass=Meta): ...\n"
+        "\n"
+        "def g(): return 1\n"
+    )
+    # アウトライン自体も Python として解析できる
+    ast.parse(outline)
@@ -0,0 +1,124 @@
+"""promp apply の LLM 出力の解析（JSON ブロックの走査）のテスト"""
+import json
+
+import pytest
+
+import promp
+
+
+def _paths(changes):
+    return [change["file_path"] for change in changes]
+
+
+def test_single_json_block():
+    text = 'はい。\n```json\n{"changes": [{"file_path": "a.py", "operation": "delete"}]}\n```\n以上です。'
+    changes, truncated, _ = promp._parse_llm_output(text)
+    assert changes == [{"file_path": "a.py", "operation": "delete"}]
+    assert truncated == []
+
+
+def test_multiple_blocks_are_merged_in_order():
+    text = (
+        '```json\n{"changes": [{"file_path": "a.py", "operation": "delete"}]}\n```\n'
+        "続きです。\n"
+        '```json\n{"changes": [{"file_path": "b.py", "operation": "delete"},'
+        ' {"file_path": "c.py", "operation": "delete"}]}\n```\n'
+    )
+    changes, truncated, _ = promp._parse_llm_output(text)
+    assert _paths(changes) == ["a.py", "b.py", "c.py"]
+    assert truncated == []
+
+
+def test_bare_fence_without_language_tag():
+    text = '```\n{"changes": [{"file_path": "a.py", "operation": "delete"}]}\n```\n'
+    changes, _, _ = promp._parse_llm_output(text)
+    assert _paths(changes) == ["a.py"]
+
+
+def test_bare_fence_that_is_not_json_is_ignored():
+    text = '```\nprint("hello")\n```\n```json\n{"changes": [{"file_path": "a.py", "operation": "delete"}]}\n```\n'
+    changes, _, _ = promp._parse_llm_output(text)
+    assert _paths(changes) == ["a.py"]
+
+
+def test_crlf_line_endings():
+    text = '```json\r\n{\r\n  "changes": [\r\n    {"file_path": "a.py", "operation": "create", "content": "x\\n"}\r\n  ]\r\n}\r\n```\r\n'
+    changes, truncated, _ = promp._parse_llm_output(text)
+    assert changes == [{"file_path": "a.py", "operation": "create", "content": "x\n"}]
+    assert truncated == []
+
+
+def test_no_fence_falls_back_to_first_brace():
+    changes, _, _ = promp._parse_llm_output('結果: {"changes": [{"file_path": "a.py", "operation": "delete"}]}')
+    assert _paths(changes) == ["a.py"]
+
+
+def test_no_break_spaces_are_replaced():
+    text = '```json\n{\n\u00a0\u00a0"changes":\u00a0[{"file_path": "a.py", "operation": "delete"}]}\n```\n'
+    changes, _, _ = promp._parse_llm_output(text)
+    assert _paths(changes) == ["a.py"]
+
+
+def test_truncated_final_change_is_reported():
+    text = (
+        "```json\n"
+        "{\n"
+        '  "changes": [\n'
+        '    {"file_path": "a.py", "operation": "delete"},\n'
+        '    {"file_path": "b.py", "operation": "update", "content": "def f():\n'
+        "        return 1\n"
+    )
+    changes, truncated, _ = promp._parse_llm_output(text)
+    assert _paths(changes) == ["a.py"]
+    assert truncated == [(2, 5, "b.py")]
+
+
+def test_malformed_block_is_skipped():
+    text = (
+        "例:\n```json\n{\"changes\": [{\"file_path\": \"x.py\", \"operation\": \"delete\"}, {oops}]}\n```\n"
+        '```json\n{"changes": [{"file_path": "a.py", "operation": "delete"}]}\n```\n'
+    )
+    changes, truncated, skipped = promp._parse_llm_output(text)
+    # 壊れたブロックは、解析できた変更も含めて除く
+    assert _paths(changes) == ["a.py"]
+    assert truncated == []
+    assert [line_no for line_no, _ in skipped] == [3]
+
+
+def test_block_without_changes_is_ignored():
+    text = '```json\n{"name": "example"}\n```\n```json\n{"changes": [{"file_path": "a.py", "operation": "delete"}]}\n```\n'
+    changes, _, skipped = promp._parse_llm_output(text)
+    assert _paths(changes) == ["a.py"]
+    assert skipped == []
+
+
+def test_only_malformed_blocks_raise():
+    with pytest.raises(json.JSONDecodeError):
+        promp._parse_llm_output('```json\n{"changes": [oops]}\n```\n')
+
+
+def test_jsonc_comments_are_ignored():
+    text = (
+        "```jsonc\n"
+        "{\n"
+        "  // 変更の一覧\n"
+        '  "changes": [\n'
+        '    {"file_path": "a.py", /* 削除 */ "operation": "delete"},\n'
+        '    {"file_path": "b.py", "operation": "create", "content": "url = \\"http://example.com\\"  // 残す\\n"}\n'
+        "  ]\n"
+        "}\n"
+        "```\n"
+    )
+    changes, truncated, skipped = promp._parse_llm_output(text)
+    assert changes == [
+        {"file_path": "a.py", "operation": "delete"},
+        {"file_path": "b.py", "operation": "create", "content": 'url = "http://example.com"  // 残す\n'},
+    ]
+    assert (truncated, skipped) == ([], [])
+
+
+def test_jsonc_truncation_keeps_line_numbers():
+    text = '```jsonc\n{\n  /* 一覧 */\n  "changes": [\n    {"file_path": "a.py", "operation": "update", "content": "x\n'
+    changes, truncated, _ = promp._parse_llm_output(text)
+    assert changes == []
+    assert truncated == [(1, 5, "a.py")]
@@ -0,0 +1,46 @@
+"""promp out --reduce のコメントの削除のテスト"""
+import pytest
+
+import promp
+
+
+@pytest.mark.parametrize(
+    "path_str, source, expected",
+    [
+        # Python: 文字列・docstring 内の # は残す
+        ("a.py", 'x = "#1"  # 番号\n# 行全体\ny = 2#末尾\n', 'x = "#1"\ny = 2\n'),
+        ("a.py", '"""# 見出し"""\n', '"""# 見出し"""\n'),
+        # シェル: シェバン行と ${#var}、$# は残す
+        ("a.sh", "#!/bin/sh\nn=${#arr[@]}  # 要素数\necho $#\n", "#!/bin/sh\nn=${#arr[@]}\necho $#\n"),
+        # YAML: URL の #fragment は残す
+        ("a.yaml", "url: http://example.com/#frag # リンク\n# 行全体\nkey: 'a # b'\n", "url: http://example.com/#frag\nkey: 'a # b'\n"),
+        # C 系
+        ("a.c", 'int x = 1; /* 値 */\n// 行全体\nchar *s = "//";\n', 'int x = 1;\nchar *s = "//";\n'),
+        ("a.go", "s := `// raw`\n/*\n複数行\n*/\nx := 1 // 末尾\n", "s := `// raw`\nx := 1\n"),
+        # JavaScript: 正規表現リテラルの中の // や /* はコメントではない
+        (
+            "a.js",
+            "const re = /https?:\\/\\//; if (x) { y(); } // 末尾\n",
+            "const re = /https?:\\/\\//; if (x) { y(); }\n",
+        ),
+        ("a.ts", "f(/[/*]/g, a / b); // 割り算\nreturn /a\\/b/.test(s);\n", "f(/[/*]/g, a / b);\nreturn /a\\/b/.test(s);\n"),
+        ("a.js", "const s = `a // ${b}`; // 末尾\n", "const s = `a // ${b}`;\n"),
+        # CSS とマークアップ
+        ("a.css", "a { color: red; } /* 赤 */\n", "a { color: red; }\n"),
+        ("a.html", "<p>本文</p><!-- 注記 -->\n<!--\n複数行\n-->\n", "<p>本文</p>\n"),
+        # SQL: 文字列内の -- は残す
+        ("a.sql", "SELECT '--' AS x; -- 末尾\n", "SELECT '--' AS x;\n"),
+        # Lua: ブロックコメント --[[ ]] と長い文字列 [[ ]]
+        (
+            "a.lua",
+            "--[[\nprint(1)\n]]\nlocal s = [[-- 文字列]]\nx = 1 --[==[ ]] ]==] y = 2\nz = 3 -- 末尾\n",
+            "local s = [[-- 文字列]]\nx = 1  y = 2\nz = 3\n",
+        ),
+    ],
+)
+def test_strip_comments(path_str, source, expected):
+    assert promp._strip_comments(source, path_str) == expected
+
+
+def test_unknown_extension_is_unchanged():
+    assert promp._strip_comments("a # b\n", "a.unknown") == "a # b\n"